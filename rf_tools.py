@@ -1,34 +1,33 @@
 import datetime
 import glob
+import io
 import json
+import re
+import random
+import socket
+import sqlite3
 
 import sys
 import os
 from pathlib import Path
 import gc
+import collections
+import concurrent.futures
+import resource
+import threading
+import uuid
+import time
+import functools
+import hashlib
 
 import argparse
 import logging
-from pathlib import Path
 
 #import signal
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib import pylab
-
-from scipy.signal import spectrogram
 
-
-import sys
-import os
-#import signal
-import numpy as np
-# main function
-from pathlib import Path
-
-# Import logging features
-import logging
+# matplotlib and scipy take most of the time of importing this module, so they are imported inside the functions that use them.
+# The CLI, the catalog functions and the worker processes only load them when they compute or render a spectrogram.
 
 
 def log_and_raise(msg, exception_type=ValueError):
@@ -36,18 +35,169 @@ def log_and_raise(msg, exception_type=ValueError):
     raise exception_type(msg)
 
 
+# Instrumentation of the pipeline. When a PipelineMetrics object is made active with set_metrics, every stage of the pipeline that
+# is wrapped in measure_stage records its wall time, CPU time, peak RSS and the bytes it read and wrote. When no metrics object is
+# active, measure_stage returns a shared object that does nothing, so the instrumentation costs close to nothing.
+ACTIVE_METRICS = None
+
+
+# This class is the stage returned by measure_stage when the instrumentation is turned off
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add_bytes(self, read=0, written=0):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+# This function returns the counters of /proc/self/io as a dictionary or None if they are not available. rchar and wchar count the
+# bytes passed to read and write calls while read_bytes and write_bytes count the bytes that went to storage.
+def read_io_counters():
+    try:
+        with open('/proc/self/io', 'r') as fp:
+            return {key: int(value) for (key, value) in (line.split(':') for line in fp)}
+    except (OSError, ValueError):
+        return None
+
+
+# This class measures one stage of the pipeline for one capture. It is used as a context manager. The stage can add the bytes it
+# read or wrote with add_bytes, for example the samples of a memory mapped capture file it read, which do not show up in the
+# io counters of the process. The bytes are added by the stage that actually reads them, not by the stage that maps the file.
+class MetricsStage:
+    def __init__(self, metrics, stage, capture):
+        self.metrics = metrics
+        self.stage = stage
+        self.capture = None if capture is None else str(capture)
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add_bytes(self, read=0, written=0):
+        self.bytes_read += read
+        self.bytes_written += written
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.io_start = read_io_counters()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_seconds = time.perf_counter() - self.wall_start
+        cpu_seconds = time.process_time() - self.cpu_start
+        io_end = read_io_counters()
+        record = {'stage': self.stage, 'capture': self.capture, 'pid': os.getpid(), 'start_time': self.start_time,
+                  'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds,
+                  # ru_maxrss is in kilobytes on Linux
+                  'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                  'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written, 'error': exc_type is not None}
+        if self.io_start is not None and io_end is not None:
+            record['io_read_bytes'] = io_end['rchar'] - self.io_start['rchar']
+            record['io_write_bytes'] = io_end['wchar'] - self.io_start['wchar']
+        self.metrics.add_record(record)
+        return False
+
+
+# This class collects the records of the stages of the pipeline. If jsonl_file_name is not None each record is appended to the
+# file as a line of json. If callback is not None it is called with each record as it is made. The records are also kept in
+# the list records and summarized by summary.
+class PipelineMetrics:
+    def __init__(self, jsonl_file_name=None, callback=None):
+        self.jsonl_file_name = jsonl_file_name
+        self.callback = callback
+        self.records = []
+        self.lock = threading.Lock()
+
+    def stage(self, stage, capture=None):
+        return MetricsStage(self, stage, capture)
+
+    def add_record(self, record):
+        with self.lock:
+            self.records.append(record)
+            if self.jsonl_file_name is not None:
+                with open(self.jsonl_file_name, 'a') as fp:
+                    fp.write(json.dumps(record) + '\n')
+        if self.callback is not None:
+            self.callback(record)
+
+    # This function returns a dictionary with the totals for each stage: the number of times it ran, the wall and CPU seconds,
+    # the bytes read and written and the largest peak RSS
+    def summary(self):
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'max_rss_bytes': 0})
+            total['count'] += 1
+            for key in ('wall_seconds', 'cpu_seconds', 'bytes_read', 'bytes_written'):
+                total[key] += record[key]
+            total['max_rss_bytes'] = max(total['max_rss_bytes'], record['max_rss_bytes'])
+        return totals
+
+    # This function prints the summary as a table
+    def print_summary(self):
+        print(f"{'stage':12s} {'count':>6s} {'wall s':>10s} {'cpu s':>10s} {'read MB':>10s} {'written MB':>10s} {'peak RSS MB':>12s}")
+        for (stage, total) in self.summary().items():
+            print(f"{stage:12s} {total['count']:6d} {total['wall_seconds']:10.3f} {total['cpu_seconds']:10.3f} {total['bytes_read']/2**20:10.1f} "
+                  f"{total['bytes_written']/2**20:10.1f} {total['max_rss_bytes']/2**20:12.1f}")
+
+
+# This function makes metrics the active PipelineMetrics object, or turns the instrumentation off if metrics is None, and returns
+# the metrics object that was active before
+def set_metrics(metrics):
+    global ACTIVE_METRICS
+    previous = ACTIVE_METRICS
+    ACTIVE_METRICS = metrics
+    return previous
+
+
+# This function returns a context manager that measures the stage of the pipeline for the capture, e.g.
+#     with measure_stage('stft', full_file_name):
+#         ...
+def measure_stage(stage, capture=None):
+    if ACTIVE_METRICS is None:
+        return NULL_STAGE
+    return ACTIVE_METRICS.stage(stage, capture)
+
+
+# Name of the SQLite catalog that is stored in each capture directory. The catalog holds the contents of every json sidecar in
+# the directory along with the mtime and size of the sidecar, so it only has to be refreshed for sidecars that changed.
+SDR_CATALOG_FILE_NAME = 'sdr_catalog.sqlite'
+
+# The capture time is taken from the date and time in the file name written by sdr_get_samples, e.g. ..._20231104_153012.npy
+SDR_CAPTURE_TIME_PATTERN = re.compile(r'_(\d{8}_\d{6})\.[^.]*$')
+
+
 # create a function called sdr_load_db which creates a list of dictionary objects from the json files in the file_path directory and returns that list.
 # The function takes the following parameters:
 # file_path - a string that is a directory path
+# use_catalog - if True the records are read from the SQLite catalog in the directory, which is refreshed first so only new or
+#               changed json files are parsed. If the catalog cannot be used then the json files are scanned directly.
 # 
 # The function will return a list of dictionary objects.
-def sdr_load_db(file_path):
+def sdr_load_db(file_path, use_catalog=True):
     # check of valid parameters
     
     # verify file_path is a string or Path or None
     if not isinstance(file_path, (str, Path, type(None))):
         log_and_raise('The file_path is not a string, Path or None')
         
+    if use_catalog:
+        try:
+            return sdr_query_db(file_path)
+        except sqlite3.Error as e:
+            logging.warning(f'Unable to use the catalog in {file_path} so scanning the json files: {e}')
+
+    return sdr_scan_db(file_path)
+
+
+# This function creates the list of dictionary objects by globbing the file_path directory and loading every json file. This is
+# what sdr_load_db did before the catalog was added.
+def sdr_scan_db(file_path):
     # create a list of dictionary objects
     json_dict_list = []
     
@@ -67,13 +217,350 @@ def sdr_load_db(file_path):
     # return the list of dictionary objects
     return json_dict_list
 
+
+# This function returns the capture time of a record as a POSIX timestamp. It is read from the capture_time key if the record has
+# one, otherwise from the date and time in the file name. If neither is available then default is returned.
+def sdr_capture_time(params, default=None):
+    if 'capture_time' in params:
+        return datetime.datetime.fromisoformat(params['capture_time']).timestamp()
+    match = SDR_CAPTURE_TIME_PATTERN.search(str(params.get('file_name', '')))
+    if match is None:
+        return default
+    return datetime.datetime.strptime(match.group(1), '%Y%m%d_%H%M%S').timestamp()
+
+
+# This function opens the SQLite catalog in the file_path directory, creating the table and indexes if needed, and returns the
+# sqlite3 connection.
+def sdr_open_catalog(file_path):
+    if not isinstance(file_path, (str, Path)):
+        log_and_raise('The file_path is not a string or Path')
+
+    connection = sqlite3.connect(os.path.join(file_path, SDR_CATALOG_FILE_NAME), timeout=30)
+    with connection:
+        connection.execute("""CREATE TABLE IF NOT EXISTS captures (
+                                json_file_name TEXT PRIMARY KEY,
+                                mtime_ns INTEGER NOT NULL,
+                                size INTEGER NOT NULL,
+                                center_freq_Hz REAL,
+                                sample_rate REAL,
+                                sdr_type TEXT,
+                                capture_time REAL,
+                                record TEXT NOT NULL)""")
+        for column in ('center_freq_Hz', 'sample_rate', 'sdr_type', 'capture_time'):
+            connection.execute(f'CREATE INDEX IF NOT EXISTS captures_{column} ON captures ({column})')
+        # the products derived from each capture, such as the rendered spectrogram or the detected events, with the state of the
+        # json and capture files and the parameters they were made from, see sdr_pending_records
+        connection.execute("""CREATE TABLE IF NOT EXISTS manifest (
+                                product TEXT NOT NULL,
+                                json_file_name TEXT NOT NULL,
+                                input_state TEXT NOT NULL,
+                                parameters TEXT NOT NULL,
+                                output_file_name TEXT,
+                                PRIMARY KEY (product, json_file_name))""")
+        # signal events found by sdr_detect_db, see detect_events
+        connection.execute("""CREATE TABLE IF NOT EXISTS events (
+                                json_file_name TEXT NOT NULL,
+                                time_start REAL NOT NULL,
+                                time_stop REAL NOT NULL,
+                                freq_low_Hz REAL NOT NULL,
+                                freq_high_Hz REAL NOT NULL,
+                                peak_freq_Hz REAL NOT NULL,
+                                peak_db REAL NOT NULL,
+                                mean_db REAL NOT NULL,
+                                cell_count INTEGER NOT NULL)""")
+        for column in ('json_file_name', 'freq_low_Hz', 'freq_high_Hz', 'peak_db'):
+            connection.execute(f'CREATE INDEX IF NOT EXISTS events_{column} ON events ({column})')
+    return connection
+
+
+# This function brings the catalog in the file_path directory up to date with the json files in the directory. Only json files
+# whose mtime or size differ from the catalog are parsed and rows for json files that were removed are deleted. json files that
+# are not capture records, an object with a file_name, are logged and left out of the catalog.
+# It returns the tuple (number of records added or updated, number of records removed).
+def sdr_refresh_catalog(file_path, connection=None):
+    close_connection = connection is None
+    if connection is None:
+        connection = sdr_open_catalog(file_path)
+
+    try:
+        catalog = {name: (mtime_ns, size) for (name, mtime_ns, size) in connection.execute('SELECT json_file_name, mtime_ns, size FROM captures')}
+
+        rows = []
+        found = set()
+        with os.scandir(file_path) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if catalog.get(entry.name) == (stat.st_mtime_ns, stat.st_size):
+                    found.add(entry.name)
+                    continue
+
+                logging.debug(f'Loading {entry.path}')
+                # json files that are not capture records, such as a list or an object without a file_name, are skipped
+                try:
+                    with open(entry.path, 'r') as fp:
+                        json_dict = json.load(fp)
+                except (OSError, ValueError) as e:
+                    logging.warning(f'Skipped {entry.path} which cannot be read as json: {e}')
+                    continue
+                if not isinstance(json_dict, dict) or 'file_name' not in json_dict:
+                    logging.warning(f'Skipped {entry.path} which is not a capture record')
+                    continue
+                found.add(entry.name)
+                rows.append((entry.name, stat.st_mtime_ns, stat.st_size, json_dict.get('center_freq_Hz'), json_dict.get('sample_rate'),
+                             json_dict.get('sdr_type'), sdr_capture_time(json_dict, default=stat.st_mtime), json.dumps(json_dict)))
+
+        removed = [(name,) for name in catalog if name not in found]
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.executemany('DELETE FROM captures WHERE json_file_name = ?', removed)
+        if rows or removed:
+            logging.info(f'Refreshed the catalog in {file_path}: {len(rows)} added or updated, {len(removed)} removed')
+        return (len(rows), len(removed))
+    finally:
+        if close_connection:
+            connection.close()
+
+
+# This function queries the catalog in the file_path directory and returns the matching records as a list of dictionary
+# objects, the same as sdr_load_db, sorted by capture time. None means no limit for any of the following parameters:
+# center_freq_min_Hz, center_freq_max_Hz - the inclusive range of center_freq_Hz
+# sample_rate - only records with this sample rate
+# sdr_type - only records from this sdr type
+# time_start, time_end - the inclusive range of the capture time as a datetime or POSIX timestamp
+# If refresh is True the catalog is first brought up to date with the json files in the directory.
+# For example the captures between 88 and 108 MHz from the last week are
+#     sdr_query_db(file_path, 88e6, 108e6, time_start=datetime.datetime.now() - datetime.timedelta(days=7))
+def sdr_query_db(file_path, center_freq_min_Hz=None, center_freq_max_Hz=None, sample_rate=None, sdr_type=None, time_start=None, time_end=None, refresh=True):
+    if not isinstance(file_path, (str, Path)):
+        log_and_raise('The file_path is not a string or Path')
+
+    conditions = []
+    values = []
+    for (column, operator, value) in (('center_freq_Hz', '>=', center_freq_min_Hz), ('center_freq_Hz', '<=', center_freq_max_Hz),
+                                      ('sample_rate', '=', sample_rate), ('sdr_type', '=', sdr_type),
+                                      ('capture_time', '>=', time_start), ('capture_time', '<=', time_end)):
+        if value is None:
+            continue
+        if isinstance(value, datetime.datetime):
+            value = value.timestamp()
+        conditions.append(f'{column} {operator} ?')
+        values.append(value)
+
+    query = 'SELECT record FROM captures'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY capture_time, json_file_name'
+
+    connection = sdr_open_catalog(file_path)
+    try:
+        if refresh:
+            sdr_refresh_catalog(file_path, connection=connection)
+        return [json.loads(record) for (record,) in connection.execute(query, values)]
+    finally:
+        connection.close()
+
+
+# This function returns the list of the records of the catalog that the product has to be made for, as tuples of
+# (json_file_name, params, input_state). A record is pending if the product was never made for it, if the json file or the
+# capture file changed since (their mtime and size are the input_state), if the product was made with other parameters, or if
+# the output file of the product no longer exists. parameters is a dictionary of everything that changes the product. If force is
+# True every record is pending. Pass the input_state to sdr_record_product once the product has been made.
+def sdr_pending_records(connection, file_path, product, parameters, force=False):
+    parameters = json.dumps(parameters, sort_keys=True, default=str)
+    done = {name: (input_state, done_parameters, output_file_name) for (name, input_state, done_parameters, output_file_name)
+            in connection.execute('SELECT json_file_name, input_state, parameters, output_file_name FROM manifest WHERE product = ?', (product,))}
+
+    pending = []
+    for (json_file_name, mtime_ns, size, record) in connection.execute('SELECT json_file_name, mtime_ns, size, record FROM captures ORDER BY json_file_name').fetchall():
+        params = json.loads(record)
+        try:
+            stat = os.stat(Path(file_path, params['file_name']))
+        except (OSError, KeyError) as e:
+            logging.warning(f'Unable to make the {product} of {json_file_name}: {e}')
+            continue
+        input_state = json.dumps([mtime_ns, size, stat.st_mtime_ns, stat.st_size])
+        if not force and json_file_name in done:
+            (done_input_state, done_parameters, output_file_name) = done[json_file_name]
+            if done_input_state == input_state and done_parameters == parameters and (output_file_name is None or os.path.exists(output_file_name)):
+                continue
+        pending.append((json_file_name, params, input_state))
+    return pending
+
+
+# This function records in the manifest that the product was made for the record json_file_name from the input_state returned by
+# sdr_pending_records with parameters. output_file_name is the file the product was written to, or None if it is stored in the
+# catalog.
+def sdr_record_product(connection, product, json_file_name, input_state, parameters, output_file_name=None):
+    with connection:
+        connection.execute('INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?)',
+                           (product, json_file_name, input_state, json.dumps(parameters, sort_keys=True, default=str), None if output_file_name is None else str(output_file_name)))
+
+
+# This function removes the entries of the manifest of records that are no longer in the catalog
+def sdr_prune_manifest(connection):
+    with connection:
+        connection.execute('DELETE FROM manifest WHERE json_file_name NOT IN (SELECT json_file_name FROM captures)')
+
+
+# This function returns the name of a temporary file in the same directory as full_file_name and with the same extension, which is
+# unique to this host, process and thread. A file is written to the temporary file and then renamed to full_file_name with
+# os.replace so other processes, including processes on other hosts sharing the directory, never see a partly written file.
+def temporary_file_name(full_file_name):
+    full_file_name = Path(full_file_name)
+    return full_file_name.with_name(f'.{full_file_name.stem}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp{full_file_name.suffix}')
+
+
+# This function writes the header of a .npy file for an array of the given dtype and shape to the open file fp. The samples are
+# then appended to the file, for example by a gnuradio file sink, so the capture can be read with np.load.
+def write_npy_header(fp, dtype, shape):
+    fp.write(npy_header(dtype, shape))
+
+
+# This function returns the bytes of a .npy header for an array of the given dtype and shape
+def npy_header(dtype, shape):
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)), 'fortran_order': False, 'shape': shape})
+    return header.getvalue()
+
+
+# This function returns the name of a capture file which is
+# sdr_<sdr_type>_fc_<center_freq_Hz>_fs_<sample_rate>_YYYYMMDD_HHMMSS.npy
+# The time is capture_time, a datetime, or the current time if capture_time is None.
+def sdr_capture_file_name(sdr_type, center_freq_Hz, sample_rate, capture_time=None):
+    if capture_time is None:
+        capture_time = datetime.datetime.now()
+    return 'sdr_' + sdr_type + '_fc_' + str(center_freq_Hz) + '_fs_' + str(sample_rate) + '_' + capture_time.strftime("%Y%m%d_%H%M%S") + '.npy'
+
+
+# This function saves the json sidecar of the capture file full_file_name and returns the full file name of the json file.
+# Any extra keyword arguments are added to the json file.
+def sdr_write_sidecar(full_file_name, sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type, dtype='complex64', layout='complex', scale=1.0, **extra):
+    full_file_name = str(full_file_name)
+    (file_path, file_name) = os.path.split(full_file_name)
+    full_json_file_name = full_file_name.replace('.npy', '.json')
+    json_dict = {'sample_rate': sample_rate, 'center_freq_Hz': center_freq_Hz, 'time_to_collect_sec': time_to_collect_sec, 'sdr_type': sdr_type, 'file_path': str(file_path), 'file_name': str(file_name), 'full_file_name': full_file_name,
+                 'dtype': dtype, 'layout': layout, 'scale': scale}
+    json_dict.update(extra)
+    with open(full_json_file_name, 'w') as fp:
+        json.dump(json_dict, fp)
+        logging.info(f'Saved the json file to {full_json_file_name}')
+    return full_json_file_name
+
+
+# Number of samples that share one scale factor in the quantized capture format
+QUANTIZED_BLOCK_SIZE = 65536
+
+# Integer types of the quantized capture format and the largest value used for the peak of a block
+QUANTIZED_DTYPES = {'int8': 127, 'int16': 32767}
+
+
+# This class is a read only view of a capture stored as interleaved integer IQ that decodes to complex64 on the fly. data is
+# the (N, 2) integer array, normally memory mapped, and sample i is scales[i // block_size]*(I + jQ). Slicing the view only
+# reads and decodes the samples in the slice, so the chunked STFT and the other functions that walk a capture with
+# iter_capture_chunks read the compact file directly. nbytes is the size of the stored data, which is the number of bytes
+# that are read from disk.
+class QuantizedCapture:
+    def __init__(self, data, scales, block_size):
+        self.data = data
+        self.scales = np.asarray(scales, dtype=np.float32)
+        self.block_size = block_size
+        self.dtype = np.dtype(np.complex64)
+        self.shape = (len(data),)
+        self.ndim = 1
+        self.nbytes = data.nbytes
+
+    def __len__(self):
+        return len(self.data)
+
+    def decode(self, start, stop):
+        if stop <= start:
+            return np.zeros(0, dtype=np.complex64)
+        x = np.asarray(self.data[start:stop], dtype=np.float32)
+        first_block = start // self.block_size
+        last_block = (stop - 1) // self.block_size
+        edges = np.clip(np.arange(first_block, last_block + 2)*self.block_size, start, stop)
+        x *= np.repeat(self.scales[first_block:last_block + 1], np.diff(edges))[:, np.newaxis]
+        return x.view(np.complex64).reshape(-1)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            (start, stop, step) = key.indices(len(self))
+            if step == 1:
+                return self.decode(start, stop)
+            if step > 0:
+                return self.decode(start, stop)[::step]
+        elif isinstance(key, (int, np.integer)):
+            index = key + len(self) if key < 0 else key
+            if not 0 <= index < len(self):
+                raise IndexError(f'index {key} is out of bounds for a capture of {len(self)} samples')
+            return self.decode(index, index + 1)[0]
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        x = self.decode(0, len(self))
+        return x if dtype is None else x.astype(dtype)
+
+
+# This function returns the name of the .npy file that holds the scale factors of the blocks of the quantized capture
+# full_file_name. The file is next to the capture and only its name is stored in the json sidecar as block_scales_file_name.
+def quantized_scales_file_name(full_file_name):
+    full_file_name = Path(full_file_name)
+    return full_file_name.with_name(full_file_name.stem + '.scales.npy')
+
+
+# This function quantizes the complex samples of x to interleaved integer IQ of the type dtype ('int8' or 'int16') and writes them to
+# the .npy file full_file_name. Each block of block_size samples gets its own scale factor so the peak of the block uses the full
+# range of the integer type. x can be a memory mapped array and is read one block at a time. The scale factors are written as
+# float32 to scales_file_name, by default the file given by quantized_scales_file_name, and the function returns the name of that
+# file without its path, which is stored in the json sidecar as block_scales_file_name.
+def save_quantized_capture(full_file_name, x, dtype='int8', block_size=QUANTIZED_BLOCK_SIZE, scales_file_name=None):
+    if dtype not in QUANTIZED_DTYPES:
+        log_and_raise(f'The dtype {dtype} is not one of {list(QUANTIZED_DTYPES)}')
+    if not isinstance(block_size, int) or block_size <= 0:
+        log_and_raise('The block_size is not a positive integer')
+    full_scale = QUANTIZED_DTYPES[dtype]
+    if scales_file_name is None:
+        scales_file_name = quantized_scales_file_name(full_file_name)
+
+    out = np.lib.format.open_memmap(str(full_file_name), mode='w+', dtype=dtype, shape=(len(x), 2))
+    scales = np.ones(-(-len(x) // block_size), dtype=np.float32)
+    for (index, block) in enumerate(iter_capture_chunks(x, block_size)):
+        iq = np.empty((len(block), 2), dtype=np.float32)
+        iq[:, 0] = block.real
+        iq[:, 1] = block.imag
+        peak = float(np.max(np.abs(iq))) if len(iq) > 0 else 0.0
+        scale = peak / full_scale if peak > 0 else 1.0
+        iq *= 1/scale
+        np.rint(iq, out=iq)
+        out[index*block_size:index*block_size + len(block)] = iq
+        scales[index] = scale
+    out.flush()
+    del out
+
+    temporary_scales_file_name = temporary_file_name(scales_file_name)
+    np.save(temporary_scales_file_name, scales)
+    os.replace(temporary_scales_file_name, scales_file_name)
+    return Path(scales_file_name).name
+
+# This function returns the full file name of the capture of the record params as a Path without opening it, the same as
+# load_capture_file: the file_name of the record in the new_file_path directory, or the full_file_name of the record if
+# new_file_path is None.
+def capture_full_file_name(params, new_file_path=None):
+    if new_file_path is not None:
+        return Path(new_file_path, params['file_name'])
+    return Path(params['full_file_name'])
+
 # This function will load a capture file and return the data as a numpy array. The input is a dictionary with the following keys:
 #     full_file_name: the name of the capture file with path
 # The function also accepts an optional parameter which is new_file_path which is a string that is the path to the new file. If this parameter 
 # is not None, then the function will load the file specified by the key 'file_name' using the path specified by new_file_path. 
 # new_file_path can be None in which case the file specified by the key 'file_name' will be loaded using the path specified by the key 'file_path'. This can also be a PAth object or a string
 # The function returns the data as a numpy array. the function also returns the full file name of the file that was loaded.
-def load_capture_file(params, new_file_path=None):
+# The optional parameter mmap_mode is passed to np.load. Use mmap_mode='r' to get a read only memory mapped view of the capture
+# instead of reading the entire file into memory.
+def load_capture_file(params, new_file_path=None, mmap_mode=None):
     # check that params is a dict and the parameter dictionary has the correct keys
     if not isinstance(params, dict):
         raise TypeError('params must be a dictionary')
@@ -86,16 +573,7 @@ def load_capture_file(params, new_file_path=None):
     if not isinstance(new_file_path, (str, Path, type(None))):
         raise TypeError('new_file_path must be a string, Path, or None')
     
-    # if new_file_path is not None, then check that it is a valid path
-    if new_file_path is not None:
-        if isinstance(new_file_path, str):
-            full_file_name =Path(new_file_path, params['file_name'])
-        elif isinstance(new_file_path, Path):
-            full_file_name = new_file_path / params['file_name']
-        else:
-            raise TypeError('new_file_path must be a string, Path, or None')        
-    else:
-        full_file_name = Path(params['full_file_name'])
+    full_file_name = capture_full_file_name(params, new_file_path=new_file_path)
         
     if not full_file_name.exists():
         raise ValueError(f'The full_file_name {full_file_name} does not exist')
@@ -105,18 +583,987 @@ def load_capture_file(params, new_file_path=None):
     # open the file with np.load and check for errors
     try:
 
-        data = np.load(full_file_name)
+        data = np.load(full_file_name, mmap_mode=mmap_mode)
 
     except:
         print('Error opening file: ', full_file_name)
         raise
     
+    # captures stored as interleaved integer IQ, with one scale (interleaved_iq) or a scale for each block (blockscaled_iq), are
+    # decoded to complex64. If mmap_mode is set a QuantizedCapture is returned which only decodes the samples that are sliced.
+    # convert_capture_file writes the sidecar before it replaces the samples, so a capture whose .npy header is still complex is
+    # returned as it is whatever the layout of the sidecar says.
+    layout = params.get('layout')
+    if (layout == 'interleaved_iq' or layout == 'blockscaled_iq') and not np.iscomplexobj(data):
+        if layout == 'interleaved_iq':
+            (scales, block_size) = ([params.get('scale', 1.0)], max(len(data), 1))
+        else:
+            (scales, block_size) = (np.load(full_file_name.with_name(params['block_scales_file_name'])), params['block_size'])
+        data = QuantizedCapture(data, scales, block_size)
+        if mmap_mode is None:
+            data = np.asarray(data)
+    
     # return the data
     return (data, full_file_name)
 
 
+# This function converts the capture of the record params to the quantized format in place. The samples are written with
+# save_quantized_capture to a temporary file, the json sidecar is updated with the dtype, layout 'blockscaled_iq', block_size and
+# block_scales_file_name, and only then the temporary file replaces the capture file, so the record keeps its file names. If the process
+# stops between the two renames the sidecar already describes the quantized capture while the .npy is still complex, which
+# load_capture_file detects from the header of the .npy, and the capture is converted again by the next run. Captures that are
+# already stored as integer IQ are not converted. The function returns the tuple (bytes before, bytes after), where the bytes
+# after include the file of the scale factors, or None if the capture was not converted.
+def convert_capture_file(params, dtype='int8', block_size=QUANTIZED_BLOCK_SIZE, new_file_path=None):
+    if params.get('layout', 'complex') not in ('complex', 'blockscaled_iq'):
+        return None
+    (x, full_file_name) = load_capture_file(params, new_file_path=new_file_path, mmap_mode='r')
+    if isinstance(x, QuantizedCapture):
+        return None
+    full_file_name = str(full_file_name)
+    bytes_before = os.path.getsize(full_file_name)
+
+    temporary_data_file_name = str(temporary_file_name(full_file_name))
+    scales_file_name = save_quantized_capture(temporary_data_file_name, x, dtype=dtype, block_size=block_size, scales_file_name=quantized_scales_file_name(full_file_name))
+    del x
+
+    full_json_file_name = full_file_name.replace('.npy', '.json')
+    with open(full_json_file_name, 'r') as fp:
+        json_dict = json.load(fp)
+    json_dict.update({'dtype': dtype, 'layout': 'blockscaled_iq', 'scale': 1.0, 'block_size': block_size, 'block_scales_file_name': scales_file_name})
+    temporary_json_file_name = temporary_file_name(full_json_file_name)
+    with open(temporary_json_file_name, 'w') as fp:
+        json.dump(json_dict, fp)
+    os.replace(temporary_json_file_name, full_json_file_name)
+    os.replace(temporary_data_file_name, full_file_name)
+
+    bytes_after = os.path.getsize(full_file_name) + os.path.getsize(quantized_scales_file_name(full_file_name))
+    logging.info(f'Converted {full_file_name} to {dtype} from {bytes_before} to {bytes_after} bytes')
+    return (bytes_before, bytes_after)
+
+
+# This function converts all of the complex captures of the database in the file_path directory to the quantized format with
+# convert_capture_file and returns the tuple (number of captures converted, bytes before, bytes after).
+def sdr_convert_db(file_path, dtype='int8', block_size=QUANTIZED_BLOCK_SIZE):
+    converted = 0
+    total_before = 0
+    total_after = 0
+    for params in sdr_load_db(file_path):
+        with measure_stage('convert', params.get('full_file_name')) as stage:
+            result = convert_capture_file(params, dtype=dtype, block_size=block_size, new_file_path=file_path)
+            if result is not None:
+                stage.add_bytes(read=result[0], written=result[1])
+        if result is not None:
+            converted += 1
+            total_before += result[0]
+            total_after += result[1]
+    return (converted, total_before, total_after)
+
+
+# Number of taps on each side of the center of the lowpass filter used by read_slice, per unit of decimation
+ZOOM_TAPS_PER_DECIMATION = 16
+
+
+# This function reads the samples of the record from t_start to t_stop seconds from the start of the capture. Only the samples in
+# the slice are read from the file, through a memory map or the QuantizedCapture view, so the cost depends on the length of the
+# slice and not on the size of the capture. t_start and t_stop can be None for the start and the end of the capture.
+# If f_low and f_high are given, in Hz at RF like center_freq_Hz, the slice is mixed down so the middle of the band is at 0 Hz,
+# lowpass filtered to the band and decimated by the largest factor that keeps the band, which is a zoom into the band. Samples
+# around the slice are read so the filter has no startup transient, and sample n of the result is the sample at
+# t_start + n/sample_rate of the capture.
+# The function returns the tuple (samples, sample_rate, center_freq_Hz) of the slice.
+def read_slice(record, t_start=None, t_stop=None, f_low=None, f_high=None, new_file_path=None):
+    from scipy.signal import firwin, upfirdn
+    (x, _) = load_capture_file(record, new_file_path=new_file_path, mmap_mode='r')
+    sample_rate = record['sample_rate']
+    center_freq_Hz = record.get('center_freq_Hz', 0)
+
+    start = 0 if t_start is None else int(round(t_start * sample_rate))
+    stop = len(x) if t_stop is None else int(round(t_stop * sample_rate))
+    start = min(max(start, 0), len(x))
+    stop = min(max(stop, 0), len(x))
+    if start >= stop:
+        log_and_raise(f'The slice from {t_start} to {t_stop} seconds has no samples in the capture of {len(x)/sample_rate} seconds')
+
+    if f_low is None and f_high is None:
+        return (np.array(x[start:stop]), sample_rate, center_freq_Hz)
+    if f_low is None or f_high is None:
+        log_and_raise('Both f_low and f_high must be given')
+    if not f_low < f_high:
+        log_and_raise('The f_low must be less than f_high')
+    if f_low < center_freq_Hz - sample_rate/2 or f_high > center_freq_Hz + sample_rate/2:
+        log_and_raise(f'The band from {f_low} to {f_high} Hz is not inside the capture from {center_freq_Hz - sample_rate/2} to {center_freq_Hz + sample_rate/2} Hz')
+
+    bandwidth = f_high - f_low
+    offset_Hz = (f_low + f_high)/2 - center_freq_Hz
+    decimation = max(int(sample_rate // bandwidth), 1)
+    half_length = ZOOM_TAPS_PER_DECIMATION*decimation
+    taps = firwin(2*half_length + 1, min(bandwidth/2, sample_rate/2*0.999), fs=sample_rate)
+
+    # read the slice with half_length samples on each side, with zeros past the ends of the capture
+    read_start = start - half_length
+    read_stop = stop + half_length
+    dtype = np.result_type(x.dtype, np.complex64)
+    samples = np.zeros(read_stop - read_start, dtype=dtype)
+    samples[max(read_start, 0) - read_start:min(read_stop, len(x)) - read_start] = x[max(read_start, 0):min(read_stop, len(x))]
+
+    # the mixer phase is computed from the sample number in the capture so slices of the same capture line up
+    samples *= np.exp(-2j*np.pi*offset_Hz/sample_rate*np.arange(read_start, read_stop)).astype(dtype)
+    # output n of upfirdn is centered on input n*decimation - half_length, so the slice starts at output 2*ZOOM_TAPS_PER_DECIMATION
+    first = 2*ZOOM_TAPS_PER_DECIMATION
+    count = -(-(stop - start) // decimation)
+    zoom = upfirdn(taps, samples, down=decimation)[first:first + count].astype(dtype, copy=False)
+
+    zoom_sample_rate = sample_rate / decimation
+    if float(zoom_sample_rate).is_integer():
+        zoom_sample_rate = int(zoom_sample_rate)
+    return (zoom, zoom_sample_rate, center_freq_Hz + offset_Hz)
+
+
+# STFT parameters used when rendering spectrograms. These match the values that have always been used by render_spectrogram_to_file
+SPECTROGRAM_NPERSEG = 128
+SPECTROGRAM_NOVERLAP = 64
+SPECTROGRAM_WINDOW = ('tukey', .25)
+
+# Desired figure size of the rendered spectrograms: (width, height) in inches
+SPECTROGRAM_FIG_WIDTH = 10
+SPECTROGRAM_FIG_HEIGHT = 6
+
+# Number of samples read from a capture at a time by the streaming STFT. The peak memory used by the STFT depends on this
+# value and not on the length of the capture.
+SPECTROGRAM_CHUNK_SIZE = 1_048_576
+
+# Precision of the analysis path, set with set_analysis_precision. 'double' computes the STFT in the precision of the capture and
+# is the same as scipy.signal.spectrogram. 'single' casts each chunk to complex64 and computes the STFT, magnitude and dB in
+# float32, which halves the memory traffic. FFT_WORKERS is the number of threads used by each batched FFT, -1 for all cores.
+ANALYSIS_PRECISIONS = ('double', 'single')
+ANALYSIS_PRECISION = 'double'
+FFT_WORKERS = 1
+
+
+# This function sets the precision and the number of FFT threads used by stft_db_stream and the functions built on it, and
+# returns the previous (precision, fft_workers)
+def set_analysis_precision(precision='double', fft_workers=1):
+    global ANALYSIS_PRECISION, FFT_WORKERS
+    if precision not in ANALYSIS_PRECISIONS:
+        log_and_raise(f'The precision {precision} is not one of {ANALYSIS_PRECISIONS}')
+    if not isinstance(fft_workers, int) or fft_workers == 0 or fft_workers < -1:
+        log_and_raise('The fft_workers is not a positive integer or -1')
+    previous = (ANALYSIS_PRECISION, FFT_WORKERS)
+    (ANALYSIS_PRECISION, FFT_WORKERS) = (precision, fft_workers)
+    return previous
+
+
+# This function returns the float type of the spectrogram of a capture with the type x_dtype in the precision, or the current
+# analysis precision if precision is None
+def spectrogram_dtype(x_dtype, precision=None):
+    if (ANALYSIS_PRECISION if precision is None else precision) == 'single':
+        return np.dtype(np.float32)
+    return np.finfo(np.result_type(x_dtype, np.complex64)).dtype
+
+
+# This function is a generator that breaks a capture into chunks of chunk_size samples. x is normally a memory mapped array
+# returned by load_capture_file(..., mmap_mode='r') so only the samples in the current chunk are read from disk.
+def iter_capture_chunks(x, chunk_size=SPECTROGRAM_CHUNK_SIZE):
+    if not isinstance(chunk_size, int) or chunk_size <= 0:
+        log_and_raise('The chunk_size is not a positive integer')
+
+    for start in range(0, len(x), chunk_size):
+        yield np.asarray(x[start:start + chunk_size])
+
+
+# This function returns the tuple (win, scale) of the window and the scale that stft_db_stream uses for samples of dtype. In double
+# precision the window is cast to the output type and the scale is computed the same way scipy.signal.spectrogram does;
+# scaling='density' with mode='complex' uses the square root of the density scale. In single precision both are float32.
+def stft_window(window, nperseg, sample_rate, dtype, single):
+    from scipy.signal import get_window
+    win = get_window(window, nperseg)
+    if single:
+        win = win.astype(np.float32)
+        return (win, np.float32(np.sqrt(1.0 / (sample_rate * (win.astype(np.float64)**2).sum()))))
+
+    output_dtype = np.result_type(dtype, np.complex64)
+    if np.result_type(win, np.complex64) != output_dtype:
+        win = win.astype(output_dtype)
+    return (win, np.sqrt(1.0 / (sample_rate * (win*win).sum())))
+
+
+# This function computes the spectrogram in dB of the STFT segments, an array with the shape (number of segments, nperseg), with
+# the window and scale returned by stft_window. It returns the block with the shape (nperseg, number of segments) and the
+# frequency axis fftshifted. In single precision segments must be a writable complex64 array, and the detrend, window, magnitude
+# and dB are done in place in it.
+def stft_db_segments(segments, win, scale, single, workers=1):
+    from scipy import fft as sp_fft
+    from scipy.signal import detrend
+    nperseg = segments.shape[-1]
+    if single:
+        segments -= segments.mean(axis=-1, keepdims=True)
+        segments *= win
+        block = sp_fft.fft(segments, n=nperseg, overwrite_x=True, workers=workers)
+        block *= scale
+        magnitude = np.abs(block)
+        np.log10(magnitude, out=magnitude)
+        magnitude *= 10
+        return np.fft.fftshift(magnitude, axes=-1).T
+
+    segments = detrend(segments, type='constant', axis=-1)
+    segments = win * segments
+    block = sp_fft.fft(segments, n=nperseg, workers=workers)
+    block *= scale
+
+    # Why fftshift is needed https://github.com/scipy/scipy/issues/5757#issuecomment-259482424
+    spectrogram_db_block = np.abs(np.fft.fftshift(block, axes=-1)).T
+    np.log10(spectrogram_db_block, out=spectrogram_db_block)
+    spectrogram_db_block *= 10
+    return spectrogram_db_block
+
+
+# This function is a generator which computes a streaming STFT of the chunks of samples in chunk_iter and yields the
+# spectrogram in column blocks as the tuple (times, spectrogram_db_block). The samples at the end of each chunk that are
+# needed by the next segment (the noverlap tail) are carried across the chunk boundary, so the output is the same as calling
+# scipy.signal.spectrogram(x, fs=sample_rate, nperseg=nperseg, noverlap=noverlap, return_onesided=False, mode='complex',
+# scaling='density') on the whole capture, followed by the fftshift of the frequency axis and 10*log10(abs()) that
+# render_spectrogram_to_file uses. spectrogram_db_block has the shape (nperseg, number of segments in the block).
+# precision and workers are the analysis precision and FFT threads, or the values set by set_analysis_precision if None. In
+# single precision the chunks are cast to complex64 and the detrend, window, magnitude and dB are done in place in float32.
+def stft_db_stream(chunk_iter, sample_rate, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, window=SPECTROGRAM_WINDOW, precision=None, workers=None):
+    if not isinstance(sample_rate, (int, float)) or sample_rate <= 0:
+        log_and_raise('The sample_rate is not a positive number')
+    if not isinstance(nperseg, int) or nperseg <= 0:
+        log_and_raise('The nperseg is not a positive integer')
+    if not isinstance(noverlap, int) or noverlap < 0 or noverlap >= nperseg:
+        log_and_raise('The noverlap must be an integer >= 0 and less than nperseg')
+
+    precision = ANALYSIS_PRECISION if precision is None else precision
+    workers = FFT_WORKERS if workers is None else workers
+    if precision not in ANALYSIS_PRECISIONS:
+        log_and_raise(f'The precision {precision} is not one of {ANALYSIS_PRECISIONS}')
+    single = precision == 'single'
+
+    step = nperseg - noverlap
+    (win, scale) = (None, None)
+
+    tail = None
+    segment_index = 0
+    for chunk in chunk_iter:
+        if single:
+            chunk = np.asarray(chunk, dtype=np.complex64)
+        buffer = chunk if tail is None or len(tail) == 0 else np.concatenate((tail, chunk))
+        if len(buffer) < nperseg:
+            tail = buffer
+            continue
+        if win is None:
+            (win, scale) = stft_window(window, nperseg, sample_rate, buffer.dtype, single)
+
+        segment_count = (len(buffer) - noverlap) // step
+        segments = np.lib.stride_tricks.sliding_window_view(buffer, nperseg)[0:segment_count*step:step]
+        if single:
+            # one complex64 copy of the segments that the detrend, window and FFT all work in
+            segments = np.array(segments)
+        spectrogram_db_block = stft_db_segments(segments, win, scale, single, workers)
+
+        times = (np.arange(segment_index, segment_index + segment_count)*step + nperseg/2)/float(sample_rate)
+        segment_index += segment_count
+
+        # keep the samples that are still needed by the next segment
+        tail = buffer[segment_count*step:].copy()
+
+        yield (times, spectrogram_db_block)
+
+
+# This function computes the spectrogram in dB of the capture x using the streaming STFT and returns the tuple
+# (frequencies, times, spectrogram_db). The frequencies are fftshifted so they go from -sample_rate/2 to sample_rate/2.
+# x can be a numpy array or a memory mapped array. The spectrogram is written a block at a time into a preallocated
+# array so there are no full size complex, magnitude and log copies. If out is not None it must be a float array
+# (for example a np.memmap) with shape (nperseg, number of segments) that the result is written into.
+# precision and workers are passed to stft_db_stream.
+def compute_spectrogram_db(x, sample_rate, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, chunk_size=SPECTROGRAM_CHUNK_SIZE, out=None, precision=None, workers=None):
+    from scipy import fft as sp_fft
+    step = nperseg - noverlap
+    segment_count = (len(x) - noverlap) // step if len(x) >= nperseg else 0
+
+    if out is None:
+        out = np.empty((nperseg, segment_count), dtype=spectrogram_dtype(x.dtype, precision))
+    elif out.shape != (nperseg, segment_count):
+        log_and_raise(f'out must have the shape {(nperseg, segment_count)}')
+
+    times = np.empty(segment_count)
+    column = 0
+    for (times_block, spectrogram_db_block) in stft_db_stream(iter_capture_chunks(x, chunk_size), sample_rate, nperseg=nperseg, noverlap=noverlap, precision=precision, workers=workers):
+        block_count = spectrogram_db_block.shape[1]
+        out[:, column:column + block_count] = spectrogram_db_block
+        times[column:column + block_count] = times_block
+        column += block_count
+
+    frequencies = np.fft.fftshift(sp_fft.fftfreq(nperseg, 1/sample_rate))
+    return (frequencies, times, out)
+
+
+# This function computes the spectrogram in dB of the capture x with the streaming STFT and pools the time axis down to at most
+# width columns as the blocks are produced, so the memory used does not grow with the number of STFT segments.
+# pooling is 'max' or 'mean' and is applied to the dB values of the segments that fall in each output column.
+# The function returns the tuple (frequencies, times, spectrogram_db) where times is the time of the first segment in each column
+# and spectrogram_db has the shape (nperseg, min(width, number of segments)).
+def compute_pooled_spectrogram_db(x, sample_rate, width, pooling='max', nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, chunk_size=SPECTROGRAM_CHUNK_SIZE):
+    from scipy import fft as sp_fft
+    step = nperseg - noverlap
+    segment_count = (len(x) - noverlap) // step if len(x) >= nperseg else 0
+    blocks = stft_db_stream(iter_capture_chunks(x, chunk_size), sample_rate, nperseg=nperseg, noverlap=noverlap)
+    (times, spectrogram_db) = pool_spectrogram_blocks(blocks, segment_count, width, pooling=pooling, nperseg=nperseg, dtype=spectrogram_dtype(x.dtype))
+    frequencies = np.fft.fftshift(sp_fft.fftfreq(nperseg, 1/sample_rate))
+    return (frequencies, times, spectrogram_db)
+
+
+# This function pools the time axis of the spectrogram blocks (times, spectrogram_db_block) from blocks, such as the blocks of
+# stft_db_stream, down to at most width columns. segment_count is the total number of segments in the blocks. The function
+# returns the tuple (times, spectrogram_db), see compute_pooled_spectrogram_db.
+def pool_spectrogram_blocks(blocks, segment_count, width, pooling='max', nperseg=SPECTROGRAM_NPERSEG, dtype=np.float64):
+    if not isinstance(width, int) or width <= 0:
+        log_and_raise('The width is not a positive integer')
+    if pooling not in ('max', 'mean'):
+        log_and_raise('The pooling must be "max" or "mean"')
+
+    column_count = min(width, segment_count)
+
+    out = np.full((nperseg, column_count), -np.inf if pooling == 'max' else 0.0, dtype=dtype)
+    counts = np.zeros(column_count)
+    times = np.empty(column_count)
+
+    segment_index = 0
+    for (times_block, spectrogram_db_block) in blocks:
+        block_count = spectrogram_db_block.shape[1]
+        # output column of each segment in the block. The columns are sorted so reduceat can be used on each run of equal columns
+        columns = np.arange(segment_index, segment_index + block_count) * column_count // segment_count
+        starts = np.flatnonzero(np.r_[True, columns[1:] != columns[:-1]])
+        block_columns = columns[starts]
+        if pooling == 'max':
+            out[:, block_columns] = np.maximum(out[:, block_columns], np.maximum.reduceat(spectrogram_db_block, starts, axis=1))
+        else:
+            out[:, block_columns] += np.add.reduceat(spectrogram_db_block, starts, axis=1)
+        new_columns = counts[block_columns] == 0
+        times[block_columns[new_columns]] = times_block[starts[new_columns]]
+        counts[block_columns] += np.diff(np.r_[starts, block_count])
+        segment_index += block_count
+
+    if pooling == 'mean' and column_count > 0:
+        out /= counts
+
+    return (times, out)
+
+
+# Largest number of STFT segments that iter_batch_spectrogram_db transforms with one FFT. 1024 segments of 128 complex128 samples
+# are 2 MiB, which stays in the CPU cache; larger batches were slower. Captures with more segments than this already amortize the
+# per-capture overhead and are computed on their own with the streaming STFT.
+BATCH_SPECTROGRAM_SEGMENTS = 1024
+
+
+# This function is a generator which computes the spectrograms in dB of the captures in capture_iter, which all have the sample
+# rate sample_rate, and yields one tuple (frequencies, times, spectrogram_db) for each capture in order, the same as
+# compute_spectrogram_db. The captures are packed into batches of up to batch_segments STFT segments. The samples of a batch are
+# concatenated, the segments of every capture are gathered from one strided view of the concatenation, and the whole batch is
+# detrended, windowed and transformed with one FFT. This saves the window setup, framing and FFT call of each capture, which is
+# most of the time for sweeps of many short captures. The spectrograms are the same as compute_spectrogram_db to the bit.
+# A capture with more than batch_segments segments is computed by compute_spectrogram_db on its own. A batch is also ended when
+# the dtype of the captures changes, since the window and scale depend on it.
+def iter_batch_spectrogram_db(capture_iter, sample_rate, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, window=SPECTROGRAM_WINDOW, precision=None, workers=None, batch_segments=BATCH_SPECTROGRAM_SEGMENTS):
+    from scipy import fft as sp_fft
+    if not isinstance(sample_rate, (int, float)) or sample_rate <= 0:
+        log_and_raise('The sample_rate is not a positive number')
+    if not isinstance(nperseg, int) or nperseg <= 0:
+        log_and_raise('The nperseg is not a positive integer')
+    if not isinstance(noverlap, int) or noverlap < 0 or noverlap >= nperseg:
+        log_and_raise('The noverlap must be an integer >= 0 and less than nperseg')
+    if not isinstance(batch_segments, int) or batch_segments <= 0:
+        log_and_raise('The batch_segments is not a positive integer')
+
+    precision = ANALYSIS_PRECISION if precision is None else precision
+    workers = FFT_WORKERS if workers is None else workers
+    if precision not in ANALYSIS_PRECISIONS:
+        log_and_raise(f'The precision {precision} is not one of {ANALYSIS_PRECISIONS}')
+    single = precision == 'single'
+
+    step = nperseg - noverlap
+    frequencies = np.fft.fftshift(sp_fft.fftfreq(nperseg, 1/sample_rate))
+    windows = {}
+
+    # this function computes the spectrograms of a batch, a list of tuples of (samples, segment count), with one FFT
+    def compute_batch(batch):
+        counts = [segment_count for (_, segment_count) in batch]
+        dtype = batch[0][0].dtype
+        if sum(counts) == 0:
+            return [(frequencies, np.empty(0), np.empty((nperseg, 0), dtype=spectrogram_dtype(dtype, precision))) for _ in batch]
+
+        buffer = np.concatenate([samples for (samples, _) in batch])
+        offsets = np.cumsum([0] + [len(samples) for (samples, _) in batch[:-1]])
+        starts = np.concatenate([offset + np.arange(segment_count)*step for (offset, segment_count) in zip(offsets, counts)])
+        # the fancy index copies the segments out of the strided view, so in single precision they can be worked on in place
+        segments = np.lib.stride_tricks.sliding_window_view(buffer, nperseg)[starts]
+        if dtype not in windows:
+            windows[dtype] = stft_window(window, nperseg, sample_rate, dtype, single)
+        (win, scale) = windows[dtype]
+        spectrogram_db = stft_db_segments(segments, win, scale, single, workers)
+
+        results = []
+        column = 0
+        for segment_count in counts:
+            times = (np.arange(segment_count)*step + nperseg/2)/float(sample_rate)
+            results.append((frequencies, times, np.ascontiguousarray(spectrogram_db[:, column:column + segment_count])))
+            column += segment_count
+        return results
+
+    batch = []
+    batch_count = 0
+    for x in capture_iter:
+        segment_count = (len(x) - noverlap) // step if len(x) >= nperseg else 0
+        dtype = np.dtype(np.complex64) if single else np.dtype(x.dtype)
+        if batch and (batch_count + segment_count > batch_segments or batch[0][0].dtype != dtype):
+            yield from compute_batch(batch)
+            (batch, batch_count) = ([], 0)
+
+        if segment_count > batch_segments:
+            yield compute_spectrogram_db(x, sample_rate, nperseg=nperseg, noverlap=noverlap, precision=precision, workers=workers)
+            continue
+        # only the samples used by the segments are read
+        samples = np.asarray(x[:segment_count*step + noverlap] if segment_count > 0 else x[:0], dtype=dtype)
+        batch.append((samples, segment_count))
+        batch_count += segment_count
+
+    if batch:
+        yield from compute_batch(batch)
+
+
+# This function computes the spectrograms in dB of many records of the database with iter_batch_spectrogram_db. The records are
+# grouped by sample rate and each group is batched, so a sweep directory of short captures is transformed with a few large FFTs
+# instead of one STFT per capture. The captures are loaded as memory maps one at a time as the batches are filled.
+# The function is a generator which yields the tuple (index, frequencies, times, spectrogram_db) for each record, where index is
+# the position of the record in records. The groups are in the order of the first record of each sample rate, and the records in
+# a group are in their order in records.
+def sdr_batch_spectrogram_db(records, new_file_path=None, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, precision=None, workers=None, batch_segments=BATCH_SPECTROGRAM_SEGMENTS):
+    groups = {}
+    for (index, params) in enumerate(records):
+        groups.setdefault(params['sample_rate'], []).append(index)
+
+    for (sample_rate, indexes) in groups.items():
+        captures = (load_capture_file(records[index], new_file_path=new_file_path, mmap_mode='r')[0] for index in indexes)
+        results = iter_batch_spectrogram_db(captures, sample_rate, nperseg=nperseg, noverlap=noverlap, precision=precision, workers=workers, batch_segments=batch_segments)
+        for (index, (frequencies, times, spectrogram_db)) in zip(indexes, results):
+            yield (index, frequencies, times, spectrogram_db)
+
+
+# This function computes the spectrograms of the steps of a sweep, the records, with sdr_batch_spectrogram_db and stitches them
+# into a panorama across the band with stitch_panorama. Each spectrogram is reduced over time to its mean power and its max-hold
+# in dB. The records must have the same sample rate. The function returns the tuple (panorama_frequencies, mean_db, max_db).
+def sdr_batch_spectrogram_panorama(records, freq_step_Hz, new_file_path=None, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, precision=None, workers=None, batch_segments=BATCH_SPECTROGRAM_SEGMENTS):
+    if len(records) == 0:
+        log_and_raise('There are no records')
+    if len({params['sample_rate'] for params in records}) != 1:
+        log_and_raise('The records of a panorama must have the same sample_rate')
+
+    spectra = np.empty((len(records), 2, nperseg))
+    for (index, frequencies, times, spectrogram_db) in sdr_batch_spectrogram_db(records, new_file_path=new_file_path, nperseg=nperseg, noverlap=noverlap, precision=precision, workers=workers, batch_segments=batch_segments):
+        if spectrogram_db.shape[1] == 0:
+            log_and_raise(f"The capture of {records[index].get('file_name')} is too short to compute a spectrogram")
+        spectra[index, 0] = 10*np.log10(np.mean(10**(spectrogram_db / 10), axis=1))
+        spectra[index, 1] = spectrogram_db.max(axis=1)
+
+    (panorama_frequencies, panorama) = stitch_panorama([params['center_freq_Hz'] for params in records], frequencies, spectra, freq_step_Hz)
+    return (panorama_frequencies, panorama[0], panorama[1])
+
+
+# Default directory and size cap of the spectrogram cache. The directory can be changed with the RF_TOOLS_CACHE_DIR environment
+# variable or the --cache-dir option.
+SPECTROGRAM_CACHE_PATH = Path(os.environ.get('RF_TOOLS_CACHE_DIR', Path.home() / '.cache' / 'rf_tools' / 'spectrograms'))
+SPECTROGRAM_CACHE_MAX_BYTES = 4 * 2**30
+
+# This class is an on-disk cache of the spectrograms in dB computed by compute_spectrogram_db. Each entry is a .npy file in
+# cache_path that is read back as a memory map, so a repeat view of a capture skips the STFT and only reads the columns it uses.
+# The key of an entry is the capture file (its real path, size and mtime, or a hash of its contents if hash_content is True) and
+# the STFT parameters nperseg, noverlap, window, scaling and precision, so a capture that changes or a different STFT gets a new
+# entry. Entries are written to a temporary file and renamed so worker processes can share the cache. When the entries are
+# larger than max_bytes the least recently used are removed; the mtime of an entry is updated on each hit to track its use.
+# A spectrogram larger than max_bytes is not cached. hits, misses, stores and evictions count the lookups made through this cache,
+# including the lookups of the render workers of render_spectrogram_to_file.
+class SpectrogramCache:
+    def __init__(self, cache_path=SPECTROGRAM_CACHE_PATH, max_bytes=SPECTROGRAM_CACHE_MAX_BYTES, hash_content=False):
+        self.cache_path = Path(cache_path)
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def key(self, full_file_name, nperseg, noverlap, window, precision):
+        if self.hash_content:
+            digest = hashlib.sha1()
+            with open(full_file_name, 'rb') as fp:
+                for block in iter(functools.partial(fp.read, 2**20), b''):
+                    digest.update(block)
+            capture = digest.hexdigest()
+        else:
+            stat = os.stat(full_file_name)
+            capture = (os.path.realpath(full_file_name), stat.st_size, stat.st_mtime_ns)
+        key = json.dumps([capture, nperseg, noverlap, window, 'density', precision], default=str)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def entry_file_name(self, key):
+        return self.cache_path / f'{key}.npy'
+
+    # This function returns the cached spectrogram of the key as a read only memory map, or None if it is not in the cache
+    def lookup(self, key):
+        entry_file_name = self.entry_file_name(key)
+        try:
+            spectrogram_db = np.load(entry_file_name, mmap_mode='r')
+            os.utime(entry_file_name)
+        except (OSError, ValueError):
+            return None
+        return spectrogram_db
+
+    # This function returns the spectrogram in dB of the capture x, which was loaded from full_file_name, as the tuple
+    # (frequencies, times, spectrogram_db) the same as compute_spectrogram_db. It is read from the cache or computed and added to
+    # the cache. The function returns None if the spectrogram is not in the cache and is too large to be cached.
+    def get(self, x, sample_rate, full_file_name, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, chunk_size=SPECTROGRAM_CHUNK_SIZE):
+        from scipy import fft as sp_fft
+        step = nperseg - noverlap
+        segment_count = (len(x) - noverlap) // step if len(x) >= nperseg else 0
+        frequencies = np.fft.fftshift(sp_fft.fftfreq(nperseg, 1/sample_rate))
+        times = (np.arange(segment_count)*step + nperseg/2)/float(sample_rate)
+
+        key = self.key(full_file_name, nperseg, noverlap, SPECTROGRAM_WINDOW, ANALYSIS_PRECISION)
+        spectrogram_db = self.lookup(key)
+        if spectrogram_db is not None and spectrogram_db.shape == (nperseg, segment_count):
+            self.hits += 1
+            return (frequencies, times, spectrogram_db)
+        self.misses += 1
+
+        dtype = spectrogram_dtype(x.dtype)
+        if nperseg * segment_count * dtype.itemsize > self.max_bytes:
+            return None
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+        temporary_file_name = self.cache_path / f'{key}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            out = np.lib.format.open_memmap(temporary_file_name, mode='w+', dtype=dtype, shape=(nperseg, segment_count))
+            compute_spectrogram_db(x, sample_rate, nperseg=nperseg, noverlap=noverlap, chunk_size=chunk_size, out=out)
+            out.flush()
+            del out
+            os.replace(temporary_file_name, self.entry_file_name(key))
+        finally:
+            if temporary_file_name.exists():
+                temporary_file_name.unlink()
+        self.stores += 1
+        self.evict(keep=key)
+        return (frequencies, times, np.load(self.entry_file_name(key), mmap_mode='r'))
+
+    def counts(self):
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores, 'evictions': self.evictions}
+
+    # This function adds the counts of the lookups made by another process, such as a render worker, to the counts of this cache
+    def add_counts(self, counts):
+        self.hits += counts['hits']
+        self.misses += counts['misses']
+        self.stores += counts['stores']
+        self.evictions += counts['evictions']
+
+    def entries(self):
+        entries = []
+        for entry_file_name in self.cache_path.glob('*.npy'):
+            try:
+                stat = entry_file_name.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry_file_name))
+        return sorted(entries)
+
+    # This function removes the least recently used entries, except the entry of keep, until the cache is at most max_bytes
+    def evict(self, keep=None):
+        entries = self.entries()
+        total_bytes = sum(size for (_, size, _) in entries)
+        for (_, size, entry_file_name) in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if entry_file_name.stem == keep:
+                continue
+            try:
+                entry_file_name.unlink()
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        for (_, _, entry_file_name) in self.entries():
+            entry_file_name.unlink(missing_ok=True)
+
+    def stats(self):
+        entries = self.entries()
+        return dict(self.counts(), entries=len(entries), bytes=sum(size for (_, size, _) in entries), max_bytes=self.max_bytes)
+
+
+# The spectrogram cache used by cached_spectrogram_db, or None to always compute the spectrograms. The cache is off by default so
+# importing rf_tools does not write to the disk, turn it on with set_spectrogram_cache(SpectrogramCache()) or the --cache option.
+SPECTROGRAM_CACHE = None
+
+
+# This function sets the spectrogram cache used by cached_spectrogram_db, or turns it off if cache is None, and returns the
+# previous cache
+def set_spectrogram_cache(cache):
+    global SPECTROGRAM_CACHE
+    previous = SPECTROGRAM_CACHE
+    SPECTROGRAM_CACHE = cache
+    return previous
+
+
+# This function returns the spectrogram cache used by cached_spectrogram_db, or None if it is turned off
+def get_spectrogram_cache():
+    return SPECTROGRAM_CACHE
+
+
+# This function returns the spectrogram in dB of the capture x, which was loaded from full_file_name, as the tuple
+# (frequencies, times, spectrogram_db) from the spectrogram cache, computing it with compute_spectrogram_db if it is not cached.
+# If the cache is turned off or the spectrogram is too large to be cached it is computed in memory.
+def cached_spectrogram_db(x, sample_rate, full_file_name, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, chunk_size=SPECTROGRAM_CHUNK_SIZE):
+    result = None
+    if SPECTROGRAM_CACHE is not None:
+        result = SPECTROGRAM_CACHE.get(x, sample_rate, full_file_name, nperseg=nperseg, noverlap=noverlap, chunk_size=chunk_size)
+    if result is None:
+        result = compute_spectrogram_db(x, sample_rate, nperseg=nperseg, noverlap=noverlap, chunk_size=chunk_size)
+    return result
+
+
+# This function returns the spectrogram in dB of the capture of the record params as the tuple (frequencies, times,
+# spectrogram_db) using the spectrogram cache, for use in notebooks. The frequencies are relative to the center frequency.
+def load_spectrogram_db(params, new_file_path=None, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, chunk_size=SPECTROGRAM_CHUNK_SIZE):
+    (x, full_file_name) = load_capture_file(params, new_file_path=new_file_path, mmap_mode='r')
+    return cached_spectrogram_db(x, params['sample_rate'], str(full_file_name), nperseg=nperseg, noverlap=noverlap, chunk_size=chunk_size)
+
+
+# This function maps the spectrogram in dB to a uint8 RGB image of height x width pixels with a lookup table made from the
+# matplotlib colormap cmap_name. The lowest frequency is at the bottom of the image. The color limits default to the minimum
+# and maximum finite values of the data, which is what pcolormesh does. Pixels are mapped to the nearest spectrogram bin.
+def spectrogram_db_to_rgb(spectrogram_db, width, height, cmap_name='viridis', clim=None, lut_size=256):
+    import matplotlib
+    lut = (matplotlib.colormaps[cmap_name].resampled(lut_size)(np.arange(lut_size))[:, :3] * 255).round().astype(np.uint8)
+
+    if clim is None:
+        finite = spectrogram_db[np.isfinite(spectrogram_db)]
+        clim = (finite.min(), finite.max()) if finite.size > 0 else (0.0, 1.0)
+    (vmin, vmax) = clim
+    if vmax <= vmin:
+        vmax = vmin + 1.0
+
+    # the index of the spectrogram bin for each pixel row and column. Rows are flipped so low frequencies are at the bottom
+    rows = (np.arange(height) * spectrogram_db.shape[0] // height)[::-1]
+    columns = np.arange(width) * spectrogram_db.shape[1] // width
+
+    levels = spectrogram_db[np.ix_(rows, columns)]
+    levels -= vmin
+    levels *= (lut_size - 1) / (vmax - vmin)
+    np.nan_to_num(levels, copy=False, nan=0.0, posinf=lut_size - 1, neginf=0.0)
+    np.clip(levels, 0, lut_size - 1, out=levels)
+    return lut[levels.astype(np.intp)]
+
+
+# This function returns the full file name of the PNG file of the spectrogram of the capture full_file_name rendered with
+# render_mode. The mesh render keeps the name of the capture with the extension changed to .png and the raster render adds
+# _raster, so the images of the two modes do not overwrite each other.
+def spectrogram_image_file_name(full_file_name, render_mode='mesh'):
+    full_file_name = Path(full_file_name)
+    if render_mode == 'raster':
+        return full_file_name.with_name(full_file_name.stem + '_raster.png')
+    return full_file_name.with_suffix('.png')
+
+
+# This function returns the name of the product of the manifest and the work queues for the spectrograms rendered with
+# render_mode, so the PNG files of each mode are tracked on their own
+def spectrogram_product(render_mode='mesh'):
+    return 'spectrogram_png' if render_mode == 'mesh' else f'spectrogram_{render_mode}_png'
+
+
+# This function renders the spectrogram of a single record directly to a PNG raster without pcolormesh. The time axis is
+# pooled to the pixel width of the figure while the STFT is computed, the dB values are mapped through a colormap lookup table
+# and the RGB array is written straight to the PNG file. There are no axes or colorbar. The image has the same pixel size as
+# the figure made by render_spectrogram_record with the same fig_width, fig_height and dpi. The spectrogram cache is not used.
+# If spectrogram is given it is the tuple (frequencies, times, spectrogram_db) of the capture, which is pooled instead of
+# reading the capture.
+def render_spectrogram_raster(params, new_file_path=None, chunk_size=SPECTROGRAM_CHUNK_SIZE, fig_width=SPECTROGRAM_FIG_WIDTH, fig_height=SPECTROGRAM_FIG_HEIGHT, dpi=None, pooling='max', cmap_name='viridis', spectrogram=None):
+    import matplotlib.image
+    if new_file_path is None:
+        full_file_path = Path(params['file_path'])
+    else:
+        full_file_path = Path(new_file_path)
+
+    if dpi is None:
+        dpi = matplotlib.rcParams['savefig.dpi']
+        if dpi == 'figure':
+            dpi = matplotlib.rcParams['figure.dpi']
+    width = int(round(fig_width * dpi))
+    height = int(round(fig_height * dpi))
+
+    if spectrogram is None:
+        with measure_stage('load', params.get('full_file_name')):
+            (x, full_file_name)=load_capture_file(params, new_file_path=full_file_path, mmap_mode='r')
+    else:
+        full_file_name = capture_full_file_name(params, new_file_path=full_file_path)
+
+    print(f"Processing {full_file_path}")
+
+    full_image_file_name = spectrogram_image_file_name(full_file_name, 'raster')
+
+    if spectrogram is not None:
+        with measure_stage('pool', full_file_name):
+            (frequencies, times, spectrogram_db) = spectrogram
+            blocks = [(times, spectrogram_db)] if spectrogram_db.shape[1] > 0 else []
+            (times, spectrogram_db) = pool_spectrogram_blocks(blocks, spectrogram_db.shape[1], width, pooling=pooling, nperseg=spectrogram_db.shape[0], dtype=spectrogram_db.dtype)
+    else:
+        with measure_stage('stft', full_file_name) as stage:
+            # the spectrogram is pooled while it is computed and is not kept in the spectrogram cache, which would hold the full
+            # resolution spectrogram of which only width columns are drawn
+            (frequencies, times, spectrogram_db) = compute_pooled_spectrogram_db(x, params['sample_rate'], width, pooling=pooling, chunk_size=chunk_size)
+            stage.add_bytes(read=x.nbytes)
+            del x
+    if spectrogram_db.shape[1] == 0:
+        log_and_raise(f'The capture {full_file_name} is too short to compute a spectrogram')
+
+    with measure_stage('colormap', full_file_name):
+        rgb = spectrogram_db_to_rgb(spectrogram_db, width, height, cmap_name=cmap_name)
+    with measure_stage('encode', full_file_name) as stage:
+        temporary_image_file_name = temporary_file_name(full_image_file_name)
+        matplotlib.image.imsave(temporary_image_file_name, rgb, dpi=dpi)
+        os.replace(temporary_image_file_name, full_image_file_name)
+        stage.add_bytes(written=os.path.getsize(full_image_file_name))
+
+    print(f"Saved spectrogram to {full_image_file_name}")
+    return full_image_file_name
+
+
+# This function renders the spectrogram of a single record of the database to a PNG file and returns the full file name of the
+# PNG file. The file name is given by spectrogram_image_file_name: the data file with the extension changed to .png for the mesh
+# render and to _raster.png for the raster render. The matplotlib backend must
+# already be set to Agg, which is done by render_spectrogram_to_file and by the worker processes it starts.
+# render_mode is 'mesh' to draw the spectrogram with pcolormesh, axes and a colorbar or 'raster' to use the much faster
+# render_spectrogram_raster which writes only the image of the spectrogram.
+# The whole render is measured as the 'render' stage when the instrumentation is on. spectrogram is the precomputed tuple
+# (frequencies, times, spectrogram_db) of the capture, as yielded by iter_render_spectrograms, or None to compute it from the
+# capture.
+def render_spectrogram_record(params, new_file_path=None, chunk_size=SPECTROGRAM_CHUNK_SIZE, fig_width=SPECTROGRAM_FIG_WIDTH, fig_height=SPECTROGRAM_FIG_HEIGHT, render_mode='mesh', spectrogram=None):
+    with measure_stage('render', params.get('full_file_name')):
+        if render_mode == 'raster':
+            return render_spectrogram_raster(params, new_file_path=new_file_path, chunk_size=chunk_size, fig_width=fig_width, fig_height=fig_height, spectrogram=spectrogram)
+        elif render_mode == 'mesh':
+            return render_spectrogram_mesh(params, new_file_path=new_file_path, chunk_size=chunk_size, fig_width=fig_width, fig_height=fig_height, spectrogram=spectrogram)
+        else:
+            log_and_raise('The render_mode must be "mesh" or "raster"')
+
+
+# This function renders the spectrogram of a single record with pcolormesh, axes and a colorbar. See render_spectrogram_record.
+# If spectrogram is given it is the tuple (frequencies, times, spectrogram_db) of the capture, which is drawn instead of reading
+# the capture or the spectrogram cache.
+def render_spectrogram_mesh(params, new_file_path=None, chunk_size=SPECTROGRAM_CHUNK_SIZE, fig_width=SPECTROGRAM_FIG_WIDTH, fig_height=SPECTROGRAM_FIG_HEIGHT, spectrogram=None):
+    import matplotlib.pyplot as plt
+    # If file_path is None, then use the same directory as the data file
+    if new_file_path is None:
+        full_file_path = Path(params['file_path'])
+    else:
+        full_file_path = Path(new_file_path)
+        
+    sample_rate = params['sample_rate']
+    
+    # Load the capture file as a memory map so the STFT only reads one chunk at a time, unless the spectrogram was given
+    if spectrogram is None:
+        with measure_stage('load', params.get('full_file_name')):
+            (x, full_file_name)=load_capture_file(params, new_file_path=full_file_path, mmap_mode='r')
+    else:
+        full_file_name = capture_full_file_name(params, new_file_path=full_file_path)
+    
+    print(f"Processing {full_file_path}") 
+    
+    full_image_file_name = spectrogram_image_file_name(full_file_name, 'mesh')
+    
+    if spectrogram is not None:
+        (frequencies, times, spectrogram_db) = spectrogram
+    else:
+        with measure_stage('stft', full_file_name) as stage:
+            # the samples of the memory mapped capture are only read here, and not at all on a hit of the spectrogram cache
+            hits = None if SPECTROGRAM_CACHE is None else SPECTROGRAM_CACHE.hits
+            (frequencies, times, spectrogram_db)= cached_spectrogram_db(x, sample_rate, str(full_file_name), chunk_size=chunk_size)
+            if hits is None or SPECTROGRAM_CACHE.hits == hits:
+                stage.add_bytes(read=x.nbytes)
+            del x
+
+    with measure_stage('mesh', full_file_name):
+        # create a unique colormap to use for the spectrogram plot
+        cmap = plt.get_cmap('viridis')
+
+        fig = plt.figure(figsize=(fig_width, fig_height))
+        ax = fig.add_subplot(111)
+        ph=ax.pcolormesh(times,frequencies, spectrogram_db, cmap=cmap)
+        ax.set_xlabel('Time (s)')
+        ax.set_ylabel('Frequency (Hz)')
+        #set the colorbar
+        fig.colorbar(ph, ax=ax)
+     
+        ax.set_title('Spectrogram')
+
+    # Save the figure to a PNG file
+    with measure_stage('encode', full_file_name) as stage:
+        temporary_image_file_name = temporary_file_name(full_image_file_name)
+        fig.savefig(temporary_image_file_name)
+        os.replace(temporary_image_file_name, full_image_file_name)
+        stage.add_bytes(written=os.path.getsize(full_image_file_name))
+    
+    # This is a lot of code to clear the memory after each spectrogram was rendered. This was done to prevent the memory from filling up and causing the program to crash.
+    with measure_stage('gc', full_file_name):
+        plt.close()     
+        plt.close(fig)
+        gc.collect()
+    
+    print(f"Saved spectrogram to {full_image_file_name}")
+    return full_image_file_name
+
+
+# Number of FFT bins and the number of segments transformed at a time by spectral_reduce
+PSD_NFFT = 1024
+PSD_BATCH_SEGMENTS = 256
+
+
+# This function reduces the samples in x to averaged power spectra. The samples are split into segments of nfft samples with
+# 50% overlap and the segments are transformed batch_segments at a time with one batched FFT, so the memory used depends on
+# nfft*batch_segments and not on the length of x. The function returns the tuple (frequencies, mean_psd, max_psd) where
+# mean_psd is the Welch PSD, the same as scipy.signal.welch(x, fs=sample_rate, window=window, nperseg=nfft,
+# return_onesided=False, scaling='density') fftshifted, and max_psd is the max-hold of the segment spectra.
+# The frequencies are fftshifted and relative to the center frequency.
+def spectral_reduce(x, sample_rate, nfft=PSD_NFFT, window='hann', batch_segments=PSD_BATCH_SEGMENTS):
+    from scipy import fft as sp_fft
+    from scipy.signal import get_window, detrend
+    if not isinstance(nfft, int) or nfft <= 1:
+        log_and_raise('The nfft is not an integer > 1')
+    if len(x) < nfft:
+        log_and_raise(f'There are {len(x)} samples which is less than nfft {nfft}')
+
+    step = nfft // 2
+    win = get_window(window, nfft)
+    scale = 1.0 / (sample_rate * (win*win).sum())
+
+    segments = np.lib.stride_tricks.sliding_window_view(x, nfft)[::step]
+    sum_psd = np.zeros(nfft)
+    max_psd = np.zeros(nfft)
+    for start in range(0, len(segments), batch_segments):
+        batch = detrend(np.asarray(segments[start:start + batch_segments]), type='constant', axis=-1)
+        batch = sp_fft.fft(batch * win, axis=-1)
+        power = batch.real**2
+        power += batch.imag**2
+        sum_psd += power.sum(axis=0)
+        np.maximum(max_psd, power.max(axis=0), out=max_psd)
+
+    frequencies = np.fft.fftshift(sp_fft.fftfreq(nfft, 1/sample_rate))
+    mean_psd = np.fft.fftshift(sum_psd * (scale / len(segments)))
+    max_psd = np.fft.fftshift(max_psd * scale)
+    return (frequencies, mean_psd, max_psd)
+
+
+# This function stitches the spectra of the steps of a sweep into one panorama across the band. center_freqs_Hz is the center
+# frequency of each step, frequencies are the fftshifted frequencies relative to the center returned by spectral_reduce and
+# spectra is an array with the shape (number of steps, ..., nfft). Only the bins of each step within freq_step_Hz/2 of its center
+# are kept, which trims the band edges where the steps overlap and where the response of the SDR filter rolls off.
+# The function returns the tuple (panorama_frequencies, panorama) where panorama has the shape (..., number of bins kept).
+def stitch_panorama(center_freqs_Hz, frequencies, spectra, freq_step_Hz):
+    spectra = np.asarray(spectra)
+    if spectra.shape[0] != len(center_freqs_Hz) or spectra.shape[-1] != len(frequencies):
+        log_and_raise('The spectra must have the shape (number of steps, ..., number of frequencies)')
+
+    keep = (frequencies >= -freq_step_Hz/2) & (frequencies < freq_step_Hz/2)
+    order = np.argsort(center_freqs_Hz)
+    panorama_frequencies = (np.asarray(center_freqs_Hz, dtype=float)[order, np.newaxis] + frequencies[keep]).reshape(-1)
+    panorama = np.moveaxis(spectra[order][..., keep], 0, -2)
+    panorama = panorama.reshape(panorama.shape[:-2] + (-1,))
+    return (panorama_frequencies, panorama)
+
+
+# This function renders the spectrogram of a record with render_spectrogram_record and returns the full file name of the PNG file.
+# If the record fails to render the error is logged and None is returned, so one bad capture does not stop a batch.
+def try_render_spectrogram_record(params, **kwargs):
+    try:
+        return render_spectrogram_record(params, **kwargs)
+    except Exception as e:
+        logging.error(f"Failed to render the spectrogram of {params.get('full_file_name')}: {e}")
+        print(f"Failed to render the spectrogram of {params.get('full_file_name')}: {e}")
+        return None
+
+
+# This function is run once when each worker process of the process pool used by render_spectrogram_to_file starts. 
+# It switches the worker to the Agg backend once so it does not need to be done for every figure.
+# If collect_metrics is True the worker records the metrics of its stages so they can be returned to the parent process.
+def render_worker_init(collect_metrics=False, precision='double', fft_workers=1, spectrogram_cache=None):
+    import matplotlib
+    matplotlib.use('Agg')
+    set_metrics(PipelineMetrics() if collect_metrics else None)
+    set_analysis_precision(precision, fft_workers)
+    set_spectrogram_cache(spectrogram_cache)
+
+
+# This function is run by the worker processes. It renders one record and returns None instead of raising, so one bad capture
+# does not stop the rest of the batch. The error is logged with the name of the capture.
+# It returns the tuple (full file name of the PNG file or None, list of the metrics records of the task, spectrogram cache counts
+# of the task).
+def render_worker_task(task):
+    (params, new_file_path, chunk_size, fig_width, fig_height, render_mode) = task
+    if ACTIVE_METRICS is not None:
+        ACTIVE_METRICS.records = []
+    cache_counts = None if SPECTROGRAM_CACHE is None else SPECTROGRAM_CACHE.counts()
+    full_image_file_name = try_render_spectrogram_record(params, new_file_path=new_file_path, chunk_size=chunk_size, fig_width=fig_width, fig_height=fig_height, render_mode=render_mode)
+    if cache_counts is not None:
+        cache_counts = {name: count - cache_counts[name] for (name, count) in SPECTROGRAM_CACHE.counts().items()}
+    return (full_image_file_name, [] if ACTIVE_METRICS is None else ACTIVE_METRICS.records, cache_counts)
+
+
+# This function is a generator which yields the tuple (index, spectrogram) for each index of index_list in order, where spectrogram
+# is the tuple (frequencies, times, spectrogram_db) of the capture of sdr_db[index] or None. Runs of consecutive records with the
+# same sample rate whose captures have at most batch_segments STFT segments are computed together with iter_batch_spectrogram_db,
+# which opens each capture once. The longer captures, and the records whose capture cannot be loaded or whose batch fails, get
+# None and are rendered from their capture as before, which also reports their errors.
+def iter_render_spectrograms(sdr_db, index_list, new_file_path=None, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP, batch_segments=BATCH_SPECTROGRAM_SEGMENTS):
+    step = nperseg - noverlap
+
+    # this function computes the spectrograms of a batch, a list of tuples of (index, capture), measured as the 'batch_stft' stage
+    def compute_batch(batch, sample_rate):
+        try:
+            with measure_stage('batch_stft') as stage:
+                results = list(iter_batch_spectrogram_db((x for (_, x) in batch), sample_rate, nperseg=nperseg, noverlap=noverlap, batch_segments=batch_segments))
+                stage.add_bytes(read=sum(x.nbytes for (_, x) in batch))
+        except Exception as e:
+            logging.warning(f'Unable to compute a batch of {len(batch)} spectrograms, they are computed one at a time: {e}')
+            return [(index, None) for (index, _) in batch]
+        return [(index, result) for ((index, _), result) in zip(batch, results)]
+
+    batch = []
+    batch_count = 0
+    batch_sample_rate = None
+    for index in index_list:
+        params = sdr_db[index]
+        try:
+            (x, _) = load_capture_file(params, new_file_path=new_file_path, mmap_mode='r')
+            sample_rate = params['sample_rate']
+        except Exception:
+            x = None
+        segment_count = (len(x) - noverlap) // step if x is not None and len(x) >= nperseg else 0
+        short = 0 < segment_count <= batch_segments
+
+        if batch and (not short or sample_rate != batch_sample_rate or batch_count + segment_count > batch_segments):
+            yield from compute_batch(batch, batch_sample_rate)
+            (batch, batch_count) = ([], 0)
+        if not short:
+            yield (index, None)
+            continue
+        batch.append((index, x))
+        batch_count += segment_count
+        batch_sample_rate = sample_rate
+
+    if batch:
+        yield from compute_batch(batch, batch_sample_rate)
+
+
 # This function will render a spectrogram to a file. The file will be saved in the same directory as the data file
-# The file name will be the same as the data file with the extension changed to .png
+# The file name will be the same as the data file with the extension changed to .png, or to _raster.png for the raster render
 # If index is None, then all the records in the database will be used, by looping through the database. Index can also be a list of indexes or a scalar index
 # Each file will be saved in the same directory as the data file
 # If file_path is None, then the file will be saved in the same directory as the data file
@@ -126,20 +1573,28 @@ def load_capture_file(params, new_file_path=None):
 # [1] https://github.com/matplotlib/mplfinance/issues/483
 # [2] http://datasideoflife.com/?p=1443
 # [3] https://stackoverflow.com/questions/2364945/matplotlib-runs-out-of-memory-when-plotting-in-a-loop
+# The spectrogram is computed with the streaming STFT in compute_spectrogram_db, reading chunk_size samples at a time from a
+# memory mapped capture, so the memory used by the STFT does not grow with the length of the capture.
 #
-def render_spectrogram_to_file(sdr_db, index_arg=None, new_file_path=None):
-    
+# workers is the number of processes used to render the records. If workers is 1 the records are rendered one at a time in this
+# process. If workers is greater than 1 the records are split across a process pool where each worker sets up the Agg backend
+# once. The list of file names is returned in the same order as the records. A record that fails to render is logged and its
+# entry in the returned list is None, so one bad capture does not stop the rest of the batch.
+# If on_rendered is given it is called as on_rendered(index, full_image_file_name) as soon as the record sdr_db[index] has been
+# rendered, before the other records are done, so the caller can record each PNG file as it is written. It is not called for
+# the records that fail to render.
+# render_mode is 'mesh' (the default) or 'raster', see render_spectrogram_record. When the records are rendered in this process the
+# spectrograms of the short captures are computed together in batches by iter_render_spectrograms and passed to the renders.
+def render_spectrogram_to_file(sdr_db, index_arg=None, new_file_path=None, chunk_size=SPECTROGRAM_CHUNK_SIZE, workers=1, render_mode='mesh', on_rendered=None):
+    import matplotlib
+
     # Desired figure size: (width, height)
-    fig_width = 10  # in inches
-    fig_height = 6  # in inches
+    fig_width = SPECTROGRAM_FIG_WIDTH  # in inches
+    fig_height = SPECTROGRAM_FIG_HEIGHT  # in inches
     
-    # Save the current backend
-    original_backend = matplotlib.get_backend()
-    print(f"Original backend is {original_backend}")
-    if original_backend != 'Agg':
-        matplotlib.use('Agg')
-        print(f"Changed backend to {matplotlib.get_backend()}")
-        import matplotlib.pyplot as plt
+    # verify workers is an integer > 0
+    if not isinstance(workers, int) or workers <= 0:
+        log_and_raise('The workers is not a positive integer')
     
     # If index is None, then use the first record in the database
     if index_arg is None:
@@ -153,58 +1608,1211 @@ def render_spectrogram_to_file(sdr_db, index_arg=None, new_file_path=None):
     else:
         raise ValueError("index must be None, an int, or a list")
                
+    if workers > 1 and len(index_list) > 1:
+        tasks = [(sdr_db[index], new_file_path, chunk_size, fig_width, fig_height, render_mode) for index in index_list]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=render_worker_init, initargs=(ACTIVE_METRICS is not None, ANALYSIS_PRECISION, FFT_WORKERS, SPECTROGRAM_CACHE)) as executor:
+            # the results are handled as the tasks finish and put back in the order of the tasks
+            futures = {executor.submit(render_worker_task, task): position for (position, task) in enumerate(tasks)}
+            full_image_file_name_list = [None]*len(tasks)
+            for future in concurrent.futures.as_completed(futures):
+                position = futures[future]
+                (full_image_file_name, records, cache_counts) = future.result()
+                full_image_file_name_list[position] = full_image_file_name
+                for record in records:
+                    ACTIVE_METRICS.add_record(record)
+                if cache_counts is not None and SPECTROGRAM_CACHE is not None:
+                    SPECTROGRAM_CACHE.add_counts(cache_counts)
+                if on_rendered is not None and full_image_file_name is not None:
+                    on_rendered(index_list[position], full_image_file_name)
+        return full_image_file_name_list
+
+    # Save the current backend
+    original_backend = matplotlib.get_backend()
+    print(f"Original backend is {original_backend}")
+    if original_backend != 'Agg':
+        matplotlib.use('Agg')
+        print(f"Changed backend to {matplotlib.get_backend()}")
+    
     full_image_file_name_list=[]
     
-    for index in index_list:
-        # If file_path is None, then use the same directory as the data file
-        if new_file_path is None:
-            full_file_path = Path(sdr_db[index]['file_path'])
-        else:
-            full_file_path = Path(new_file_path)
-            
-        sample_rate = sdr_db[index]['sample_rate']
-        
-        # Load the capture file
-        (x, full_file_name)=load_capture_file(sdr_db[index], new_file_path=full_file_path)
-        
-        print(f"Processing {full_file_path}") 
-        
-        full_image_file_name = Path(full_file_name).with_suffix('.png')
+    try:
+        # the spectrograms of the short captures are computed together with batched FFTs as the records are rendered
+        for (index, spectrogram) in iter_render_spectrograms(sdr_db, index_list, new_file_path=new_file_path):
+            full_image_file_name = try_render_spectrogram_record(sdr_db[index], new_file_path=new_file_path, chunk_size=chunk_size, fig_width=fig_width, fig_height=fig_height, render_mode=render_mode, spectrogram=spectrogram)
+            full_image_file_name_list.append(full_image_file_name)
+            if on_rendered is not None and full_image_file_name is not None:
+                on_rendered(index, full_image_file_name)
+    finally:
+        if original_backend != 'Agg':
+            matplotlib.use(original_backend)
+            print(f"Changed backend back to {matplotlib.get_backend()}")
         
-        (frequencies, times, spectrogram_data)= spectrogram(x, fs=sample_rate, nperseg=128, noverlap=64,return_onesided=False, mode='complex', scaling='density')
+    return full_image_file_name_list
 
-        # Why fftshift is needed https://github.com/scipy/scipy/issues/5757#issuecomment-259482424
-        frequencies = np.fft.fftshift(frequencies)
-        spectrogram_data = np.fft.fftshift(spectrogram_data, axes=0)
-        # create a unique colormap to use for the spectrogram plot
-        cmap = plt.get_cmap('viridis')
+# This function renders the spectrograms of the captures in the file_path directory with render_spectrogram_to_file, skipping the
+# captures whose PNG file is up to date. The manifest in the catalog records the json and capture files and the render parameters
+# of each PNG file, so only new or changed captures, or captures rendered with other parameters, are rendered unless force is
+# True. Each render_mode is its own product with its own PNG files, see spectrogram_product and spectrogram_image_file_name. The function returns the list of the full file names of the spectrograms that were rendered.
+def sdr_render_db(file_path, workers=1, render_mode='mesh', chunk_size=SPECTROGRAM_CHUNK_SIZE, force=False):
+    connection = sdr_open_catalog(file_path)
+    try:
+        sdr_refresh_catalog(file_path, connection=connection)
+        parameters = {'render_mode': render_mode, 'fig_width': SPECTROGRAM_FIG_WIDTH, 'fig_height': SPECTROGRAM_FIG_HEIGHT, 'nperseg': SPECTROGRAM_NPERSEG,
+                      'noverlap': SPECTROGRAM_NOVERLAP, 'window': SPECTROGRAM_WINDOW, 'precision': ANALYSIS_PRECISION}
+        product = spectrogram_product(render_mode)
+        pending = sdr_pending_records(connection, file_path, product, parameters, force=force)
+        print(f"Rendering {len(pending)} of the captures in {file_path}")
 
-        fig = plt.figure(figsize=(fig_width, fig_height))
-        ax = fig.add_subplot(111)
-        ph=ax.pcolormesh(times,frequencies, 10*np.log10(np.abs(spectrogram_data)), cmap=cmap)
-        ax.set_xlabel('Time (s)')
-        ax.set_ylabel('Frequency (Hz)')
-        #set the colorbar
-        fig.colorbar(ph, ax=ax)
-     
-        ax.set_title('Spectrogram')
+        # each PNG file is recorded in the manifest as soon as it is written, so an interrupted run keeps the renders it finished.
+        # The captures that fail to render are logged by render_spectrogram_to_file and are not recorded.
+        full_image_file_name_list = []
+        def record_rendered(index, full_image_file_name):
+            (json_file_name, _, input_state) = pending[index]
+            sdr_record_product(connection, product, json_file_name, input_state, parameters, output_file_name=full_image_file_name)
+            full_image_file_name_list.append(full_image_file_name)
 
-        # Save the figure to a PNG file
-        fig.savefig(full_image_file_name)
-        
-        # This is a lot of code to clear the memory after each spectrogram was rendered. This was done to prevent the memory from filling up and causing the program to crash.
-        plt.close()     
-        pylab.close(fig)
-        gc.collect()
-        
-        full_image_file_name_list.append(full_image_file_name)
-        print(f"Saved spectrogram to {full_image_file_name}")
+        if pending:
+            render_spectrogram_to_file([params for (_, params, _) in pending], new_file_path=file_path, chunk_size=chunk_size, workers=workers, render_mode=render_mode, on_rendered=record_rendered)
+        sdr_prune_manifest(connection)
+        return full_image_file_name_list
+    finally:
+        connection.close()
+
+
+# Name of the directory in a capture directory that holds the lease and done files of the work queues, and the default time in
+# seconds after which the lease of a worker that stopped renewing it expires
+WORK_QUEUE_DIRECTORY_NAME = '.rf_tools_queue'
+WORK_QUEUE_LEASE_SECONDS = 600
+
+
+# This class is a work queue over the captures of a capture directory that can be shared by several processes and hosts, for
+# example over NFS. It only uses files in <file_path>/.rf_tools_queue/<product> so it does not depend on SQLite locking:
+#     <json file name>.lease  - held by the worker processing the capture. It is created with O_EXCL so only one worker can
+#                               claim a capture, and its mtime is renewed every lease_seconds/4 while the capture is processed.
+#                               A lease that was not renewed for lease_seconds belongs to a worker that crashed and is taken
+#                               over by renaming it, which only one worker can do. The lease holds a unique token of the
+#                               claim, and a worker only renews, releases or completes a capture whose lease has its token.
+#     <json file name>.done   - the state of the json and capture files, the parameters and the output file of the product,
+#                               written with a temporary file and os.replace when the capture is done.
+# A capture is skipped when its done file matches the current files and parameters and the output file exists. Lease times are
+# compared with the time of the file server, read from the mtime of a clock file, so the clocks of the hosts do not matter.
+class WorkQueue:
+    def __init__(self, file_path, product, parameters, lease_seconds=WORK_QUEUE_LEASE_SECONDS):
+        self.file_path = Path(file_path)
+        self.product = product
+        self.parameters = json.loads(json.dumps(parameters, sort_keys=True, default=str))
+        self.lease_seconds = lease_seconds
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.tokens = {}
+        self.queue_path = self.file_path / WORK_QUEUE_DIRECTORY_NAME / product
+        self.queue_path.mkdir(parents=True, exist_ok=True)
+        self.clock_file_name = self.queue_path / f'.clock.{socket.gethostname()}.{os.getpid()}'
+
+    def lease_file_name(self, json_file_name):
+        return self.queue_path / (json_file_name + '.lease')
+
+    def done_file_name(self, json_file_name):
+        return self.queue_path / (json_file_name + '.done')
+
+    # This function returns the current time of the file server of the queue directory
+    def server_time(self):
+        with open(self.clock_file_name, 'a'):
+            pass
+        os.utime(self.clock_file_name)
+        return os.stat(self.clock_file_name).st_mtime
+
+    # This function returns the state of the json and capture files of the record params
+    def input_state(self, params):
+        json_stat = os.stat(self.file_path / Path(params['file_name']).with_suffix('.json'))
+        capture_stat = os.stat(self.file_path / params['file_name'])
+        return [json_stat.st_mtime_ns, json_stat.st_size, capture_stat.st_mtime_ns, capture_stat.st_size]
+
+    def is_done(self, json_file_name, input_state):
+        try:
+            with open(self.done_file_name(json_file_name), 'r') as fp:
+                done = json.load(fp)
+        except (OSError, ValueError):
+            return False
+        return (done['input_state'] == input_state and done['parameters'] == self.parameters
+                and (done['output_file_name'] is None or os.path.exists(done['output_file_name'])))
+
+    # This function returns the token written in the lease of the capture, or None if there is no lease or it cannot be read
+    def lease_token(self, json_file_name):
+        try:
+            with open(self.lease_file_name(json_file_name), 'r') as fp:
+                return json.load(fp).get('token')
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    # This function returns True if the lease of the capture is the one this worker claimed
+    def holds_lease(self, json_file_name):
+        token = self.tokens.get(json_file_name)
+        return token is not None and self.lease_token(json_file_name) == token
+
+    # This function tries to claim the capture and returns True if this worker now holds its lease. Each claim writes a new
+    # unique token into the lease, which renew, release and complete check so a worker never touches a lease it lost.
+    def claim(self, json_file_name):
+        lease_file_name = self.lease_file_name(json_file_name)
+        for _ in range(2):
+            try:
+                fd = os.open(lease_file_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    expired = os.stat(lease_file_name).st_mtime + self.lease_seconds < self.server_time()
+                except FileNotFoundError:
+                    continue
+                if not expired:
+                    return False
+                # take over the expired lease. Only the worker whose rename succeeds removes it and tries to claim it again.
+                # The lease may have been renewed, or replaced by the new lease of another worker, between the stat and the
+                # rename, so it is checked again after the rename and put back if it is no longer expired.
+                stale_file_name = lease_file_name.with_name(f'{lease_file_name.name}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.stale')
+                try:
+                    os.rename(lease_file_name, stale_file_name)
+                except FileNotFoundError:
+                    return False
+                if os.stat(stale_file_name).st_mtime + self.lease_seconds >= self.server_time():
+                    try:
+                        # os.link does not replace a lease that another worker created in the meantime
+                        os.link(stale_file_name, lease_file_name)
+                    except FileExistsError:
+                        logging.warning(f'The lease of {json_file_name} was claimed again while it was checked')
+                    os.unlink(stale_file_name)
+                    return False
+                os.unlink(stale_file_name)
+                logging.warning(f'Took over the expired lease of {json_file_name}')
+                continue
+            token = f'{self.worker_id}:{threading.get_ident()}:{uuid.uuid4().hex}'
+            with os.fdopen(fd, 'w') as fp:
+                json.dump({'worker': self.worker_id, 'token': token}, fp)
+            self.tokens[json_file_name] = token
+            return True
+        return False
+
+    # This function renews the lease of the capture and returns False if this worker no longer holds it
+    def renew(self, json_file_name):
+        if not self.holds_lease(json_file_name):
+            logging.warning(f'The lease of {json_file_name} was lost')
+            return False
+        try:
+            os.utime(self.lease_file_name(json_file_name))
+        except FileNotFoundError:
+            logging.warning(f'The lease of {json_file_name} was lost')
+            return False
+        return True
+
+    # This function removes the lease of the capture if this worker still holds it
+    def release(self, json_file_name):
+        if self.holds_lease(json_file_name):
+            try:
+                os.unlink(self.lease_file_name(json_file_name))
+            except FileNotFoundError:
+                pass
+        self.tokens.pop(json_file_name, None)
+
+    # This function records that the capture is done and releases its lease. If the lease was taken over by another worker the
+    # capture is left to that worker and the function returns False.
+    def complete(self, json_file_name, input_state, output_file_name=None):
+        if not self.holds_lease(json_file_name):
+            logging.warning(f'The lease of {json_file_name} was lost, the capture is left to the worker that took it over')
+            self.tokens.pop(json_file_name, None)
+            return False
+        done_file_name = self.done_file_name(json_file_name)
+        temporary_done_file_name = temporary_file_name(done_file_name)
+        with open(temporary_done_file_name, 'w') as fp:
+            json.dump({'input_state': input_state, 'parameters': self.parameters, 'worker': self.worker_id,
+                       'output_file_name': None if output_file_name is None else str(output_file_name)}, fp)
+        os.replace(temporary_done_file_name, done_file_name)
+        self.release(json_file_name)
+        return True
+
+    # This function processes the captures in the directory that are not done and not leased by another worker. process is called
+    # as process(params) and returns the output file name of the product, or None if the product is not a file. The records are
+    # visited in a random order so workers that start together spread out. A capture that fails is logged and released so
+    # another run can retry it. The function returns a dictionary of the number of captures processed, failed, already done,
+    # leased by other workers, skipped because their record has no file_name or their files cannot be read, and lost because
+    # their lease was taken over by another worker while they were processed.
+    def run(self, process):
+        stats = {'processed': 0, 'failed': 0, 'done': 0, 'leased': 0, 'skipped': 0, 'lost': 0}
+        records = sdr_scan_db(self.file_path)
+        random.shuffle(records)
+        try:
+            for params in records:
+                # a json file in the directory that is not a capture record is skipped like in sdr_pending_records
+                try:
+                    json_file_name = Path(params['file_name']).with_suffix('.json').name
+                    input_state = self.input_state(params)
+                except (OSError, KeyError, TypeError) as e:
+                    logging.warning(f'Unable to make the {self.product} of a record in {self.file_path}: {e!r}')
+                    stats['skipped'] += 1
+                    continue
+                if self.is_done(json_file_name, input_state):
+                    stats['done'] += 1
+                    continue
+                if not self.claim(json_file_name):
+                    stats['leased'] += 1
+                    continue
+                # the capture may have been finished by another worker since it was checked
+                if self.is_done(json_file_name, input_state):
+                    self.release(json_file_name)
+                    stats['done'] += 1
+                    continue
+
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=self.heartbeat, args=(json_file_name, stop), daemon=True)
+                heartbeat.start()
+                try:
+                    output_file_name = process(params)
+                except Exception as e:
+                    logging.error(f'Failed to make the {self.product} of {json_file_name}: {e}')
+                    stats['failed'] += 1
+                    self.release(json_file_name)
+                    continue
+                finally:
+                    stop.set()
+                    heartbeat.join()
+                if self.complete(json_file_name, input_state, output_file_name):
+                    stats['processed'] += 1
+                else:
+                    stats['lost'] += 1
+        finally:
+            try:
+                os.unlink(self.clock_file_name)
+            except FileNotFoundError:
+                pass
+        return stats
+
+    def heartbeat(self, json_file_name, stop):
+        while not stop.wait(self.lease_seconds / 4):
+            if not self.renew(json_file_name):
+                return
+
+
+# This function is run by each worker process of sdr_render_queue. It renders the spectrograms of the captures in file_path
+# through the work queue and returns the stats of WorkQueue.run.
+def render_queue_worker(file_path, render_mode='mesh', chunk_size=SPECTROGRAM_CHUNK_SIZE, lease_seconds=WORK_QUEUE_LEASE_SECONDS):
+    import matplotlib
+    matplotlib.use('Agg')
+    parameters = {'render_mode': render_mode, 'fig_width': SPECTROGRAM_FIG_WIDTH, 'fig_height': SPECTROGRAM_FIG_HEIGHT, 'nperseg': SPECTROGRAM_NPERSEG,
+                  'noverlap': SPECTROGRAM_NOVERLAP, 'window': SPECTROGRAM_WINDOW, 'precision': ANALYSIS_PRECISION}
+    queue = WorkQueue(file_path, spectrogram_product(render_mode), parameters, lease_seconds=lease_seconds)
+    return queue.run(lambda params: render_spectrogram_record(params, new_file_path=file_path, chunk_size=chunk_size, render_mode=render_mode))
+
+
+# This function renders the spectrograms of the captures in the file_path directory with workers processes that take the
+# captures from a WorkQueue. It can be run at the same time on several hosts that share the directory and each capture is
+# rendered once. The function returns the total stats of the workers.
+def sdr_render_queue(file_path, workers=1, render_mode='mesh', chunk_size=SPECTROGRAM_CHUNK_SIZE, lease_seconds=WORK_QUEUE_LEASE_SECONDS):
+    if workers <= 1:
+        return render_queue_worker(file_path, render_mode=render_mode, chunk_size=chunk_size, lease_seconds=lease_seconds)
+
+    stats = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=render_worker_init, initargs=(False, ANALYSIS_PRECISION, FFT_WORKERS, SPECTROGRAM_CACHE)) as executor:
+        futures = [executor.submit(render_queue_worker, file_path, render_mode, chunk_size, lease_seconds) for _ in range(workers)]
+        for future in futures:
+            for (name, count) in future.result().items():
+                stats[name] = stats.get(name, 0) + count
+    return stats
+
+
+# The spectrogram pyramid of a capture is stored in the directory <capture name>_pyramid next to the capture. Level 0 is the full
+# resolution spectrogram in dB and each following level is reduced by 2x in time and frequency with max pooling. The frequency
+# is only reduced while the level has more than PYRAMID_MIN_BINS bins, so the levels of a pyramid built with the 128 bin STFT
+# used for rendering keep every frequency bin. Levels are added until the number of columns is at most PYRAMID_MIN_COLUMNS.
+# Each level is a .npy file of float32 with the shape (number of columns, number of frequency bins) so a time range of a level is
+# a contiguous part of the file.
+PYRAMID_DIRECTORY_SUFFIX = '_pyramid'
+PYRAMID_MIN_COLUMNS = 1024
+PYRAMID_MIN_BINS = 128
+PYRAMID_INFO_FILE_NAME = 'pyramid_info.json'
+
+# Number of columns of a level that are read at a time when the next level is built
+PYRAMID_CHUNK_COLUMNS = 65536
+
+
+# This function returns the directory of the spectrogram pyramid of the capture full_file_name
+def spectrogram_pyramid_path(full_file_name):
+    full_file_name = Path(full_file_name)
+    return full_file_name.with_name(full_file_name.stem + PYRAMID_DIRECTORY_SUFFIX)
+
+
+# This function reduces a block of a pyramid level with the shape (columns, bins) by 2 in time and, if reduce_frequency is True,
+# by 2 in frequency with max pooling. An odd last column or bin is kept on its own.
+def pyramid_reduce_block(block, reduce_frequency):
+    if block.shape[0] % 2:
+        block = np.concatenate((block, block[-1:]))
+    block = block.reshape(-1, 2, block.shape[1]).max(axis=1)
+    if reduce_frequency:
+        if block.shape[1] % 2:
+            block = np.concatenate((block, block[:, -1:]), axis=1)
+        block = block.reshape(block.shape[0], -1, 2).max(axis=2)
+    return block
+
+
+# This function builds the multi-resolution spectrogram pyramid of a record of the database. The level 0 spectrogram is written
+# from the streaming STFT straight into a memory mapped file and each following level is built from the previous one
+# PYRAMID_CHUNK_COLUMNS columns at a time, so the memory used does not depend on the length of the capture.
+# If the pyramid already exists and was built from the same capture file (size and mtime) and nperseg it is not rebuilt unless
+# force is True. The STFT uses nperseg bins with 50% overlap. The function returns the directory of the pyramid.
+def build_spectrogram_pyramid(params, new_file_path=None, nperseg=SPECTROGRAM_NPERSEG, chunk_size=SPECTROGRAM_CHUNK_SIZE, min_columns=PYRAMID_MIN_COLUMNS, min_bins=PYRAMID_MIN_BINS, force=False):
+    (x, full_file_name) = load_capture_file(params, new_file_path=new_file_path, mmap_mode='r')
+    sample_rate = params['sample_rate']
+    pyramid_path = spectrogram_pyramid_path(full_file_name)
+    stat = os.stat(full_file_name)
+
+    info_file_name = pyramid_path / PYRAMID_INFO_FILE_NAME
+    if not force and info_file_name.exists():
+        with open(info_file_name, 'r') as fp:
+            info = json.load(fp)
+        if info['capture_size'] == stat.st_size and info['capture_mtime_ns'] == stat.st_mtime_ns and info['nperseg'] == nperseg:
+            return pyramid_path
+
+    noverlap = nperseg // 2
+    segment_count = (len(x) - noverlap) // (nperseg - noverlap) if len(x) >= nperseg else 0
+    if segment_count == 0:
+        log_and_raise(f'The capture {full_file_name} is too short to compute a spectrogram')
+
+    pyramid_path.mkdir(exist_ok=True)
+    levels = []
+
+    level = np.lib.format.open_memmap(pyramid_path / 'level_0.npy', mode='w+', dtype=np.float32, shape=(segment_count, nperseg))
+    column = 0
+    for (times_block, spectrogram_db_block) in stft_db_stream(iter_capture_chunks(x, chunk_size), sample_rate, nperseg=nperseg, noverlap=noverlap):
+        level[column:column + spectrogram_db_block.shape[1]] = spectrogram_db_block.T
+        column += spectrogram_db_block.shape[1]
+    del x
+    levels.append({'time_factor': 1, 'frequency_factor': 1, 'shape': list(level.shape)})
+
+    while level.shape[0] > min_columns:
+        reduce_frequency = level.shape[1] > min_bins
+        shape = ((level.shape[0] + 1) // 2, (level.shape[1] + 1) // 2 if reduce_frequency else level.shape[1])
+        next_level = np.lib.format.open_memmap(pyramid_path / f'level_{len(levels)}.npy', mode='w+', dtype=np.float32, shape=shape)
+        for start in range(0, level.shape[0], PYRAMID_CHUNK_COLUMNS):
+            next_level[start // 2:(start + PYRAMID_CHUNK_COLUMNS + 1) // 2] = pyramid_reduce_block(level[start:start + PYRAMID_CHUNK_COLUMNS], reduce_frequency)
+        next_level.flush()
+        levels.append({'time_factor': levels[-1]['time_factor'] * 2, 'frequency_factor': levels[-1]['frequency_factor'] * (2 if reduce_frequency else 1), 'shape': list(shape)})
+        level = next_level
+    level.flush()
+    del level
+
+    info = {'sample_rate': sample_rate, 'nperseg': nperseg, 'noverlap': noverlap, 'segment_count': segment_count, 'levels': levels,
+            'capture_size': stat.st_size, 'capture_mtime_ns': stat.st_mtime_ns}
+    with open(info_file_name, 'w') as fp:
+        json.dump(info, fp)
+    logging.info(f'Built the spectrogram pyramid {pyramid_path} with {len(levels)} levels')
+    return pyramid_path
+
+
+# This function max pools the axis of the array a down to count cells and returns the pooled array and the index of the first
+# element of each cell
+def max_pool_axis(a, count, axis):
+    starts = np.unique(np.arange(count) * a.shape[axis] // count)
+    return (np.maximum.reduceat(a, starts, axis=axis), starts)
+
+
+# This function returns a view of the spectrogram of a record for the time range t0 to t1 in seconds and the frequency range
+# f0 to f1 in Hz relative to the center frequency. None means the start or end of the capture or band. The view is read from
+# the coarsest level of the spectrogram pyramid that still has at least width columns and min(height, full resolution bins) bins
+# in the range, and only that part of the level is read from disk. It is then max pooled down to at most width columns and
+# height bins. The pyramid is built first, with nperseg bins, if it does not exist. The function returns the tuple (frequencies, times, spectrogram_db) in the
+# same form as compute_spectrogram_db, where the frequencies and times are those of the first bin and column of each cell.
+def get_view(record, t0=None, t1=None, f0=None, f1=None, width=1000, height=600, new_file_path=None, nperseg=SPECTROGRAM_NPERSEG):
+    from scipy import fft as sp_fft
+    pyramid_path = build_spectrogram_pyramid(record, new_file_path=new_file_path, nperseg=nperseg)
+    with open(pyramid_path / PYRAMID_INFO_FILE_NAME, 'r') as fp:
+        info = json.load(fp)
+
+    sample_rate = info['sample_rate']
+    nperseg = info['nperseg']
+    step = nperseg - info['noverlap']
+    segment_times = lambda segments: (segments*step + nperseg/2)/float(sample_rate)
+    frequencies = np.fft.fftshift(sp_fft.fftfreq(nperseg, 1/sample_rate))
+
+    # the range of level 0 segments and frequency bins in the view
+    segment_start = 0 if t0 is None else int(np.clip(np.ceil((t0*sample_rate - nperseg/2)/step), 0, info['segment_count'] - 1))
+    segment_stop = info['segment_count'] if t1 is None else int(np.clip(np.floor((t1*sample_rate - nperseg/2)/step) + 1, segment_start + 1, info['segment_count']))
+    bin_start = 0 if f0 is None else int(np.clip(np.searchsorted(frequencies, f0), 0, nperseg - 1))
+    bin_stop = nperseg if f1 is None else int(np.clip(np.searchsorted(frequencies, f1, side='right'), bin_start + 1, nperseg))
+
+    for level_index in range(len(info['levels']) - 1, -1, -1):
+        level_info = info['levels'][level_index]
+        column_start = segment_start // level_info['time_factor']
+        column_stop = -(-segment_stop // level_info['time_factor'])
+        row_start = bin_start // level_info['frequency_factor']
+        row_stop = -(-bin_stop // level_info['frequency_factor'])
+        if level_index == 0 or (column_stop - column_start >= width and row_stop - row_start >= min(height, bin_stop - bin_start)):
+            break
+
+    level = np.load(pyramid_path / f'level_{level_index}.npy', mmap_mode='r')
+    view = np.array(level[column_start:column_stop, row_start:row_stop]).T
+    del level
+
+    (view, column_starts) = max_pool_axis(view, min(width, view.shape[1]), axis=1)
+    (view, row_starts) = max_pool_axis(view, min(height, view.shape[0]), axis=0)
+    times = segment_times((column_start + column_starts) * level_info['time_factor'])
+    view_frequencies = frequencies[(row_start + row_starts) * level_info['frequency_factor']]
+    return (view_frequencies, times, view)
+
+
+# The detector marks a spectrogram cell as signal when it is DETECT_THRESHOLD_DB above the noise floor of its frequency bin and
+# keeps groups of at least DETECT_MIN_CELLS connected cells as events
+DETECT_THRESHOLD_DB = 10.0
+DETECT_MIN_CELLS = 4
+# The noise floor is estimated over windows of DETECT_FLOOR_COLUMNS spectrogram columns, about one chunk of
+# SPECTROGRAM_CHUNK_SIZE samples with the default STFT, whatever chunks the capture is read in
+DETECT_FLOOR_COLUMNS = 16384
+
+# Names of the values of an event, in the order of the columns of the events table
+EVENT_KEYS = ('time_start', 'time_stop', 'freq_low_Hz', 'freq_high_Hz', 'peak_freq_Hz', 'peak_db', 'mean_db', 'cell_count')
+
+
+# This function is a generator which regroups the (times, spectrogram_db_block) blocks of stft_db_stream into blocks of
+# column_count columns, and a shorter last block, so the blocks do not depend on the chunks the capture is read in.
+def stft_db_windows(blocks, column_count=DETECT_FLOOR_COLUMNS):
+    pending = []
+    pending_count = 0
+    for (times, spectrogram_db_block) in blocks:
+        start = 0
+        while start < len(times):
+            take = min(column_count - pending_count, len(times) - start)
+            pending.append((times[start:start + take], spectrogram_db_block[:, start:start + take]))
+            pending_count += take
+            start += take
+            if pending_count == column_count:
+                yield (np.concatenate([block[0] for block in pending]), np.concatenate([block[1] for block in pending], axis=1))
+                pending = []
+                pending_count = 0
+    if pending:
+        yield (np.concatenate([block[0] for block in pending]), np.concatenate([block[1] for block in pending], axis=1))
+
+
+# This function returns the noise floor under each cell of the spectrogram window spectrogram_db in dB, as described for
+# detect_events. The result broadcasts to the shape of spectrogram_db.
+def spectrogram_noise_floor(spectrogram_db):
+    return np.minimum(np.median(spectrogram_db, axis=1, keepdims=True), np.median(spectrogram_db, axis=0, keepdims=True))
+
+
+# This function finds the bursts of energy in the spectrogram of the capture x. The spectrogram is computed with the streaming
+# STFT used by render_spectrogram_to_file and processed in windows of DETECT_FLOOR_COLUMNS columns (see stft_db_windows), which
+# do not depend on chunk_size, so the events are the same whatever chunks x is read in. For each window the noise floor of a
+# cell is the smaller of the median over time of its frequency bin, which is robust to bursts that occupy less than half of the
+# window, and the median over frequency of its column, which is robust to narrowband signals that last the whole window. The
+# cells more than threshold_db above their noise floor are labeled into connected regions. Regions that touch the boundary
+# between two windows are merged, so a burst that crosses a window boundary is one event.
+# The function returns a list of events. Each event is a dictionary with the keys in EVENT_KEYS: the time range in seconds,
+# the frequency range in Hz (center_freq_Hz plus the baseband frequency), the frequency of the peak, the peak and mean power in
+# dB and the number of spectrogram cells in the event. Events with fewer than min_cells cells are dropped. The events are sorted
+# by their start time.
+def detect_events(x, sample_rate, center_freq_Hz=0, threshold_db=DETECT_THRESHOLD_DB, min_cells=DETECT_MIN_CELLS, chunk_size=SPECTROGRAM_CHUNK_SIZE):
+    from scipy import fft as sp_fft
+    from scipy import ndimage
+    nperseg = SPECTROGRAM_NPERSEG
+    frequencies = np.fft.fftshift(sp_fft.fftfreq(nperseg, 1/sample_rate)) + center_freq_Hz
+    half_bin = sample_rate / nperseg / 2
+    half_segment = nperseg / 2 / sample_rate
+
+    events = []
+    # events that touch the last column of the previous window, as tuples of (event, first row, last row, touches the end)
+    open_events = []
+    for (times, spectrogram_db) in stft_db_windows(stft_db_stream(iter_capture_chunks(x, chunk_size), sample_rate), DETECT_FLOOR_COLUMNS):
+        (labels, label_count) = ndimage.label(spectrogram_db > spectrogram_noise_floor(spectrogram_db) + threshold_db)
+
+        index = np.arange(1, label_count + 1)
+        slices = ndimage.find_objects(labels)
+        peaks = ndimage.maximum(spectrogram_db, labels, index)
+        peak_positions = ndimage.maximum_position(spectrogram_db, labels, index)
+        sums = ndimage.sum_labels(spectrogram_db, labels, index)
+        counts = ndimage.sum_labels(np.ones_like(spectrogram_db), labels, index)
+
+        block_events = []
+        for ((rows, columns), peak, peak_position, region_sum, count) in zip(slices, peaks, peak_positions, sums, counts):
+            event = {'time_start': float(times[columns.start] - half_segment), 'time_stop': float(times[columns.stop - 1] + half_segment),
+                     'freq_low_Hz': float(frequencies[rows.start] - half_bin), 'freq_high_Hz': float(frequencies[rows.stop - 1] + half_bin),
+                     'peak_freq_Hz': float(frequencies[peak_position[0]]), 'peak_db': float(peak), 'mean_db': float(region_sum / count), 'cell_count': int(count)}
+            block_events.append((event, rows.start, rows.stop - 1, columns.stop == labels.shape[1], columns.start == 0))
+
+        # group the open events with the events of this window that continue them, using the overlap of their rows
+        nodes = [(event, first_row, last_row, False) for (event, first_row, last_row, _) in open_events] + \
+                [(event, first_row, last_row, touches_end) for (event, first_row, last_row, touches_end, _) in block_events]
+        group = list(range(len(nodes)))
+        def find(node):
+            while group[node] != node:
+                node = group[node]
+            return node
+        for (i, (_, first_row, last_row, _)) in enumerate(open_events):
+            for (j, (_, block_first_row, block_last_row, _, touches_start)) in enumerate(block_events, start=len(open_events)):
+                if touches_start and block_first_row <= last_row and first_row <= block_last_row:
+                    group[find(j)] = find(i)
+
+        groups = {}
+        for node in range(len(nodes)):
+            groups.setdefault(find(node), []).append(nodes[node])
+        open_events = []
+        for members in groups.values():
+            event = functools.reduce(merge_events, [member[0] for member in members])
+            ends = [member for member in members if member[3]]
+            if ends:
+                open_events.append((event, min(member[1] for member in ends), max(member[2] for member in ends), True))
+            else:
+                events.append(event)
+    events.extend(event for (event, _, _, _) in open_events)
+
+    return sorted((event for event in events if event['cell_count'] >= min_cells), key=lambda event: event['time_start'])
+
+
+# This function merges two events that are parts of the same burst and returns the merged event
+def merge_events(a, b):
+    cell_count = a['cell_count'] + b['cell_count']
+    peak = a if a['peak_db'] >= b['peak_db'] else b
+    return {'time_start': min(a['time_start'], b['time_start']), 'time_stop': max(a['time_stop'], b['time_stop']),
+            'freq_low_Hz': min(a['freq_low_Hz'], b['freq_low_Hz']), 'freq_high_Hz': max(a['freq_high_Hz'], b['freq_high_Hz']),
+            'peak_freq_Hz': peak['peak_freq_Hz'], 'peak_db': peak['peak_db'],
+            'mean_db': (a['mean_db']*a['cell_count'] + b['mean_db']*b['cell_count']) / cell_count, 'cell_count': cell_count}
+
+
+# This function runs detect_events on every capture in the file_path directory that has not been processed yet, or whose json
+# or capture file changed, and stores the events in the events table of the catalog. Captures are skipped when they were
+# processed with the same threshold_db, min_cells and DETECT_FLOOR_COLUMNS unless force is True, see sdr_pending_records.
+# It returns the number of captures that were processed.
+def sdr_detect_db(file_path, threshold_db=DETECT_THRESHOLD_DB, min_cells=DETECT_MIN_CELLS, force=False):
+    connection = sdr_open_catalog(file_path)
+    try:
+        sdr_refresh_catalog(file_path, connection=connection)
+        parameters = {'threshold_db': threshold_db, 'min_cells': min_cells, 'nperseg': SPECTROGRAM_NPERSEG, 'precision': ANALYSIS_PRECISION,
+                      'floor_columns': DETECT_FLOOR_COLUMNS}
+
+        processed = 0
+        for (json_file_name, params, input_state) in sdr_pending_records(connection, file_path, 'events', parameters, force=force):
+            (x, full_file_name) = load_capture_file(params, new_file_path=file_path, mmap_mode='r')
+            print(f"Detecting events in {full_file_name}")
+            events = detect_events(x, params['sample_rate'], center_freq_Hz=params.get('center_freq_Hz', 0), threshold_db=threshold_db, min_cells=min_cells)
+            del x
+
+            with connection:
+                connection.execute('DELETE FROM events WHERE json_file_name = ?', (json_file_name,))
+                connection.executemany(f'INSERT INTO events VALUES (?, {", ".join("?" * len(EVENT_KEYS))})',
+                                       [(json_file_name,) + tuple(event[key] for key in EVENT_KEYS) for event in events])
+            sdr_record_product(connection, 'events', json_file_name, input_state, parameters)
+            logging.info(f'Found {len(events)} events in {full_file_name}')
+            processed += 1
+
+        # remove the events of captures that are no longer in the catalog
+        with connection:
+            connection.execute('DELETE FROM events WHERE json_file_name NOT IN (SELECT json_file_name FROM captures)')
+        sdr_prune_manifest(connection)
+        return processed
+    finally:
+        connection.close()
+
+
+# This function queries the events stored by sdr_detect_db in the catalog of the file_path directory without loading any IQ.
+# The events overlapping the frequency range freq_min_Hz to freq_max_Hz with a peak power of at least min_peak_db are returned.
+# None means no limit. Each event is a dictionary with the keys in EVENT_KEYS plus the full_file_name, center_freq_Hz and
+# sample_rate of its capture, sorted by peak power from strongest to weakest.
+# For example all bursts above -30 dB near 433.9 MHz are
+#     sdr_query_events(file_path, 433.85e6, 433.95e6, min_peak_db=-30)
+def sdr_query_events(file_path, freq_min_Hz=None, freq_max_Hz=None, min_peak_db=None):
+    conditions = []
+    values = []
+    for (condition, value) in (('events.freq_high_Hz >= ?', freq_min_Hz), ('events.freq_low_Hz <= ?', freq_max_Hz), ('events.peak_db >= ?', min_peak_db)):
+        if value is not None:
+            conditions.append(condition)
+            values.append(value)
+
+    query = f'SELECT {", ".join("events." + key for key in EVENT_KEYS)}, captures.record FROM events JOIN captures USING (json_file_name)'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY events.peak_db DESC'
+
+    connection = sdr_open_catalog(file_path)
+    try:
+        events = []
+        for row in connection.execute(query, values):
+            event = dict(zip(EVENT_KEYS, row[:-1]))
+            record = json.loads(row[-1])
+            event.update({key: record.get(key) for key in ('full_file_name', 'center_freq_Hz', 'sample_rate')})
+            events.append(event)
+        return events
+    finally:
+        connection.close()
+
+
+# Name of the table of capture statistics written by sdr_stats_db in the SDR DB directory
+STATS_FILE_NAME = 'sdr_stats.npz'
+# Columns of the per-capture table and of the per-frequency-bin table computed by capture_statistics
+STATS_CAPTURE_KEYS = ('sample_count', 'duration_sec', 'mean_power_db', 'peak_power_db', 'noise_floor_db', 'max_db', 'peak_freq_Hz', 'occupancy')
+STATS_BIN_KEYS = ('freq_Hz', 'mean_db', 'max_db', 'occupancy')
+
+
+# This function computes the statistics of the capture x in one pass over its chunks, with the streaming STFT used by
+# detect_events. It returns the tuple (capture_stats, bin_stats):
+#     capture_stats is a dictionary with the keys in STATS_CAPTURE_KEYS: the number of samples, the duration in seconds, the mean
+#     and peak sample power in dB, the mean noise floor of the spectrogram in dB, the largest spectrogram value in dB, the frequency
+#     of the bin with the largest mean in Hz, and the fraction of spectrogram cells more than threshold_db above the noise floor.
+#     bin_stats is a dictionary with the keys in STATS_BIN_KEYS of arrays with one value per frequency bin: the frequency in Hz
+#     (center_freq_Hz plus the baseband frequency), the mean and largest value in dB and the occupancy of the bin.
+# The noise floor and the occupancy use the noise floor of detect_events, over the same windows of DETECT_FLOOR_COLUMNS columns,
+# so the statistics do not depend on chunk_size. The spectrogram values are NaN if x is shorter than one segment.
+def capture_statistics(x, sample_rate, center_freq_Hz=0, threshold_db=DETECT_THRESHOLD_DB, chunk_size=SPECTROGRAM_CHUNK_SIZE):
+    from scipy import fft as sp_fft
+    nperseg = SPECTROGRAM_NPERSEG
+    power = {'sum': 0.0, 'max': 0.0}
+
+    # the sample power is accumulated as the chunks are passed to the STFT, so the capture is read once
+    def power_chunks():
+        for chunk in iter_capture_chunks(x, chunk_size):
+            chunk_power = np.square(chunk.real, dtype=np.float64) + np.square(chunk.imag, dtype=np.float64)
+            power['sum'] += float(chunk_power.sum())
+            power['max'] = max(power['max'], float(chunk_power.max(initial=0.0)))
+            yield chunk
+
+    bin_sum = np.zeros(nperseg)
+    bin_max = np.full(nperseg, -np.inf)
+    bin_occupied = np.zeros(nperseg, dtype=np.int64)
+    floor_sum = 0.0
+    segment_count = 0
+    for (times, spectrogram_db) in stft_db_windows(stft_db_stream(power_chunks(), sample_rate), DETECT_FLOOR_COLUMNS):
+        noise_floor = spectrogram_noise_floor(spectrogram_db)
+        bin_sum += spectrogram_db.sum(axis=1, dtype=np.float64)
+        np.maximum(bin_max, spectrogram_db.max(axis=1), out=bin_max)
+        bin_occupied += np.count_nonzero(spectrogram_db > noise_floor + threshold_db, axis=1)
+        floor_sum += float(np.broadcast_to(noise_floor, spectrogram_db.shape).sum(dtype=np.float64))
+        segment_count += spectrogram_db.shape[1]
+
+    if segment_count == 0:
+        bin_mean = np.full(nperseg, np.nan)
+        bin_max[:] = np.nan
+        bin_occupancy = np.full(nperseg, np.nan)
+    else:
+        bin_mean = bin_sum / segment_count
+        bin_occupancy = bin_occupied / segment_count
+    frequencies = np.fft.fftshift(sp_fft.fftfreq(nperseg, 1/sample_rate)) + center_freq_Hz
+
+    sample_count = len(x)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        capture_stats = {'sample_count': sample_count, 'duration_sec': sample_count / sample_rate,
+                         'mean_power_db': float(10*np.log10(power['sum'] / sample_count)) if sample_count else np.nan,
+                         'peak_power_db': float(10*np.log10(power['max'])) if sample_count else np.nan,
+                         'noise_floor_db': floor_sum / (segment_count * nperseg) if segment_count else np.nan,
+                         'max_db': float(bin_max.max()) if segment_count else np.nan,
+                         'peak_freq_Hz': float(frequencies[np.argmax(bin_mean)]) if segment_count else np.nan,
+                         'occupancy': float(bin_occupied.sum() / (segment_count * nperseg)) if segment_count else np.nan}
+    bin_stats = {'freq_Hz': frequencies, 'mean_db': bin_mean, 'max_db': bin_max, 'occupancy': bin_occupancy}
+    return (capture_stats, bin_stats)
+
+
+# This function reads the table of capture statistics written by sdr_stats_db in the file_path directory. It returns the tuple
+# (captures, bins) of dictionaries of column arrays, or of pandas DataFrames if as_dataframe is True. captures has one row per
+# capture with the columns json_file_name, center_freq_Hz, sample_rate, capture_time and STATS_CAPTURE_KEYS. bins has one row
+# per frequency bin of each capture with the columns json_file_name, bin and STATS_BIN_KEYS, so for example the occupancy of
+# every bin across the whole DB is
+#     (captures, bins) = sdr_load_stats(file_path)
+#     bins.groupby('freq_Hz')['occupancy'].mean()
+# pandas is only imported when as_dataframe is True.
+def sdr_load_stats(file_path, as_dataframe=True):
+    stats_file_name = Path(file_path, STATS_FILE_NAME)
+    if not stats_file_name.exists():
+        log_and_raise(f'There are no capture statistics in {file_path}, run sdr_stats_db first', FileNotFoundError)
+
+    with np.load(stats_file_name, allow_pickle=False) as table:
+        captures = {key[len('capture.'):]: table[key] for key in table.files if key.startswith('capture.')}
+        bins = {key[len('bin.'):]: table[key] for key in table.files if key.startswith('bin.')}
+    if as_dataframe:
+        import pandas as pd
+        return (pd.DataFrame(captures), pd.DataFrame(bins))
+    return (captures, bins)
+
+
+# This function returns the parameters that the table of capture statistics in the file_path directory was computed with, as the
+# json string that sdr_stats_db writes into it, or None if the table was written without them.
+def sdr_stats_parameters(file_path):
+    with np.load(Path(file_path, STATS_FILE_NAME), allow_pickle=False) as table:
+        return str(table['parameters']) if 'parameters' in table.files else None
+
+
+# This function builds the table of capture statistics of the SDR DB in the file_path directory, which sdr_load_stats reads. The
+# statistics are computed by capture_statistics from one pass over each capture. The manifest of the catalog records the captures
+# that are in the table, so a run only computes the statistics of new or changed captures, or of every capture if force is True
+# or threshold_db or DETECT_FLOOR_COLUMNS changes, and keeps the rows of the others. The table records the parameters it was
+# computed with and its rows are only kept if they are the same. The rows of captures that are no longer in the catalog are removed.
+# The table is a .npz file of columns, which is written to a temporary file and renamed over the old table. If parquet is True
+# the two tables are also written to sdr_stats_captures.parquet and sdr_stats_bins.parquet, which needs pandas and pyarrow.
+# The function returns the number of captures whose statistics were computed.
+def sdr_stats_db(file_path, threshold_db=DETECT_THRESHOLD_DB, force=False, parquet=False):
+    stats_file_name = Path(file_path, STATS_FILE_NAME)
+    connection = sdr_open_catalog(file_path)
+    try:
+        sdr_refresh_catalog(file_path, connection=connection)
+        parameters = {'threshold_db': threshold_db, 'nperseg': SPECTROGRAM_NPERSEG, 'precision': ANALYSIS_PRECISION,
+                      'floor_columns': DETECT_FLOOR_COLUMNS, 'keys': STATS_CAPTURE_KEYS + STATS_BIN_KEYS}
+        catalog = {json_file_name: (center_freq_Hz, sample_rate, capture_time) for (json_file_name, center_freq_Hz, sample_rate, capture_time)
+                   in connection.execute('SELECT json_file_name, center_freq_Hz, sample_rate, capture_time FROM captures')}
+
+        # the rows of a table that was computed with other parameters are not kept
+        if stats_file_name.exists() and sdr_stats_parameters(file_path) == json.dumps(parameters, sort_keys=True, default=str):
+            (old_captures, old_bins) = sdr_load_stats(file_path, as_dataframe=False)
+        else:
+            (old_captures, old_bins) = ({'json_file_name': np.array([], dtype=str)}, {'json_file_name': np.array([], dtype=str)})
+
+        pending = sdr_pending_records(connection, file_path, 'statistics', parameters, force=force)
+        pending_names = {json_file_name for (json_file_name, _, _) in pending}
+        kept = (set(old_captures['json_file_name'].tolist()) & set(catalog)) - pending_names
+        if set(catalog) - kept - pending_names:
+            # the manifest lists captures whose rows are missing, for example if the table was replaced by an older copy
+            pending = [record for record in sdr_pending_records(connection, file_path, 'statistics', parameters, force=True) if record[0] not in kept]
+
+        capture_rows = []
+        bin_rows = []
+        computed = []
+        for (json_file_name, params, input_state) in pending:
+            (x, full_file_name) = load_capture_file(params, new_file_path=file_path, mmap_mode='r')
+            print(f"Computing statistics of {full_file_name}")
+            (capture_stats, bin_stats) = capture_statistics(x, params['sample_rate'], center_freq_Hz=params.get('center_freq_Hz', 0), threshold_db=threshold_db)
+            del x
+            capture_rows.append({'json_file_name': np.array([json_file_name]), **{key: np.array([capture_stats[key]]) for key in STATS_CAPTURE_KEYS}})
+            bin_count = len(bin_stats['freq_Hz'])
+            bin_rows.append({'json_file_name': np.full(bin_count, json_file_name), 'bin': np.arange(bin_count), **bin_stats})
+            computed.append((json_file_name, input_state))
+
+        # the rows kept from the old table and the new rows are concatenated column by column
+        if kept:
+            capture_rows.insert(0, {key: column[np.isin(old_captures['json_file_name'], list(kept))] for (key, column) in old_captures.items()
+                                    if key in ('json_file_name',) + STATS_CAPTURE_KEYS})
+            bin_rows.insert(0, {key: column[np.isin(old_bins['json_file_name'], list(kept))] for (key, column) in old_bins.items()})
+        if not capture_rows:
+            capture_rows = [{key: np.array([], dtype=str if key == 'json_file_name' else float) for key in ('json_file_name',) + STATS_CAPTURE_KEYS}]
+            bin_rows = [{key: np.array([], dtype=str if key == 'json_file_name' else float) for key in ('json_file_name', 'bin') + STATS_BIN_KEYS}]
+        captures = {key: np.concatenate([rows[key] for rows in capture_rows]) for key in capture_rows[0]}
+        bins = {key: np.concatenate([rows[key] for rows in bin_rows]) for key in bin_rows[0]}
+
+        # the catalog columns are taken from the catalog for every row and the captures are sorted by time
+        metadata = [catalog[json_file_name] for json_file_name in captures['json_file_name'].tolist()]
+        for (index, key) in enumerate(('center_freq_Hz', 'sample_rate', 'capture_time')):
+            captures[key] = np.array([values[index] for values in metadata], dtype=float)
+        order = np.lexsort((captures['json_file_name'], captures['capture_time']))
+        captures = {key: column[order] for (key, column) in captures.items()}
+        captures = {key: captures[key] for key in ('json_file_name', 'center_freq_Hz', 'sample_rate', 'capture_time') + STATS_CAPTURE_KEYS}
+
+        temporary_stats_file_name = temporary_file_name(stats_file_name)
+        with open(temporary_stats_file_name, 'wb') as f:
+            np.savez(f, parameters=np.array(json.dumps(parameters, sort_keys=True, default=str)),
+                     **{f'capture.{key}': column for (key, column) in captures.items()}, **{f'bin.{key}': column for (key, column) in bins.items()})
+        os.replace(temporary_stats_file_name, stats_file_name)
+
+        if parquet:
+            import pandas as pd
+            for (name, columns) in (('captures', captures), ('bins', bins)):
+                parquet_file_name = Path(file_path, f'sdr_stats_{name}.parquet')
+                temporary_parquet_file_name = temporary_file_name(parquet_file_name)
+                pd.DataFrame(columns).to_parquet(temporary_parquet_file_name, index=False)
+                os.replace(temporary_parquet_file_name, parquet_file_name)
+
+        for (json_file_name, input_state) in computed:
+            sdr_record_product(connection, 'statistics', json_file_name, input_state, parameters, output_file_name=stats_file_name)
+        sdr_prune_manifest(connection)
+        logging.info(f'Computed the statistics of {len(computed)} captures and kept {len(kept)} in {stats_file_name}')
+        return len(computed)
+    finally:
+        connection.close()
+
+
+# Number of taps of the prototype lowpass filter of the polyphase channelizer for each channel. More taps give sharper channel edges.
+PFB_TAPS_PER_CHANNEL = 16
+
+
+# This function returns the prototype lowpass filter of a polyphase channelizer with channel_count channels. It has
+# channel_count*taps_per_channel taps, a cutoff at half the channel spacing and unity gain at DC.
+def pfb_prototype_filter(channel_count, taps_per_channel=PFB_TAPS_PER_CHANNEL):
+    from scipy.signal import firwin
+    return firwin(channel_count*taps_per_channel, 1/channel_count, window=('kaiser', 8.0))
+
+
+# This function is a generator that splits the stream of chunks of samples from chunk_iter into channel_count channels with a
+# critically sampled polyphase filter bank. Each chunk of input yields a complex64 array of shape (channel_count, n) of the
+# channel samples that the chunk completes, where row k is the channel centered at k*sample_rate/channel_count (so the rows for
+# k >= channel_count/2 are the negative frequencies) decimated by channel_count. Channel k is the same as mixing the input down
+# by k*sample_rate/channel_count, filtering with prototype and keeping every channel_count-th sample, but all of the channels are
+# computed in one pass with taps_per_channel multiply adds per input sample and one batched FFT. The filter state is carried
+# across chunks so the result does not depend on the chunk size.
+def pfb_channelize_stream(chunk_iter, channel_count, prototype=None, taps_per_channel=PFB_TAPS_PER_CHANNEL):
+    from scipy import fft as sp_fft
+    if not isinstance(channel_count, int) or channel_count < 2:
+        log_and_raise('The channel_count is not an integer >= 2')
+    if prototype is None:
+        prototype = pfb_prototype_filter(channel_count, taps_per_channel)
+    # pad the prototype to a whole number of taps per channel and split the time reversed filter into its polyphase components
+    taps_per_channel = -(-len(prototype) // channel_count)
+    filter_length = taps_per_channel*channel_count
+    polyphase = np.zeros(filter_length, dtype=np.float32)
+    polyphase[filter_length - len(prototype):] = prototype[::-1]
+    polyphase = polyphase.reshape(taps_per_channel, channel_count)
+
+    # the filter starts with zero state
+    tail = np.zeros(filter_length - 1, dtype=np.complex64)
+    for chunk in chunk_iter:
+        buffer = np.concatenate((tail, np.asarray(chunk, dtype=np.complex64)))
+        if len(buffer) < filter_length:
+            tail = buffer
+            continue
+        output_count = (len(buffer) - filter_length) // channel_count + 1
+        rows = buffer[:(output_count - 1 + taps_per_channel)*channel_count].reshape(-1, channel_count)
+        accumulator = rows[0:output_count] * polyphase[0]
+        for tap in range(1, taps_per_channel):
+            accumulator += rows[tap:tap + output_count] * polyphase[tap]
+        # the sum over the filter phases is reversed so the inverse FFT mixes channel k down to baseband
+        channels = sp_fft.ifft(accumulator[:, ::-1], axis=-1)
+        channels *= channel_count
+        tail = buffer[output_count*channel_count:].copy()
+        yield channels.T.astype(np.complex64, copy=False)
+
+
+# This function splits the capture of the record params into channel_count channels with pfb_channelize_stream in one pass over
+# the file and saves each channel as its own capture with a json sidecar, so the channels can be loaded with sdr_load_db and
+# rendered like any other capture. The sidecar has the center frequency of the channel and the sample rate divided by
+# channel_count, plus the keys source_file_name and channel. channels is a list of the channels to save as signed indices, where
+# channel k is centered at center_freq_Hz + k*sample_rate/channel_count, or None for all of the channels. The channel captures
+# are saved to file_path, or the directory of the capture if file_path is None, with the same capture time as the capture.
+# The function returns the list of the full file names of the json sidecars.
+def channelize_capture(params, channel_count, channels=None, file_path=None, new_file_path=None, taps_per_channel=PFB_TAPS_PER_CHANNEL, chunk_size=SPECTROGRAM_CHUNK_SIZE):
+    if not isinstance(channel_count, int) or channel_count < 2:
+        log_and_raise('The channel_count is not an integer >= 2')
+    if channels is None:
+        channels = list(range(-(channel_count // 2), channel_count - channel_count // 2))
+    for channel in channels:
+        if not isinstance(channel, int) or not -channel_count < channel < channel_count:
+            log_and_raise(f'The channel {channel} is not an integer between {-channel_count} and {channel_count}')
+
+    (x, full_file_name) = load_capture_file(params, new_file_path=new_file_path, mmap_mode='r')
+    if file_path is None:
+        file_path = Path(full_file_name).parent
+    sample_rate = params['sample_rate']
+    channel_sample_rate = sample_rate / channel_count
+    if float(channel_sample_rate).is_integer():
+        channel_sample_rate = int(channel_sample_rate)
+    capture_time = sdr_capture_time(params)
+    capture_time = datetime.datetime.now() if capture_time is None else datetime.datetime.fromtimestamp(capture_time)
+    output_count = -(-len(x) // channel_count)
+
+    outputs = []
+    for channel in channels:
+        center_freq_Hz = params['center_freq_Hz'] + channel*sample_rate/channel_count
+        if float(center_freq_Hz).is_integer():
+            center_freq_Hz = int(center_freq_Hz)
+        channel_file_name = os.path.join(file_path, sdr_capture_file_name(params.get('sdr_type', 'rtlsdr'), center_freq_Hz, channel_sample_rate, capture_time))
+        outputs.append((channel, center_freq_Hz, channel_file_name, np.lib.format.open_memmap(channel_file_name, mode='w+', dtype=np.complex64, shape=(output_count,))))
+
+    with measure_stage('channelize', capture=full_file_name):
+        position = 0
+        for block in pfb_channelize_stream(iter_capture_chunks(x, chunk_size), channel_count, taps_per_channel=taps_per_channel):
+            for (channel, _, _, out) in outputs:
+                out[position:position + block.shape[1]] = block[channel % channel_count]
+            position += block.shape[1]
+
+    json_file_names = []
+    for (channel, center_freq_Hz, channel_file_name, out) in outputs:
+        out.flush()
+        del out
+        json_file_names.append(sdr_write_sidecar(channel_file_name, channel_sample_rate, center_freq_Hz, output_count / channel_sample_rate, params.get('sdr_type', 'rtlsdr'),
+                                                 capture_time=capture_time.isoformat(), source_file_name=str(full_file_name), channel=channel))
+    logging.info(f'Split {full_file_name} into {len(outputs)} channels of {channel_sample_rate} samples/s')
+    return json_file_names
+
+
+# Default size of the blocks of a StreamingCapture and the number of blocks in its ring buffer
+STREAM_BLOCK_SIZE = 65536
+STREAM_CAPACITY_BLOCKS = 64
+
+
+# This class is a bounded ring buffer of fixed size blocks of samples that is preallocated when it is made, so the memory used by a
+# streaming capture stays constant however long it runs. One producer writes samples with write and any number of consumers read
+# the complete blocks with read, each with its own cursor. The producer never waits for the consumers. A consumer that falls more
+# than capacity_blocks - 1 blocks behind skips the blocks that were overwritten and they are counted as dropped.
+class SampleRingBuffer:
+    def __init__(self, block_size=STREAM_BLOCK_SIZE, capacity_blocks=STREAM_CAPACITY_BLOCKS, dtype=np.complex64):
+        if not isinstance(block_size, int) or block_size <= 0:
+            log_and_raise('The block_size is not a positive integer')
+        if not isinstance(capacity_blocks, int) or capacity_blocks < 2:
+            log_and_raise('The capacity_blocks is not an integer >= 2')
+        self.block_size = block_size
+        self.capacity_blocks = capacity_blocks
+        self.blocks = np.zeros((capacity_blocks, block_size), dtype=dtype)
+        # number of complete blocks written and the number of samples in the block being written
+        self.sequence = 0
+        self.fill = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    # This function copies the samples into the ring buffer and publishes each block as it is completed
+    def write(self, samples):
+        position = 0
+        while position < len(samples):
+            count = min(self.block_size - self.fill, len(samples) - position)
+            self.blocks[self.sequence % self.capacity_blocks, self.fill:self.fill + count] = samples[position:position + count]
+            self.fill += count
+            position += count
+            if self.fill == self.block_size:
+                with self.condition:
+                    self.sequence += 1
+                    self.fill = 0
+                    self.condition.notify_all()
+
+    # This function marks the end of the stream. Consumers read the blocks that are left and then read returns None.
+    # The samples of a partial last block are discarded.
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    # This function copies the block at cursor, or the oldest block that is still in the ring buffer if the consumer fell behind,
+    # into out. It waits for the block to be written and returns the tuple (next cursor, number of blocks dropped), or None if the
+    # stream is closed and there are no more blocks.
+    def read(self, cursor, out):
+        dropped = 0
+        while True:
+            with self.condition:
+                while cursor >= self.sequence and not self.closed:
+                    self.condition.wait()
+                if cursor >= self.sequence:
+                    return None
+                # the slot of the block after the newest one is being written so it can not be read
+                oldest = self.sequence - self.capacity_blocks + 1
+                if cursor < oldest:
+                    dropped += oldest - cursor
+                    cursor = oldest
+            out[:] = self.blocks[cursor % self.capacity_blocks]
+            # if the producer started writing over the block while it was copied then the copy is dropped as well
+            if self.sequence - cursor < self.capacity_blocks:
+                return (cursor + 1, dropped)
+            dropped += 1
+            cursor += 1
+
+
+# A consumer of a StreamingCapture that measures the mean power in dB of each block. The last history_length measurements are
+# kept in history as tuples of (time in seconds of the start of the block, power in dB).
+class PowerMeterConsumer:
+    def __init__(self, sample_rate, history_length=1024):
+        self.sample_rate = sample_rate
+        self.history = collections.deque(maxlen=history_length)
+
+    def process(self, block, start_sample):
+        power = np.mean(block.real**2 + block.imag**2)
+        self.history.append((start_sample / self.sample_rate, 10*np.log10(power) if power > 0 else -np.inf))
+
+    def close(self):
+        pass
+
+
+# A consumer of a StreamingCapture that keeps a rolling spectrogram of the last column_count STFT segments. The STFT is the same
+# streaming STFT used by render_spectrogram_to_file, so the columns match the spectrogram of the capture. The block size of the
+# stream must be at least nperseg. get_spectrogram returns (frequencies, times, spectrogram_db) of the columns in time order.
+# The times are computed from the start_sample of the blocks. When a block does not start where the previous one ended, because
+# the consumer dropped blocks, the STFT is started again at the new block so no segment spans the gap, and gap_count is increased.
+class RollingSpectrogramConsumer:
+    def __init__(self, sample_rate, column_count=4096, nperseg=SPECTROGRAM_NPERSEG, noverlap=SPECTROGRAM_NOVERLAP):
+        from scipy import fft as sp_fft
+        # scipy.signal, which the STFT uses for the window and the detrend, takes about a second to import, so it is imported here
+        # and not in the first call of process on the consumer thread, where the stream would drop blocks while it loads
+        import scipy.signal
+        self.sample_rate = sample_rate
+        self.frequencies = np.fft.fftshift(sp_fft.fftfreq(nperseg, 1/sample_rate))
+        self.spectrogram_db = np.full((nperseg, column_count), -np.inf)
+        self.times = np.full(column_count, np.nan)
+        self.column = 0
+        self.column_total = 0
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.nperseg = nperseg
+        self.noverlap = noverlap
+        self.stream = None
+        self.stream_start_sample = 0
+        self.next_sample = None
+        self.gap_count = 0
+
+    def pending_blocks(self):
+        while self.pending:
+            yield self.pending.popleft()
+
+    # This method starts a new streaming STFT whose first sample is start_sample, dropping the noverlap tail of the old one.
+    # Every block that is fed to the stream produces one block of columns because the block size is at least nperseg.
+    def reset_stream(self, start_sample):
+        if self.stream is not None:
+            self.stream.close()
+        self.pending.clear()
+        self.stream = stft_db_stream(self.pending_blocks(), self.sample_rate, nperseg=self.nperseg, noverlap=self.noverlap)
+        self.stream_start_sample = start_sample
+
+    def process(self, block, start_sample):
+        if len(block) < self.nperseg:
+            log_and_raise(f'The block size {len(block)} is less than nperseg {self.nperseg}')
+        if self.stream is None or start_sample != self.next_sample:
+            if self.stream is not None:
+                self.gap_count += 1
+            self.reset_stream(start_sample)
+        self.next_sample = start_sample + len(block)
+        self.pending.append(block.copy())
+        (times, spectrogram_db_block) = next(self.stream)
+        times = times + self.stream_start_sample / self.sample_rate
+        column_count = self.spectrogram_db.shape[1]
+        # keep only the newest columns if the block has more columns than the rolling spectrogram
+        times = times[-column_count:]
+        spectrogram_db_block = spectrogram_db_block[:, -column_count:]
+        columns = (self.column + np.arange(len(times))) % column_count
+        with self.lock:
+            self.spectrogram_db[:, columns] = spectrogram_db_block
+            self.times[columns] = times
+            self.column = (self.column + len(times)) % column_count
+            self.column_total += len(times)
+
+    def get_spectrogram(self):
+        with self.lock:
+            order = np.roll(np.arange(self.spectrogram_db.shape[1]), -self.column)
+            if self.column_total < self.spectrogram_db.shape[1]:
+                order = order[-self.column_total:] if self.column_total > 0 else order[:0]
+            return (self.frequencies, self.times[order], self.spectrogram_db[:, order])
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+
+# A consumer of a StreamingCapture that writes the blocks to a complex64 .npy capture file and its json sidecar, in the same form
+# as sdr_get_samples. The header of the .npy file is written when the file is opened and updated with the number of samples
+# when the consumer is closed. Dropped blocks are not in the file, so a writer that falls behind shows up in its drop counter.
+class DiskWriterConsumer:
+    def __init__(self, full_file_name, sample_rate, center_freq_Hz, sdr_type='rtlsdr', max_samples=2**40):
+        self.full_file_name = str(full_file_name)
+        self.sample_rate = sample_rate
+        self.center_freq_Hz = center_freq_Hz
+        self.sdr_type = sdr_type
+        self.max_samples = max_samples
+        self.sample_count = 0
+        self.fp = open(self.full_file_name, 'wb')
+        # the header is written for max_samples so it is large enough to be rewritten with the final number of samples
+        self.header_length = len(npy_header(np.complex64, (max_samples,)))
+        self.fp.write(npy_header(np.complex64, (max_samples,)))
+
+    def process(self, block, start_sample):
+        if self.sample_count + len(block) > self.max_samples:
+            return
+        self.fp.write(np.ascontiguousarray(block, dtype=np.complex64).tobytes())
+        self.sample_count += len(block)
+
+    def close(self):
+        header = npy_header(np.complex64, (self.sample_count,))
+        # pad the header with spaces before the newline so the data stays at the same offset
+        header = header[:-1] + b' '*(self.header_length - len(header)) + b'\n'
+        header = header[:8] + (self.header_length - 10).to_bytes(2, 'little') + header[10:]
+        self.fp.seek(0)
+        self.fp.write(header)
+        self.fp.close()
+        sdr_write_sidecar(self.full_file_name, self.sample_rate, self.center_freq_Hz, self.sample_count / self.sample_rate, self.sdr_type)
+
+
+# This class runs a real-time streaming capture. The producer, such as the gnuradio ring_buffer_sink block in rf_tools_gnuradio or
+# run_source, writes samples with write into a preallocated SampleRingBuffer. Each consumer added with add_consumer runs in its
+# own thread and is called as consumer.process(block, start_sample) for every block of block_size samples, and
+# consumer.close() when the stream ends. Consumers that fall behind drop blocks instead of slowing down the producer or growing
+# the memory, and stats returns the number of blocks written and the blocks processed and dropped by each consumer.
+class StreamingCapture:
+    def __init__(self, sample_rate, block_size=STREAM_BLOCK_SIZE, capacity_blocks=STREAM_CAPACITY_BLOCKS, dtype=np.complex64):
+        self.sample_rate = sample_rate
+        self.ring = SampleRingBuffer(block_size=block_size, capacity_blocks=capacity_blocks, dtype=dtype)
+        self.consumers = []
+        self.threads = []
+        self.counters = []
+        self.samples_written = 0
+
+    def add_consumer(self, consumer):
+        if self.threads:
+            log_and_raise('Consumers must be added before the capture is started')
+        self.consumers.append(consumer)
+        self.counters.append({'consumer': type(consumer).__name__, 'blocks_processed': 0, 'blocks_dropped': 0, 'error': None})
+        return consumer
+
+    def consumer_loop(self, consumer, counters):
+        block = np.empty(self.ring.block_size, dtype=self.ring.blocks.dtype)
+        cursor = 0
+        try:
+            while True:
+                result = self.ring.read(cursor, block)
+                if result is None:
+                    break
+                (cursor, dropped) = result
+                if dropped:
+                    if counters['blocks_dropped'] == 0:
+                        logging.warning(f"The consumer {counters['consumer']} is falling behind and dropping blocks")
+                    counters['blocks_dropped'] += dropped
+                consumer.process(block, (cursor - 1) * self.ring.block_size)
+                counters['blocks_processed'] += 1
+        except Exception as e:
+            logging.error(f"The consumer {counters['consumer']} failed: {e}")
+            counters['error'] = str(e)
+        finally:
+            consumer.close()
+
+    def start(self):
+        for (consumer, counters) in zip(self.consumers, self.counters):
+            thread = threading.Thread(target=self.consumer_loop, args=(consumer, counters), name=f"stream_{counters['consumer']}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, samples):
+        self.ring.write(samples)
+        self.samples_written += len(samples)
+
+    # This function ends the stream and waits for the consumers to process the blocks that are left
+    def stop(self):
+        self.ring.close()
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        return {'samples_written': self.samples_written, 'blocks_written': self.ring.sequence, 'consumers': [dict(counters) for counters in self.counters]}
+
+    # This function starts the consumers, writes the blocks of samples from the iterable source until it ends or max_samples
+    # samples were written, stops the capture and returns stats
+    def run_source(self, source, max_samples=None):
+        self.start()
+        try:
+            for samples in source:
+                if max_samples is not None and self.samples_written + len(samples) >= max_samples:
+                    self.write(samples[:max_samples - self.samples_written])
+                    break
+                self.write(samples)
+        finally:
+            self.stop()
+        return self.stats()
+
+
+# This function is a generator of a synthetic stream of blocks of block_size samples of a tone at tone_Hz plus complex gaussian
+# noise, for testing streaming captures without an SDR. If realtime is True the blocks are produced at sample_rate.
+def synthetic_sample_source(sample_rate, block_size=STREAM_BLOCK_SIZE, tone_Hz=100e3, amplitude=0.5, noise_amplitude=0.1, realtime=True, seed=0):
+    rng = np.random.default_rng(seed)
+    start_time = time.perf_counter()
+    start = 0
+    while True:
+        n = np.arange(start, start + block_size)
+        block = (amplitude*np.exp(2j*np.pi*tone_Hz/sample_rate*n) + noise_amplitude/np.sqrt(2)*(rng.standard_normal(block_size) + 1j*rng.standard_normal(block_size))).astype(np.complex64)
+        start += block_size
+        if realtime:
+            delay = start/sample_rate - (time.perf_counter() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+        yield block
+
+
+# This function is a generator of the samples of a capture file of a record of the database in blocks of block_size samples, for
+# testing streaming captures with recorded data. If realtime is True the blocks are produced at the sample rate of the record.
+def file_sample_source(params, block_size=STREAM_BLOCK_SIZE, realtime=False, new_file_path=None):
+    (x, _) = load_capture_file(params, new_file_path=new_file_path, mmap_mode='r')
+    start_time = time.perf_counter()
+    for (index, block) in enumerate(iter_capture_chunks(x, block_size)):
+        if realtime:
+            delay = index*block_size/params['sample_rate'] - (time.perf_counter() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+        yield block
 
-    if original_backend != 'Agg':
-        matplotlib.use(original_backend)
-        print(f"Changed backend back to {matplotlib.get_backend()}")
-        
-    return full_image_file_name_list
 
 def setup_logging(args):
     # Set up logging
@@ -224,12 +2832,58 @@ def main():
     parser.add_argument("--logging-file", default=Path("app.log"), type=Path, help="Path to the logging file.")
     parser.add_argument("--logging-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
                         help="Set the logging level.")
+    parser.add_argument("--profile", action="store_true", help="Measure each stage of the pipeline and print a summary at the end.")
+    parser.add_argument("--profile-file", default=None, type=Path, help="Path to a json lines file the stage measurements are appended to. Implies --profile.")
+
+    parser.add_argument("--precision", default="double", choices=list(ANALYSIS_PRECISIONS),
+                        help="Compute the spectrograms in the precision of the capture (double) or in float32 (single).")
+    parser.add_argument("--fft-workers", default=1, type=int, help="Number of threads used by each FFT, -1 for all cores.")
+    parser.add_argument("--cache", action="store_true", help="Keep the computed spectrograms in the spectrogram cache and read them back from it.")
+    parser.add_argument("--cache-dir", default=SPECTROGRAM_CACHE_PATH, type=Path, help="Directory of the spectrogram cache.")
+    parser.add_argument("--cache-max-bytes", default=SPECTROGRAM_CACHE_MAX_BYTES, type=int, help="Size cap of the spectrogram cache in bytes.")
 
     subparsers = parser.add_subparsers(dest="command", help="Available commands")
 
     # 'render_spectrogram_to_file' command
     render_parser = subparsers.add_parser("render_spectrogram_to_file", help="Render spectrogram to file.")
     render_parser.add_argument("sdr_db_file_path", type=validate_file_path, help="Path to the SDR DB file.")
+    render_parser.add_argument("--jobs", default=1, type=int, help="Number of worker processes used to render the spectrograms.")
+    render_parser.add_argument("--render-mode", default="mesh", choices=["mesh", "raster"],
+                               help="Render with pcolormesh and axes (mesh) or write the spectrogram image directly (raster).")
+    render_parser.add_argument("--incremental", action="store_true",
+                               help="Only render the captures that are new or changed, or were rendered with other parameters.")
+
+    # 'render_queue' command
+    queue_parser = subparsers.add_parser("render_queue", help="Render the spectrograms through a work queue shared by every host and process that runs it on the directory.")
+    queue_parser.add_argument("sdr_db_file_path", type=validate_file_path, help="Path to the SDR DB file.")
+    queue_parser.add_argument("--jobs", default=1, type=int, help="Number of worker processes on this host.")
+    queue_parser.add_argument("--render-mode", default="mesh", choices=["mesh", "raster"],
+                              help="Render with pcolormesh and axes (mesh) or write the spectrogram image directly (raster).")
+    queue_parser.add_argument("--lease-seconds", default=WORK_QUEUE_LEASE_SECONDS, type=float,
+                              help="Time after which the capture of a worker that stopped is given to another worker.")
+
+    # 'build_spectrogram_pyramid' command
+    pyramid_parser = subparsers.add_parser("build_spectrogram_pyramid", help="Build the multi-resolution spectrogram pyramids used by get_view.")
+    pyramid_parser.add_argument("sdr_db_file_path", type=validate_file_path, help="Path to the SDR DB file.")
+    pyramid_parser.add_argument("--force", action="store_true", help="Rebuild pyramids that are up to date.")
+
+    # 'convert_captures' command
+    convert_parser = subparsers.add_parser("convert_captures", help="Convert the complex captures to the compact quantized format in place.")
+    convert_parser.add_argument("sdr_db_file_path", type=validate_file_path, help="Path to the SDR DB file.")
+    convert_parser.add_argument("--dtype", default="int8", choices=list(QUANTIZED_DTYPES), help="Integer type of the interleaved IQ samples.")
+    convert_parser.add_argument("--block-size", default=QUANTIZED_BLOCK_SIZE, type=int, help="Number of samples that share one scale factor.")
+
+    # 'detect_events' command
+    detect_parser = subparsers.add_parser("detect_events", help="Detect signal events in the captures and store them in the catalog.")
+    detect_parser.add_argument("sdr_db_file_path", type=validate_file_path, help="Path to the SDR DB file.")
+    detect_parser.add_argument("--threshold-db", default=DETECT_THRESHOLD_DB, type=float, help="Detection threshold above the noise floor in dB.")
+    detect_parser.add_argument("--force", action="store_true", help="Detect events again in captures that were already processed.")
+
+    stats_parser = subparsers.add_parser("capture_statistics", help="Add the statistics of new or changed captures to the statistics table of the DB.")
+    stats_parser.add_argument("sdr_db_file_path", type=validate_file_path, help="Path to the SDR DB file.")
+    stats_parser.add_argument("--threshold-db", default=DETECT_THRESHOLD_DB, type=float, help="Occupancy threshold above the noise floor in dB.")
+    stats_parser.add_argument("--force", action="store_true", help="Compute the statistics of every capture again.")
+    stats_parser.add_argument("--parquet", action="store_true", help="Also write the tables as Parquet files (needs pandas and pyarrow).")
 
     # Parse arguments
     args = parser.parse_args()
@@ -239,14 +2893,44 @@ def main():
         return
 
     setup_logging(args)
+    set_analysis_precision(args.precision, args.fft_workers)
+    set_spectrogram_cache(SpectrogramCache(args.cache_dir, max_bytes=args.cache_max_bytes) if args.cache else None)
+
+    if args.profile or args.profile_file is not None:
+        metrics = PipelineMetrics(jsonl_file_name=args.profile_file)
+        set_metrics(metrics)
+    else:
+        metrics = None
 
     if args.command == "render_spectrogram_to_file":
+        # every capture is rendered unless --incremental is given, and the manifest is updated either way
+        rendered = sdr_render_db(args.sdr_db_file_path, workers=args.jobs, render_mode=args.render_mode, force=not args.incremental)
+        print(f"Rendered {len(rendered)} spectrograms in {args.sdr_db_file_path}")
+        if SPECTROGRAM_CACHE is not None:
+            print(f"Spectrogram cache: {SPECTROGRAM_CACHE.stats()}")
+    elif args.command == "render_queue":
+        stats = sdr_render_queue(args.sdr_db_file_path, workers=args.jobs, render_mode=args.render_mode, lease_seconds=args.lease_seconds)
+        print(f"Work queue in {args.sdr_db_file_path}: {stats}")
+    elif args.command == "build_spectrogram_pyramid":
         sdr_db = sdr_load_db(file_path=args.sdr_db_file_path)
-        print(f"Loaded {len(sdr_db)} records from {new_file_path}")
-        render_spectrogram_to_file(sdr_db, new_file_path=args.sdr_db_file_path)
+        print(f"Loaded {len(sdr_db)} records from {args.sdr_db_file_path}")
+        for params in sdr_db:
+            print(f"Built {build_spectrogram_pyramid(params, new_file_path=args.sdr_db_file_path, force=args.force)}")
+    elif args.command == "convert_captures":
+        (converted, bytes_before, bytes_after) = sdr_convert_db(args.sdr_db_file_path, dtype=args.dtype, block_size=args.block_size)
+        print(f"Converted {converted} captures from {bytes_before} to {bytes_after} bytes")
+    elif args.command == "detect_events":
+        processed = sdr_detect_db(args.sdr_db_file_path, threshold_db=args.threshold_db, force=args.force)
+        print(f"Detected events in {processed} captures in {args.sdr_db_file_path}")
+    elif args.command == "capture_statistics":
+        computed = sdr_stats_db(args.sdr_db_file_path, threshold_db=args.threshold_db, force=args.force, parquet=args.parquet)
+        print(f"Computed the statistics of {computed} captures in {args.sdr_db_file_path}")
     else:
         parser.print_help()
 
+    if metrics is not None:
+        metrics.print_summary()
+
 # def main():
     
 #     # set the sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type
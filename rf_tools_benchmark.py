@@ -0,0 +1,348 @@
+import datetime
+import json
+import os
+import sys
+import time
+import shutil
+import subprocess
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from pathlib import Path
+
+import argparse
+import logging
+
+import numpy as np
+
+import rf_tools
+
+
+# Benchmark suites. Each suite lists the number of records for the sdr_load_db benchmarks and the synthetic captures as tuples
+# of (sample_rate, duration in seconds, cases to run on the capture). The mesh render is only run on the shorter captures
+# because pcolormesh of a long capture takes far longer than the other cases. compute_spectrogram_db_single is the single
+# precision STFT with an FFT thread per core and spectrogram_precision reports the difference between the single and double
+# precision spectrograms instead of a time. The startup cases time a new python process that imports rf_tools or runs
+# rf_tools.py --help. The sweeps are directories of many short captures as tuples of (sample_rate, duration in seconds, number of
+# captures); spectrogram_loop computes their spectrograms one capture at a time and spectrogram_batch with sdr_batch_spectrogram_db.
+# The other cases run with the spectrogram cache turned off. render_mesh_cached and render_raster_cached render with a spectrogram
+# cache in an empty directory, once with the cache cold and once after a first render has filled it, and report the size of the
+# cache, so a render that writes large entries or gets slower with the cache on shows up in the results.
+BENCHMARK_SUITES = {
+    'quick': {'db_sizes': [10, 1000],
+              'startup': ['import_rf_tools', 'rf_tools_help'],
+              'sweeps': [(1_024_000, 0.005, 200)],
+              'captures': [(1_024_000, 1, ['load_capture_file', 'compute_spectrogram_db', 'compute_spectrogram_db_single', 'spectrogram_precision', 'render_mesh', 'render_raster', 'render_mesh_cached', 'render_raster_cached']),
+                           (1_024_000, 10, ['load_capture_file', 'compute_spectrogram_db', 'compute_spectrogram_db_single', 'render_raster'])]},
+    'full': {'db_sizes': [10, 1000, 10000],
+             'startup': ['import_rf_tools', 'rf_tools_help'],
+             'sweeps': [(1_024_000, 0.001, 1000), (1_024_000, 0.005, 1000), (2_400_000, 0.01, 200)],
+             'captures': [(1_024_000, 1, ['load_capture_file', 'compute_spectrogram_db', 'compute_spectrogram_db_single', 'spectrogram_precision', 'render_mesh', 'render_raster', 'render_mesh_cached', 'render_raster_cached']),
+                          (1_024_000, 60, ['load_capture_file', 'compute_spectrogram_db', 'compute_spectrogram_db_single', 'spectrogram_precision', 'render_mesh', 'render_raster', 'render_mesh_cached', 'render_raster_cached']),
+                          (1_024_000, 600, ['compute_spectrogram_db', 'compute_spectrogram_db_single', 'render_raster']),
+                          (2_400_000, 1, ['load_capture_file', 'compute_spectrogram_db', 'compute_spectrogram_db_single', 'render_mesh', 'render_raster']),
+                          (2_400_000, 60, ['load_capture_file', 'compute_spectrogram_db', 'compute_spectrogram_db_single', 'render_raster']),
+                          (10_000_000, 1, ['load_capture_file', 'compute_spectrogram_db', 'compute_spectrogram_db_single', 'render_mesh', 'render_raster']),
+                          (10_000_000, 10, ['load_capture_file', 'compute_spectrogram_db', 'compute_spectrogram_db_single', 'spectrogram_precision', 'render_raster'])]},
+}
+
+# A result is a regression when its time or memory is more than this fraction above the baseline. Times are only compared when
+# the baseline is at least BENCHMARK_MIN_SECONDS because shorter times are dominated by noise.
+BENCHMARK_TOLERANCE = 0.2
+BENCHMARK_MIN_SECONDS = 0.05
+
+# Cases that time the startup of a new python process
+BENCHMARK_STARTUP_CASES = ('import_rf_tools', 'rf_tools_help')
+
+# Modules that importing rf_tools should not load. They are imported by the functions that need them.
+IMPORT_HEAVY_MODULES = ('matplotlib', 'matplotlib.pyplot', 'scipy.signal', 'scipy.ndimage', 'scipy.fft', 'gnuradio')
+
+# Number of samples generated at a time when writing a synthetic capture
+SYNTHETIC_CHUNK_SIZE = 1_048_576
+
+
+def log_and_raise(msg, exception_type=ValueError):
+    logging.error(msg)
+    raise exception_type(msg)
+
+
+# This function writes a synthetic capture of duration seconds at sample_rate to file_path along with its json sidecar, in the
+# same form as sdr_get_samples. The capture is complex gaussian noise plus a continuous tone and a burst of a second tone every
+# second. It is generated SYNTHETIC_CHUNK_SIZE samples at a time into a memory mapped .npy file so captures of many minutes can
+# be written without holding them in memory. The function returns the dictionary that was saved to the json file.
+def write_synthetic_capture(file_path, sample_rate, duration, center_freq_Hz=100_000_000, dtype=np.complex128, seed=0, capture_time=None):
+    if capture_time is None:
+        capture_time = datetime.datetime.now()
+    file_name = 'sdr_synthetic_' + str(duration) + 's_fc_' + str(center_freq_Hz) + '_fs_' + str(sample_rate) + '_' + capture_time.strftime("%Y%m%d_%H%M%S") + '.npy'
+    full_file_name = os.path.join(file_path, file_name)
+
+    sample_count = int(duration*sample_rate)
+    x = np.lib.format.open_memmap(full_file_name, mode='w+', dtype=dtype, shape=(sample_count,))
+    rng = np.random.default_rng(seed)
+    tone_Hz = sample_rate / 10
+    burst_Hz = -sample_rate / 5
+    for start in range(0, sample_count, SYNTHETIC_CHUNK_SIZE):
+        n = np.arange(start, min(start + SYNTHETIC_CHUNK_SIZE, sample_count))
+        t = n / sample_rate
+        chunk = 0.01*(rng.standard_normal(len(n)) + 1j*rng.standard_normal(len(n)))
+        chunk += 0.1*np.exp(2j*np.pi*tone_Hz*t)
+        # a 100 ms burst at the start of every second
+        chunk += np.where(t % 1 < 0.1, 0.5*np.exp(2j*np.pi*burst_Hz*t), 0)
+        x[start:start + len(n)] = chunk
+    x.flush()
+    del x
+
+    json_dict = {'sample_rate': sample_rate, 'center_freq_Hz': center_freq_Hz, 'time_to_collect_sec': duration, 'sdr_type': 'synthetic',
+                 'file_path': str(file_path), 'file_name': file_name, 'full_file_name': full_file_name,
+                 'dtype': np.dtype(dtype).name, 'layout': 'complex', 'scale': 1.0}
+    with open(full_file_name.replace('.npy', '.json'), 'w') as fp:
+        json.dump(json_dict, fp)
+    return json_dict
+
+
+# This function writes record_count json sidecars to file_path for the sdr_load_db benchmarks. The capture files are not written.
+def write_synthetic_db(file_path, record_count, sample_rate=1_024_000):
+    os.makedirs(file_path, exist_ok=True)
+    start_time = datetime.datetime(2024, 1, 1)
+    for i in range(record_count):
+        center_freq_Hz = 80_000_000 + (i % 400) * 100_000
+        file_name = 'sdr_synthetic_fc_' + str(center_freq_Hz) + '_fs_' + str(sample_rate) + '_' + (start_time + datetime.timedelta(minutes=i)).strftime("%Y%m%d_%H%M%S") + '.npy'
+        json_dict = {'sample_rate': sample_rate, 'center_freq_Hz': center_freq_Hz, 'time_to_collect_sec': 10, 'sdr_type': 'synthetic',
+                     'file_path': str(file_path), 'file_name': file_name, 'full_file_name': os.path.join(file_path, file_name)}
+        with open(os.path.join(file_path, file_name.replace('.npy', '.json')), 'w') as fp:
+            json.dump(json_dict, fp)
+
+
+# This function compares the single precision spectrogram of the capture of the record with the double precision spectrogram one
+# block at a time and returns the largest and mean absolute difference in dB. Cells that are -inf in both are skipped.
+def compare_spectrogram_precision(record):
+    (x, _) = rf_tools.load_capture_file(record, mmap_mode='r')
+    sample_rate = record['sample_rate']
+    double_blocks = rf_tools.stft_db_stream(rf_tools.iter_capture_chunks(x), sample_rate, precision='double')
+    single_blocks = rf_tools.stft_db_stream(rf_tools.iter_capture_chunks(x), sample_rate, precision='single')
+    max_abs_db = 0.0
+    sum_abs_db = 0.0
+    count = 0
+    for ((_, double_db), (_, single_db)) in zip(double_blocks, single_blocks):
+        finite = np.isfinite(double_db) | np.isfinite(single_db)
+        difference = np.abs(double_db[finite] - single_db[finite].astype(np.float64))
+        if len(difference) > 0:
+            max_abs_db = max(max_abs_db, float(difference.max()))
+            sum_abs_db += float(difference.sum())
+            count += len(difference)
+    return {'max_abs_db': max_abs_db, 'mean_abs_db': sum_abs_db / count if count > 0 else 0.0, 'cells': count}
+
+
+# This function runs one benchmark case in the current process and returns its measurements. It is run in a new process for each
+# case so the peak resident memory of the case is not hidden by the cases run before it.
+def run_case(case):
+    (name, function_name, args) = case
+    logging.basicConfig(level=logging.WARNING)
+    # the spectrogram cache is turned off so each case computes its spectrogram, except for the cached cases which use a cache
+    # in an empty directory that is removed after the case
+    cache_path = None
+    if function_name.endswith('_cached'):
+        cache_path = tempfile.mkdtemp(prefix='rf_tools_cache_')
+        rf_tools.set_spectrogram_cache(rf_tools.SpectrogramCache(cache_path=cache_path))
+    else:
+        rf_tools.set_spectrogram_cache(None)
+    if function_name.startswith('render'):
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot
+    # rf_tools imports scipy on first use, which the startup cases measure, so it is imported before the other cases are timed
+    if function_name not in BENCHMARK_STARTUP_CASES:
+        import scipy.fft
+        import scipy.ndimage
+        import scipy.signal
+
+    def run():
+        if function_name == 'sdr_load_db':
+            return len(rf_tools.sdr_load_db(args['file_path']))
+        elif function_name == 'sdr_scan_db':
+            return len(rf_tools.sdr_scan_db(args['file_path']))
+        elif function_name == 'load_capture_file':
+            (x, _) = rf_tools.load_capture_file(args['record'])
+            return len(x)
+        elif function_name == 'compute_spectrogram_db':
+            (x, _) = rf_tools.load_capture_file(args['record'], mmap_mode='r')
+            return rf_tools.compute_spectrogram_db(x, args['record']['sample_rate'])[2].shape[1]
+        elif function_name == 'compute_spectrogram_db_single':
+            (x, _) = rf_tools.load_capture_file(args['record'], mmap_mode='r')
+            return rf_tools.compute_spectrogram_db(x, args['record']['sample_rate'], precision='single', workers=-1)[2].shape[1]
+        elif function_name == 'spectrogram_precision':
+            return compare_spectrogram_precision(args['record'])
+        elif function_name == 'render_mesh':
+            return len(rf_tools.render_spectrogram_to_file([args['record']], render_mode='mesh'))
+        elif function_name == 'render_raster':
+            return len(rf_tools.render_spectrogram_to_file([args['record']], render_mode='raster'))
+        elif function_name in ('render_mesh_cached', 'render_raster_cached'):
+            render_mode = function_name[len('render_'):-len('_cached')]
+            cache = rf_tools.get_spectrogram_cache()
+            counts = cache.counts()
+            rf_tools.render_spectrogram_to_file([args['record']], render_mode=render_mode)
+            return dict({name: count - counts[name] for (name, count) in cache.counts().items()}, cache=args['cache'], cache_bytes=cache.stats()['bytes'])
+        elif function_name == 'spectrogram_loop':
+            for record in args['records']:
+                (x, _) = rf_tools.load_capture_file(record, mmap_mode='r')
+                rf_tools.compute_spectrogram_db(x, record['sample_rate'])
+            return len(args['records'])
+        elif function_name == 'spectrogram_batch':
+            return sum(1 for _ in rf_tools.sdr_batch_spectrogram_db(args['records']))
+        elif function_name == 'import_rf_tools':
+            # the new process reports which of IMPORT_HEAVY_MODULES the import loaded
+            code = f'import sys, json, rf_tools; print(json.dumps([name for name in {IMPORT_HEAVY_MODULES!r} if name in sys.modules]))'
+            completed = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(rf_tools.__file__), capture_output=True, text=True, check=True)
+            return {'heavy_modules': json.loads(completed.stdout)}
+        elif function_name == 'rf_tools_help':
+            subprocess.run([sys.executable, rf_tools.__file__, '--help'], capture_output=True, check=True)
+            return 0
+        log_and_raise(f'Unknown benchmark function {function_name}')
+
+    try:
+        # the warm cached cases fill the cache with a first render that is not timed
+        if cache_path is not None and args['cache'] == 'warm':
+            run()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = run()
+        cpu_seconds = time.process_time() - cpu_start
+        wall_seconds = time.perf_counter() - wall_start
+        (_, peak_traced_bytes) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        if cache_path is not None:
+            shutil.rmtree(cache_path, ignore_errors=True)
+    # ru_maxrss is in kilobytes on Linux
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {'name': name, 'function': function_name, 'seconds': wall_seconds, 'cpu_seconds': cpu_seconds,
+            'peak_traced_bytes': peak_traced_bytes, 'max_rss_bytes': rss_after*1024, 'rss_growth_bytes': (rss_after - rss_before)*1024,
+            'result': result, 'parameters': {key: value for (key, value) in args.items() if key not in ('record', 'records')}}
+
+
+# This function generates the synthetic data of a suite in work_dir and returns the list of cases to run as tuples of
+# (name, function name, arguments)
+def prepare_suite(suite, work_dir):
+    if suite not in BENCHMARK_SUITES:
+        log_and_raise(f'The suite {suite} is not one of {list(BENCHMARK_SUITES)}')
+
+    cases = []
+    for function_name in BENCHMARK_SUITES[suite]['startup']:
+        cases.append((function_name, function_name, {}))
+
+    for (sample_rate, duration, capture_count) in BENCHMARK_SUITES[suite]['sweeps']:
+        sweep_path = os.path.join(work_dir, f'sweep_{sample_rate}_{duration}_{capture_count}')
+        os.makedirs(sweep_path, exist_ok=True)
+        print(f"Writing a sweep of {capture_count} synthetic captures of {duration} s at {sample_rate} samples per second")
+        # the steps of the sweep have different center frequencies, which also gives each capture its own file name
+        records = [write_synthetic_capture(sweep_path, sample_rate, duration, center_freq_Hz=100_000_000 + index*sample_rate//2, seed=index)
+                   for index in range(capture_count)]
+        for function_name in ('spectrogram_loop', 'spectrogram_batch'):
+            cases.append((f'{function_name}[fs={sample_rate},seconds={duration},captures={capture_count}]', function_name,
+                          {'records': records, 'sample_rate': sample_rate, 'duration': duration, 'capture_count': capture_count}))
+
+    for record_count in BENCHMARK_SUITES[suite]['db_sizes']:
+        db_path = os.path.join(work_dir, f'db_{record_count}')
+        write_synthetic_db(db_path, record_count)
+        arguments = {'file_path': db_path, 'record_count': record_count}
+        cases.append((f'sdr_scan_db[records={record_count}]', 'sdr_scan_db', arguments))
+        # the first call builds the catalog and the second only checks it is up to date
+        cases.append((f'sdr_load_db[records={record_count},cold]', 'sdr_load_db', arguments))
+        cases.append((f'sdr_load_db[records={record_count},warm]', 'sdr_load_db', arguments))
+
+    capture_path = os.path.join(work_dir, 'captures')
+    os.makedirs(capture_path, exist_ok=True)
+    for (sample_rate, duration, functions) in BENCHMARK_SUITES[suite]['captures']:
+        print(f"Writing a synthetic capture of {duration} s at {sample_rate} samples per second")
+        record = write_synthetic_capture(capture_path, sample_rate, duration)
+        for function_name in functions:
+            if function_name.endswith('_cached'):
+                for cache in ('cold', 'warm'):
+                    cases.append((f'{function_name}[fs={sample_rate},seconds={duration},cache={cache}]', function_name,
+                                  {'record': record, 'sample_rate': sample_rate, 'duration': duration, 'cache': cache}))
+            else:
+                cases.append((f'{function_name}[fs={sample_rate},seconds={duration}]', function_name,
+                              {'record': record, 'sample_rate': sample_rate, 'duration': duration}))
+    return cases
+
+
+# This function runs the benchmark suite and returns the results as a dictionary that can be saved as json. The synthetic data
+# is written to work_dir, or a temporary directory that is removed afterwards if work_dir is None.
+def run_benchmarks(suite='quick', work_dir=None):
+    remove_work_dir = work_dir is None
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='rf_tools_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        # the synthetic data is written by another process so the memory it uses is not inherited by the benchmark processes
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(1) as pool:
+            cases = pool.apply(prepare_suite, (suite, work_dir))
+        results = []
+        for case in cases:
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (case,))
+            print(f"{result['name']:55s} {result['seconds']:9.3f} s {result['max_rss_bytes']/2**20:9.1f} MB RSS {result['peak_traced_bytes']/2**20:9.1f} MB traced")
+            if isinstance(result['result'], dict):
+                print(f"{'':55s} {result['result']}")
+            results.append(result)
+    finally:
+        if remove_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {'suite': suite, 'timestamp': datetime.datetime.now().isoformat(), 'python': sys.version.split()[0], 'numpy': np.__version__,
+            'results': results}
+
+
+# This function compares the results with the baseline results and returns a list of the regressions. A result is a regression
+# when its seconds, max_rss_bytes or peak_traced_bytes is more than tolerance above the same result in the baseline. seconds are
+# only compared when the baseline is at least BENCHMARK_MIN_SECONDS.
+def compare_benchmarks(results, baseline, tolerance=BENCHMARK_TOLERANCE):
+    baseline_results = {result['name']: result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        if result['name'] not in baseline_results:
+            continue
+        for metric in ('seconds', 'max_rss_bytes', 'peak_traced_bytes'):
+            base = baseline_results[result['name']][metric]
+            if metric == 'seconds' and base < BENCHMARK_MIN_SECONDS:
+                continue
+            ratio = result[metric] / base if base > 0 else 1.0
+            print(f"{result['name']:55s} {metric:18s} {ratio:6.2f}x baseline")
+            if ratio > 1 + tolerance:
+                regressions.append({'name': result['name'], 'metric': metric, 'baseline': base, 'value': result[metric], 'ratio': ratio})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of rf_tools with synthetic captures.")
+    parser.add_argument("--suite", default="quick", choices=list(BENCHMARK_SUITES), help="Benchmark suite to run.")
+    parser.add_argument("--output", default=Path("benchmark_results.json"), type=Path, help="Path to the json file the results are saved to.")
+    parser.add_argument("--baseline", default=None, type=Path, help="Path to the json results to compare against.")
+    parser.add_argument("--tolerance", default=BENCHMARK_TOLERANCE, type=float, help="Allowed fraction above the baseline before a result is a regression.")
+    parser.add_argument("--work-dir", default=None, type=Path, help="Directory for the synthetic data. A temporary directory is used if not given.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(suite=args.suite, work_dir=args.work_dir)
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print(f"Saved the results to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        regressions = compare_benchmarks(results, baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['name']} {regression['metric']} {regression['ratio']:.2f}x baseline")
+        if regressions:
+            sys.exit(1)
+
+
+# test to see if running as a standalone script and not imported then run main()
+if __name__ == '__main__':
+    main()
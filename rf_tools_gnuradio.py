@@ -1,18 +1,16 @@
 import os
+import queue
+import threading
 import numpy as np
 from pathlib import Path
 import logging
 import datetime
-import json
+import functools
 
+import rf_tools
 
-from gnuradio.filter import firdes
-from gnuradio import gr
-from gnuradio import blocks
-from gnuradio.fft import window
-from gnuradio.eng_arg import eng_float, intx
-from gnuradio import eng_notation
-from gnuradio import soapy
+# GNU Radio and soapy are imported inside the functions that build flowgraphs, so the helper functions and constants of this
+# module can be used without loading them.
 
 
 def log_and_raise(msg, exception_type=ValueError):
@@ -23,10 +21,25 @@ def log_and_raise(msg, exception_type=ValueError):
 # https://joshisanerd.com/projects/sdr_snippets/gnuradio_and_ipython//0%20First%20Attempt.html
 
 
-def sdr_rtlsdr_get_samples(sample_rate = 1024000, center_freq_Hz = 100e6, time_to_collect_sec = 10):
-    tb = gr.top_block()
-    N = int(time_to_collect_sec*sample_rate)
-    
+# Sample formats that can be written to disk by sdr_capture_to_file. The value is the tuple (numpy dtype, layout, scale) that is
+# recorded in the json sidecar. complex64 is the fc32 stream from the source. int8 is interleaved 8 bit IQ, the native format of
+# the RTL-SDR, where the complex value is scale*(I + jQ).
+SAMPLE_FORMATS = {'complex64': ('complex64', 'complex', 1.0),
+                  'int8': ('int8', 'interleaved_iq', 1/127)}
+
+
+# This function checks that sdr_type is an SDR the capture functions can open. Only the RTL-SDR is supported so far, so the
+# captures are never labelled with an SDR that did not make them.
+def check_sdr_type(sdr_type):
+    if sdr_type == 'hackrf':
+        log_and_raise(f'The sdr_type {sdr_type} is not supported yet')
+    elif sdr_type != 'rtlsdr':
+        log_and_raise(f'The sdr_type {sdr_type} is not "rtlsdr" or "hackrf"')
+
+
+# This function creates the soapy source block for an RTL-SDR tuned to center_freq_Hz
+def sdr_rtlsdr_source(sample_rate = 1024000, center_freq_Hz = 100e6):
+    from gnuradio import soapy
     stream_args = ''
     tune_args = ['']
     settings = ['']
@@ -39,7 +52,48 @@ def sdr_rtlsdr_get_samples(sample_rate = 1024000, center_freq_Hz = 100e6, time_t
     soapy_rtlsdr_source_0.set_frequency(0, center_freq_Hz)
     soapy_rtlsdr_source_0.set_frequency_correction(0, 0)
     soapy_rtlsdr_source_0.set_gain(0, 'TUNER', 20)
+    return soapy_rtlsdr_source_0
+
+
+# This function creates a simulated source of a complex tone at tone_Hz plus complex gaussian noise. It can be passed as the
+# source to sdr_get_samples and the other capture functions to test them without an SDR attached.
+# If throttle is True the samples are produced at sample_rate like a real SDR, which is needed to benchmark sweeps.
+def sdr_signal_source(sample_rate = 1024000, tone_Hz = 100e3, amplitude = 0.5, noise_amplitude = 0.1, throttle = False):
+    from gnuradio import gr, blocks, analog
+    hier = gr.hier_block2('sdr_signal_source', gr.io_signature(0, 0, 0), gr.io_signature(1, 1, gr.sizeof_gr_complex))
+    tone = analog.sig_source_c(sample_rate, analog.GR_COS_WAVE, tone_Hz, amplitude, 0)
+    noise = analog.noise_source_c(analog.GR_GAUSSIAN, noise_amplitude, 0)
+    adder = blocks.add_cc()
+    hier.connect(tone, (adder, 0))
+    hier.connect(noise, (adder, 1))
+    if throttle:
+        hier.connect(adder, blocks.throttle(gr.sizeof_gr_complex, sample_rate), hier)
+    else:
+        hier.connect(adder, hier)
+    return hier
+
+
+# This function creates a source that plays back the samples in a complex64 .npy capture file or a raw fc32 file. It can be
+# passed as the source to sdr_get_samples and the other capture functions. If repeat is True the file is played in a loop.
+def sdr_file_source(file_name, repeat = False):
+    from gnuradio import gr, blocks
+    file_name = str(file_name)
+    offset = 0
+    if file_name.endswith('.npy'):
+        x = np.load(file_name, mmap_mode='r')
+        if x.dtype != np.complex64:
+            log_and_raise(f'The file {file_name} must be complex64 to be used as a source, not {x.dtype}')
+        offset = x.offset // gr.sizeof_gr_complex
+    return blocks.file_source(gr.sizeof_gr_complex, file_name, repeat, offset, 0)
+
+
+def sdr_rtlsdr_get_samples(sample_rate = 1024000, center_freq_Hz = 100e6, time_to_collect_sec = 10, source = None):
+    from gnuradio import gr, blocks
+    tb = gr.top_block()
+    N = int(time_to_collect_sec*sample_rate)
     
+    if source is None:
+        source = sdr_rtlsdr_source(sample_rate = sample_rate, center_freq_Hz = center_freq_Hz)
     
     # Let's try to flush out the first bunch of samples
     skip_head = blocks.skiphead(gr.sizeof_gr_complex, 1)
@@ -51,12 +105,67 @@ def sdr_rtlsdr_get_samples(sample_rate = 1024000, center_freq_Hz = 100e6, time_t
     sink = blocks.vector_sink_c()
     
     
-    tb.connect(soapy_rtlsdr_source_0, skip_head, head, sink) # Can use the handy serial connect method here
+    tb.connect(source, skip_head, head, sink) # Can use the handy serial connect method here
     tb.run()
     tb.stop()
     x = np.array(sink.data())
     return x
 
+
+# This function streams the samples from the source straight to full_file_name without collecting them in memory. The file is a
+# .npy file in the sample_format (see SAMPLE_FORMATS), written by a gnuradio file sink after the .npy header. The complex64
+# format is the fc32 stream of the source, which is 1/2 the size of the complex128 arrays written by sdr_get_samples and never
+# goes through a Python list. If source is None the RTL-SDR is used.
+# The function returns the number of samples written.
+def sdr_capture_to_file(full_file_name, sample_rate = 1024000, center_freq_Hz = 100e6, time_to_collect_sec = 10, sample_format = 'complex64', source = None):
+    from gnuradio import gr, blocks
+    if sample_format not in SAMPLE_FORMATS:
+        log_and_raise(f'The sample_format {sample_format} is not one of {list(SAMPLE_FORMATS)}')
+    
+    N = int(time_to_collect_sec*sample_rate)
+    (dtype, layout, scale) = SAMPLE_FORMATS[sample_format]
+    shape = (N,) if layout == 'complex' else (N, 2)
+    
+    with open(full_file_name, 'wb') as fp:
+        rf_tools.write_npy_header(fp, dtype, shape)
+        header_length = fp.tell()
+    
+    tb = gr.top_block()
+    if source is None:
+        source = sdr_rtlsdr_source(sample_rate = sample_rate, center_freq_Hz = center_freq_Hz)
+    
+    skip_head = blocks.skiphead(gr.sizeof_gr_complex, 1)
+    head = blocks.head(gr.sizeof_gr_complex, N)
+    tb.connect(source, skip_head, head)
+    
+    if layout == 'complex':
+        sink = blocks.file_sink(gr.sizeof_gr_complex, str(full_file_name), True)
+        tb.connect(head, sink)
+    else:
+        # convert to interleaved I and Q chars scaled so +/-1.0 maps to +/-127
+        to_char = blocks.complex_to_interleaved_char(False, 1/scale)
+        sink = blocks.file_sink(gr.sizeof_char, str(full_file_name), True)
+        tb.connect(head, to_char, sink)
+    sink.set_unbuffered(False)
+    
+    tb.run()
+    tb.stop()
+    sink.close()
+    
+    # a file source can end before N samples so fix the header to match the samples that were written
+    sample_count = (os.path.getsize(full_file_name) - header_length) // np.dtype(dtype).itemsize // (1 if layout == 'complex' else 2)
+    if sample_count != N:
+        logging.warning(f'Only {sample_count} of {N} samples were written to {full_file_name}')
+        shape = (sample_count,) if layout == 'complex' else (sample_count, 2)
+        header = rf_tools.npy_header(dtype, shape)
+        if len(header) != header_length:
+            log_and_raise(f'Unable to fix the header of {full_file_name}', exception_type=IOError)
+        with open(full_file_name, 'r+b') as fp:
+            fp.write(header)
+    
+    logging.info(f'Streamed {sample_count} samples to {full_file_name}')
+    return sample_count
+
 # Write a function that takes as input:
 # sample_rate: which is a number
 # center_freq_Hz: which is a positive number representing the frequency the sdr should be at
@@ -76,8 +185,16 @@ def sdr_rtlsdr_get_samples(sample_rate = 1024000, center_freq_Hz = 100e6, time_t
 # file_path
 # and the values should be the values of the variables.
 # If there is an error, the function should return None.
+# The json file also records the dtype and layout of the samples in the file (see SAMPLE_FORMATS).
+# If stream_to_disk is True the samples are streamed straight to the file by sdr_capture_to_file in the sample_format
+# 'complex64' or 'int8' instead of being collected in memory first. In this case file_path must not be None and the x that is
+# returned is a read only memory map of the samples in the file. For 'int8' it is an rf_tools.QuantizedCapture over the memory map,
+# so the samples are complex64 whatever the sample_format.
+# If stream_to_disk is False the sample_format can be 'int8' or 'int16' to save the samples in the compact quantized format of
+# rf_tools.save_quantized_capture, interleaved integer IQ with a scale factor for each block that is recorded in the json file.
+# source is an optional gnuradio block to use instead of the SDR, such as sdr_signal_source or sdr_file_source.
 
-def sdr_get_samples(sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type='rtlsdr', file_path=None, create_directory = True):
+def sdr_get_samples(sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type='rtlsdr', file_path=None, create_directory = True, stream_to_disk = False, sample_format = 'complex64', source = None):
     # verify sample_rate is a number > 0
     if not isinstance(sample_rate, (int, float)):
        log_and_raise('The sample_rate is not a number')
@@ -110,6 +227,16 @@ def sdr_get_samples(sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type='
     # verify create_directory is a boolean
     if not isinstance(create_directory, bool):
         log_and_raise('The create_directory is not a boolean')
+    
+    # verify stream_to_disk is a boolean and there is a file to stream to
+    if not isinstance(stream_to_disk, bool):
+        log_and_raise('The stream_to_disk is not a boolean')
+    if stream_to_disk and file_path is None:
+        log_and_raise('The file_path must not be None when stream_to_disk is True')
+    if stream_to_disk and sample_format not in SAMPLE_FORMATS:
+        log_and_raise(f'The sample_format {sample_format} is not one of {list(SAMPLE_FORMATS)} when stream_to_disk is True')
+    if not stream_to_disk and sample_format != 'complex64' and sample_format not in rf_tools.QUANTIZED_DTYPES:
+        log_and_raise(f'The sample_format {sample_format} is not one of {["complex64"] + list(rf_tools.QUANTIZED_DTYPES)}')
                
 
     if file_path is not None:
@@ -127,29 +254,43 @@ def sdr_get_samples(sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type='
             log_and_raise(f'The file_path {file_path} is not a writable directory')
         
         
-    # collect the samples
-    if sdr_type == 'rtlsdr':
-        x=sdr_rtlsdr_get_samples(sample_rate = sample_rate, center_freq_Hz = center_freq_Hz, time_to_collect_sec = time_to_collect_sec)
-        if not isinstance(x, np.ndarray):
-            log_and_raise(f'x must be an np.ndarray')
-    elif sdr_type == 'hackrf':
-        log_and_raise(f'The sdr_type {sdr_type} is not supported yet')
-    else:
-        log_and_raise(f'The sdr_type {sdr_type} is not "rtlsdr" or "hackrf"')
+    check_sdr_type(sdr_type)
     
     if file_path is not None:
-        # save the numpy array x
-        file_name = 'sdr_' + sdr_type + '_fc_' + str(center_freq_Hz) + '_fs_' + str(sample_rate) + '_' + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + '.npy'
+        file_name = rf_tools.sdr_capture_file_name(sdr_type, center_freq_Hz, sample_rate)
         full_file_name = os.path.join(file_path, file_name)
-
-        np.save(full_file_name, x)
-        logging.info(f'Saved the numpy array to {full_file_name}')
+    
+    # collect the samples. The stages are measured when the rf_tools instrumentation is turned on
+    capture_name = full_file_name if file_path is not None else f'{sdr_type}_fc_{center_freq_Hz}'
+    with rf_tools.measure_stage('capture', capture_name) as stage:
+        if stream_to_disk:
+            sdr_capture_to_file(full_file_name, sample_rate = sample_rate, center_freq_Hz = center_freq_Hz, time_to_collect_sec = time_to_collect_sec, sample_format = sample_format, source = source)
+            x = np.load(full_file_name, mmap_mode='r')
+            (dtype, layout, scale) = SAMPLE_FORMATS[sample_format]
+            # interleaved integer IQ is returned as a complex view that decodes the samples that are sliced, as load_capture_file does
+            if layout == 'interleaved_iq':
+                x = rf_tools.QuantizedCapture(x, [scale], max(len(x), 1))
+            stage.add_bytes(written=os.path.getsize(full_file_name))
+        else:
+            x=sdr_rtlsdr_get_samples(sample_rate = sample_rate, center_freq_Hz = center_freq_Hz, time_to_collect_sec = time_to_collect_sec, source = source)
+            if not isinstance(x, np.ndarray):
+                log_and_raise(f'x must be an np.ndarray')
+            (dtype, layout, scale) = (str(x.dtype), 'complex', 1.0)
+    
+    extra = {}
+    if file_path is not None:
+        if not stream_to_disk:
+            # save the numpy array x, quantized to integer IQ with a scale for each block if sample_format is an integer type
+            with rf_tools.measure_stage('save', capture_name) as stage:
+                if sample_format in rf_tools.QUANTIZED_DTYPES:
+                    extra = {'block_size': rf_tools.QUANTIZED_BLOCK_SIZE, 'block_scales_file_name': rf_tools.save_quantized_capture(full_file_name, x, dtype=sample_format)}
+                    (dtype, layout, scale) = (sample_format, 'blockscaled_iq', 1.0)
+                else:
+                    np.save(full_file_name, x)
+                stage.add_bytes(written=os.path.getsize(full_file_name))
+            logging.info(f'Saved the numpy array to {full_file_name}')
         # save the json file
-        full_json_file_name = str(full_file_name).replace('.npy', '.json')
-        json_dict = {'sample_rate': sample_rate, 'center_freq_Hz': center_freq_Hz, 'time_to_collect_sec': time_to_collect_sec, 'sdr_type': sdr_type, 'file_path': str(file_path), 'file_name': str(file_name), 'full_file_name': str(full_file_name)}
-        with open(full_json_file_name, 'w') as fp:
-            json.dump(json_dict, fp)
-            logging.info(f'Saved the json file to {full_json_file_name}')
+        full_json_file_name = rf_tools.sdr_write_sidecar(full_file_name, sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type, dtype=dtype, layout=layout, scale=scale, **extra)
     else:
         full_file_name = None
         full_json_file_name = None
@@ -168,7 +309,12 @@ def sdr_get_samples(sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type='
 # The function will start a collect samples at freq_start_Hz and then increment the frequency by freq_step_Hz until freq_end_Hz is reached.
 # The function will save the samples to a file in the file_path directory.
 # The function will return a list of the full file names of the saved files.
-def sdr_sweep(sample_rate, time_to_collect_sec, sdr_type, freq_start_Hz, freq_end_Hz, freq_step_Hz, file_path=None, create_directory=False):
+# If persistent is True the sweep is run by sdr_sweep_persistent which keeps one flowgraph running and retunes it in place,
+# dropping settle_samples after each retune, instead of building a new flowgraph for each step. source and retune are passed
+# to sdr_sweep_persistent so the sweep can be run against a simulated source.
+# If reduce_spectra is True only averaged power spectra are stored, see sdr_sweep_spectra, which is called with nfft and keep_iq
+# and whose return value is returned instead of the list of file names.
+def sdr_sweep(sample_rate, time_to_collect_sec, sdr_type, freq_start_Hz, freq_end_Hz, freq_step_Hz, file_path=None, create_directory=False, persistent=False, settle_samples=None, source=None, retune=None, reduce_spectra=False, nfft=rf_tools.PSD_NFFT, keep_iq=None):
     # check of valid parameters
     # verify sample_rate is a number > 0
     if not isinstance(sample_rate, (int, float)):
@@ -222,6 +368,14 @@ def sdr_sweep(sample_rate, time_to_collect_sec, sdr_type, freq_start_Hz, freq_en
             else:
                 log_and_raise(f'The file_path {file_path} does not exist')
                 
+    if reduce_spectra:
+        return sdr_sweep_spectra(sample_rate, time_to_collect_sec, sdr_type, freq_start_Hz, freq_end_Hz, freq_step_Hz, file_path=file_path, persistent=persistent,
+                                 settle_samples=SWEEP_SETTLE_SAMPLES if settle_samples is None else settle_samples, source=source, retune=retune, nfft=nfft, keep_iq=keep_iq)
+    
+    if persistent:
+        return sdr_sweep_persistent(sample_rate, time_to_collect_sec, sdr_type, list(range(freq_start_Hz, freq_end_Hz, freq_step_Hz)), file_path=file_path,
+                                    settle_samples=SWEEP_SETTLE_SAMPLES if settle_samples is None else settle_samples, source=source, retune=retune)
+    
     # create a list of the full file names of the saved files
     full_file_names = []
     
@@ -236,6 +390,255 @@ def sdr_sweep(sample_rate, time_to_collect_sec, sdr_type, freq_start_Hz, freq_en
     return full_file_names
 
 
+# Number of samples that are dropped after each retune of a persistent sweep to let the tuner and the flowgraph buffers settle
+SWEEP_SETTLE_SAMPLES = 65536
+
+# Number of captured steps that can be waiting for the writer thread. Together with the step being captured and the step being
+# written this bounds the memory used by a persistent sweep to SWEEP_WRITE_QUEUE_SIZE + 2 step buffers.
+SWEEP_WRITE_QUEUE_SIZE = 2
+
+
+# A gnuradio sink block used by sdr_sweep_persistent. Samples are discarded until the block is armed with a buffer. It then
+# drops settle_samples samples and copies the following samples into the buffer until it is full, when it sets the done event.
+# The class is made by sweep_capture_sink_class the first time it is called, so GNU Radio is only imported when a sweep runs.
+@functools.lru_cache(maxsize=None)
+def sweep_capture_sink_class():
+    from gnuradio import gr
+
+    class sweep_capture_sink(gr.sync_block):
+        def __init__(self):
+            gr.sync_block.__init__(self, name='sweep_capture_sink', in_sig=[np.complex64], out_sig=None)
+            self.lock = threading.Lock()
+            self.done = threading.Event()
+            self.buffer = None
+            self.settle_samples = 0
+            self.count = 0
+
+        def arm(self, buffer, settle_samples):
+            with self.lock:
+                self.buffer = buffer
+                self.settle_samples = settle_samples
+                self.count = 0
+                self.done.clear()
+
+        def work(self, input_items, output_items):
+            samples = input_items[0]
+            with self.lock:
+                if self.buffer is not None:
+                    skip = min(self.settle_samples, len(samples))
+                    self.settle_samples -= skip
+                    take = min(len(samples) - skip, len(self.buffer) - self.count)
+                    self.buffer[self.count:self.count + take] = samples[skip:skip + take]
+                    self.count += take
+                    if self.count == len(self.buffer):
+                        self.buffer = None
+                        self.done.set()
+            return len(samples)
+
+    return sweep_capture_sink
+
+
+# This function saves one step of a sweep to a capture file and json sidecar in file_path, the same as sdr_get_samples, and
+# returns the full file name. It is run by the writer thread of sdr_sweep_persistent.
+def sdr_sweep_save_step(x, sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type, file_path):
+    full_file_name = os.path.join(file_path, rf_tools.sdr_capture_file_name(sdr_type, center_freq_Hz, sample_rate))
+    np.save(full_file_name, x)
+    logging.info(f'Saved the numpy array to {full_file_name}')
+    rf_tools.sdr_write_sidecar(full_file_name, sample_rate, center_freq_Hz, time_to_collect_sec, sdr_type, dtype=str(x.dtype))
+    return full_file_name
+
+
+# This function sweeps one running flowgraph across the frequencies in freq_list. After each retune settle_samples are dropped and
+# then time_to_collect_sec of samples are captured into a step buffer. Each full buffer is handed to a background writer thread
+# so the next step is captured while the previous one is written, which makes the cost of the sweep close to the sum of the
+# dwell times. The step buffers are reused so the memory does not grow with the number of steps.
+# source is an optional gnuradio block to use instead of the SDR, for example sdr_signal_source(throttle=True) to benchmark the
+# sweep without hardware. retune is a function called with the frequency of each step. It defaults to setting the frequency
+# of the soapy source, and does nothing when a source is given without a retune function.
+# handle_step is called by the writer thread as handle_step(x, center_freq_Hz) for each step and its return values are
+# returned as a list in the order of freq_list. It defaults to saving the step with sdr_sweep_save_step when file_path is
+# not None. x is only valid until handle_step returns.
+def sdr_sweep_persistent(sample_rate, time_to_collect_sec, sdr_type, freq_list, file_path=None, settle_samples=SWEEP_SETTLE_SAMPLES, source=None, retune=None, handle_step=None):
+    from gnuradio import gr
+    if not isinstance(settle_samples, int) or settle_samples < 0:
+        log_and_raise('The settle_samples is not an integer >= 0')
+    check_sdr_type(sdr_type)
+    if len(freq_list) == 0:
+        return []
+    
+    N = int(time_to_collect_sec*sample_rate)
+    
+    if source is None:
+        source = sdr_rtlsdr_source(sample_rate = sample_rate, center_freq_Hz = freq_list[0])
+        if retune is None:
+            retune = lambda freq_Hz: source.set_frequency(0, freq_Hz)
+    if retune is None:
+        retune = lambda freq_Hz: None
+    if handle_step is None:
+        if file_path is None:
+            handle_step = lambda x, freq_Hz: None
+        else:
+            handle_step = lambda x, freq_Hz: sdr_sweep_save_step(x, sample_rate, freq_Hz, time_to_collect_sec, sdr_type, file_path)
+    
+    free_buffers = queue.Queue()
+    for _ in range(SWEEP_WRITE_QUEUE_SIZE + 2):
+        free_buffers.put(np.empty(N, dtype=np.complex64))
+    write_queue = queue.Queue(maxsize=SWEEP_WRITE_QUEUE_SIZE)
+    results = [None]*len(freq_list)
+    errors = []
+    
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                return
+            (index, freq_Hz, x) = item
+            try:
+                if not errors:
+                    results[index] = handle_step(x, freq_Hz)
+            except Exception as e:
+                logging.error(f'Failed to handle the sweep step at {freq_Hz} Hz: {e}')
+                errors.append(e)
+            finally:
+                free_buffers.put(x)
+    
+    tb = gr.top_block()
+    sink = sweep_capture_sink_class()()
+    tb.connect(source, sink)
+    
+    writer_thread = threading.Thread(target=writer, name='sdr_sweep_writer', daemon=True)
+    writer_thread.start()
+    tb.start()
+    try:
+        for (index, freq_Hz) in enumerate(freq_list):
+            buffer = free_buffers.get()
+            if errors:
+                break
+            retune(freq_Hz)
+            sink.arm(buffer, settle_samples)
+            # wait for the step to be captured with a generous margin for a source that is slow to start
+            if not sink.done.wait(timeout=10 + 2*(N + settle_samples)/sample_rate):
+                log_and_raise(f'Timed out capturing the sweep step at {freq_Hz} Hz', exception_type=TimeoutError)
+            logging.debug(f'Captured the sweep step at {freq_Hz} Hz')
+            write_queue.put((index, freq_Hz, buffer))
+    finally:
+        tb.stop()
+        tb.wait()
+        write_queue.put(None)
+        writer_thread.join()
+    
+    if errors:
+        raise errors[0]
+    return results
+
+
+# This function sweeps from freq_start_Hz to freq_end_Hz in steps of freq_step_Hz and keeps only averaged power spectra instead of
+# the IQ of every step. Each step is reduced with rf_tools.spectral_reduce to its Welch PSD and max-hold spectrum as soon as it is
+# captured, and the steps are stitched into one panorama across the band with rf_tools.stitch_panorama.
+# keep_iq flags the steps whose IQ is also saved. It can be a list of step frequencies or a function called as
+# keep_iq(center_freq_Hz, frequencies, mean_psd, max_psd) that returns True to keep the IQ of the step.
+# If file_path is not None the panorama is saved to the .npz file
+# sdr_<sdr_type>_sweep_<freq_start_Hz>_<freq_end_Hz>_fs_<sample_rate>_YYYYMMDD_HHMMSS.npz
+# with the arrays frequencies_Hz, mean_psd and max_psd of the panorama, the per step spectra step_mean_psd and step_max_psd
+# and the sweep parameters.
+# The function returns the tuple (panorama_file_name, frequencies_Hz, mean_psd, max_psd, iq_file_names) where iq_file_names has
+# the file name of the saved IQ or None for each step.
+def sdr_sweep_spectra(sample_rate, time_to_collect_sec, sdr_type, freq_start_Hz, freq_end_Hz, freq_step_Hz, file_path=None, persistent=True, settle_samples=SWEEP_SETTLE_SAMPLES, source=None, retune=None, nfft=rf_tools.PSD_NFFT, keep_iq=None):
+    freq_list = list(range(freq_start_Hz, freq_end_Hz, freq_step_Hz))
+    if len(freq_list) == 0:
+        log_and_raise('The sweep has no steps')
+    if keep_iq is not None and not callable(keep_iq):
+        keep_iq_list = set(keep_iq)
+        keep_iq = lambda center_freq_Hz, frequencies, mean_psd, max_psd: center_freq_Hz in keep_iq_list
+    if keep_iq is not None and file_path is None:
+        log_and_raise('The file_path must not be None when keep_iq is used')
+    
+    def reduce_step(x, freq_Hz):
+        (frequencies, mean_psd, max_psd) = rf_tools.spectral_reduce(x, sample_rate, nfft=nfft)
+        iq_file_name = None
+        if keep_iq is not None and keep_iq(freq_Hz, frequencies, mean_psd, max_psd):
+            iq_file_name = sdr_sweep_save_step(x, sample_rate, freq_Hz, time_to_collect_sec, sdr_type, file_path)
+        return (frequencies, mean_psd, max_psd, iq_file_name)
+    
+    if persistent:
+        steps = sdr_sweep_persistent(sample_rate, time_to_collect_sec, sdr_type, freq_list, settle_samples=settle_samples, source=source, retune=retune, handle_step=reduce_step)
+    else:
+        steps = []
+        for freq_Hz in freq_list:
+            x = sdr_rtlsdr_get_samples(sample_rate = sample_rate, center_freq_Hz = freq_Hz, time_to_collect_sec = time_to_collect_sec, source = source)
+            steps.append(reduce_step(x.astype(np.complex64), freq_Hz))
+    
+    frequencies = steps[0][0]
+    step_spectra = np.stack([np.stack((mean_psd, max_psd)) for (_, mean_psd, max_psd, _) in steps])
+    (frequencies_Hz, (mean_psd, max_psd)) = rf_tools.stitch_panorama(freq_list, frequencies, step_spectra, freq_step_Hz)
+    iq_file_names = [iq_file_name for (_, _, _, iq_file_name) in steps]
+    
+    panorama_file_name = None
+    if file_path is not None:
+        panorama_file_name = os.path.join(file_path, 'sdr_' + sdr_type + '_sweep_' + str(freq_start_Hz) + '_' + str(freq_end_Hz) + '_fs_' + str(sample_rate) + '_' + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + '.npz')
+        np.savez(panorama_file_name, frequencies_Hz=frequencies_Hz, mean_psd=mean_psd, max_psd=max_psd,
+                 step_center_freq_Hz=np.array(freq_list), step_frequencies_Hz=frequencies, step_mean_psd=step_spectra[:, 0], step_max_psd=step_spectra[:, 1],
+                 sample_rate=sample_rate, time_to_collect_sec=time_to_collect_sec, freq_step_Hz=freq_step_Hz, nfft=nfft, sdr_type=sdr_type)
+        logging.info(f'Saved the sweep panorama to {panorama_file_name}')
+    
+    return (panorama_file_name, frequencies_Hz, mean_psd, max_psd, iq_file_names)
+
+
+# gnuradio sink block that writes the samples it receives into a rf_tools.StreamingCapture. The work function only copies the
+# samples into the preallocated ring buffer, so the flowgraph is never held up by the consumers of the capture.
+# The class is made by ring_buffer_sink_class the first time it is called.
+@functools.lru_cache(maxsize=None)
+def ring_buffer_sink_class():
+    from gnuradio import gr
+
+    class ring_buffer_sink(gr.sync_block):
+        def __init__(self, capture):
+            gr.sync_block.__init__(self, name='ring_buffer_sink', in_sig=[np.complex64], out_sig=None)
+            self.capture = capture
+
+        def work(self, input_items, output_items):
+            self.capture.write(input_items[0])
+            return len(input_items[0])
+
+    return ring_buffer_sink
+
+
+# This function streams the samples from the SDR, or from source, into the rf_tools.StreamingCapture capture while its consumers
+# (for example rf_tools.RollingSpectrogramConsumer, rf_tools.PowerMeterConsumer and rf_tools.DiskWriterConsumer) process them.
+# The stream runs for time_to_collect_sec, or if time_to_collect_sec is None until stop_event is set, so a capture can run
+# indefinitely with constant memory. The function returns capture.stats() with the blocks written and the blocks processed
+# and dropped by each consumer.
+def sdr_stream(capture, sample_rate = 1024000, center_freq_Hz = 100e6, time_to_collect_sec = None, stop_event = None, source = None):
+    from gnuradio import gr, blocks
+    if not isinstance(capture, rf_tools.StreamingCapture):
+        log_and_raise('The capture is not a rf_tools.StreamingCapture')
+    if time_to_collect_sec is None and stop_event is None:
+        log_and_raise('Either time_to_collect_sec or stop_event must be given')
+    
+    tb = gr.top_block()
+    if source is None:
+        source = sdr_rtlsdr_source(sample_rate = sample_rate, center_freq_Hz = center_freq_Hz)
+    sink = ring_buffer_sink_class()(capture)
+    if time_to_collect_sec is None:
+        tb.connect(source, sink)
+    else:
+        tb.connect(source, blocks.head(gr.sizeof_gr_complex, int(time_to_collect_sec*sample_rate)), sink)
+    
+    capture.start()
+    try:
+        tb.start()
+        if time_to_collect_sec is None:
+            stop_event.wait()
+            tb.stop()
+        tb.wait()
+    finally:
+        capture.stop()
+    
+    stats = capture.stats()
+    logging.info(f'Streamed {stats["samples_written"]} samples: {stats["consumers"]}')
+    return stats
+
+
 # main function which is useful for testing the functions
 def main():
     
@@ -0,0 +1,34 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# rf_tools is a flat module in the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import rf_tools
+import rf_tools_benchmark
+
+
+# The spectrogram cache is turned off so the tests do not write to the cache directory of the user
+@pytest.fixture(autouse=True)
+def no_spectrogram_cache():
+    previous = rf_tools.set_spectrogram_cache(None)
+    yield
+    rf_tools.set_spectrogram_cache(previous)
+
+
+# A directory of short synthetic captures at different center frequencies, as written by rf_tools_benchmark
+@pytest.fixture
+def capture_dir(tmp_path):
+    for index in range(4):
+        rf_tools_benchmark.write_synthetic_capture(str(tmp_path), 1_024_000, 0.01, center_freq_Hz=100_000_000 + index*500_000, seed=index)
+    return tmp_path
+
+
+# One synthetic capture of 1.2 s, long enough to hold one of the 100 ms bursts of write_synthetic_capture
+@pytest.fixture
+def long_record(tmp_path):
+    return rf_tools_benchmark.write_synthetic_capture(str(tmp_path), 256_000, 1.2)
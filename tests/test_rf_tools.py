@@ -0,0 +1,244 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+import scipy.signal
+
+import rf_tools
+import rf_tools_benchmark
+
+
+# compute_spectrogram_db is the same to the bit as scipy.signal.spectrogram followed by the fftshift and dB of the renderer
+def test_spectrogram_matches_scipy(long_record):
+    (x, _) = rf_tools.load_capture_file(long_record, mmap_mode='r')
+    sample_rate = long_record['sample_rate']
+    (frequencies, times, spectrogram_db) = rf_tools.compute_spectrogram_db(x, sample_rate)
+
+    (f, t, Sxx) = scipy.signal.spectrogram(np.asarray(x), fs=sample_rate, window=rf_tools.SPECTROGRAM_WINDOW, nperseg=rf_tools.SPECTROGRAM_NPERSEG,
+                                           noverlap=rf_tools.SPECTROGRAM_NOVERLAP, return_onesided=False, mode='complex', scaling='density')
+    expected = 10*np.log10(np.abs(np.fft.fftshift(Sxx, axes=0)))
+
+    assert np.array_equal(frequencies, np.fft.fftshift(f))
+    assert np.array_equal(times, t)
+    assert np.array_equal(spectrogram_db, expected)
+
+
+# The streaming STFT gives the same spectrogram whatever the chunk size, including chunks that do not line up with the segments
+@pytest.mark.parametrize('chunk_size', [100, 1000, 4097, 65536])
+def test_spectrogram_does_not_depend_on_chunk_size(long_record, chunk_size):
+    (x, _) = rf_tools.load_capture_file(long_record, mmap_mode='r')
+    (_, _, expected) = rf_tools.compute_spectrogram_db(x, long_record['sample_rate'], chunk_size=len(x))
+    (_, _, spectrogram_db) = rf_tools.compute_spectrogram_db(x, long_record['sample_rate'], chunk_size=chunk_size)
+    assert np.array_equal(spectrogram_db, expected)
+
+
+# Each component of a decoded int8 capture is within half a quantization step of the block it is in, and slicing the
+# QuantizedCapture view decodes the same samples as decoding the whole capture
+def test_quantized_capture_round_trip(tmp_path):
+    block_size = 1000
+    record = rf_tools_benchmark.write_synthetic_capture(str(tmp_path), 256_000, 0.05)
+    (original, _) = rf_tools.load_capture_file(record)
+
+    assert rf_tools.convert_capture_file(record, dtype='int8', block_size=block_size) is not None
+    record = rf_tools.sdr_scan_db(str(tmp_path))[0]
+    assert record['layout'] == 'blockscaled_iq'
+    (x, full_file_name) = rf_tools.load_capture_file(record, mmap_mode='r')
+    assert isinstance(x, rf_tools.QuantizedCapture)
+    assert os.path.exists(Path(full_file_name).with_name(record['block_scales_file_name']))
+
+    decoded = np.asarray(x)
+    step = np.repeat(x.scales, block_size)[:len(decoded)].astype(np.float64)
+    assert np.all(np.abs(decoded.real - original.real) <= 0.5*step*(1 + 1e-5))
+    assert np.all(np.abs(decoded.imag - original.imag) <= 0.5*step*(1 + 1e-5))
+    assert np.array_equal(x[1234:5678], decoded[1234:5678])
+    assert x[-1] == decoded[-1]
+
+
+# read_slice reads only the slice, but gives the same samples as mixing, filtering and decimating the whole capture
+def test_read_slice_matches_full_zoom(long_record):
+    (x, _) = rf_tools.load_capture_file(long_record)
+    sample_rate = long_record['sample_rate']
+    center_freq_Hz = long_record['center_freq_Hz']
+    (t_start, t_stop) = (0.2, 0.3)
+    (f_low, f_high) = (center_freq_Hz + 20_000, center_freq_Hz + 36_000)
+
+    (plain, plain_sample_rate, _) = rf_tools.read_slice(long_record, t_start, t_stop)
+    assert plain_sample_rate == sample_rate
+    assert np.array_equal(plain, x[int(t_start*sample_rate):int(t_stop*sample_rate)])
+
+    (zoom, zoom_sample_rate, zoom_center_Hz) = rf_tools.read_slice(long_record, t_start, t_stop, f_low=f_low, f_high=f_high)
+    bandwidth = f_high - f_low
+    decimation = int(sample_rate // bandwidth)
+    assert zoom_sample_rate == sample_rate / decimation
+    assert zoom_center_Hz == (f_low + f_high)/2
+
+    # the reference mixes and filters the whole capture and then keeps every decimation-th sample of the slice
+    half_length = rf_tools.ZOOM_TAPS_PER_DECIMATION*decimation
+    taps = scipy.signal.firwin(2*half_length + 1, bandwidth/2, fs=sample_rate)
+    mixed = x*np.exp(-2j*np.pi*(zoom_center_Hz - center_freq_Hz)/sample_rate*np.arange(len(x)))
+    filtered = np.convolve(mixed, taps)[half_length:half_length + len(x)]
+    start = int(round(t_start*sample_rate))
+    expected = filtered[start:int(round(t_stop*sample_rate)):decimation]
+    np.testing.assert_allclose(zoom, expected, rtol=0, atol=1e-9)
+
+
+# The polyphase channelizer carries its filter state across chunks, so the channels do not depend on the chunk size
+def test_channelizer_does_not_depend_on_chunk_size(long_record):
+    (x, _) = rf_tools.load_capture_file(long_record)
+    x = x[:100_000]
+    channel_count = 8
+    expected = np.concatenate(list(rf_tools.pfb_channelize_stream([x], channel_count)), axis=1)
+    assert expected.shape == (channel_count, len(x) // channel_count)
+    for chunk_size in (333, 4096, 50_001):
+        channels = np.concatenate(list(rf_tools.pfb_channelize_stream(rf_tools.iter_capture_chunks(x, chunk_size), channel_count)), axis=1)
+        np.testing.assert_allclose(channels, expected, rtol=0, atol=1e-6)
+
+
+# Workers that share a work queue process each capture exactly once
+def test_work_queue_processes_each_capture_once(capture_dir):
+    processed = []
+    lock = threading.Lock()
+
+    def process(params):
+        time.sleep(0.01)
+        with lock:
+            processed.append(params['file_name'])
+        return None
+
+    stats = []
+    def worker():
+        stats.append(rf_tools.WorkQueue(capture_dir, 'test', {}).run(process))
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    file_names = sorted(params['file_name'] for params in rf_tools.sdr_scan_db(str(capture_dir)))
+    assert sorted(processed) == file_names
+    assert sum(worker_stats['processed'] for worker_stats in stats) == len(file_names)
+    # a second run finds every capture done
+    assert rf_tools.WorkQueue(capture_dir, 'test', {}).run(process)['done'] == len(file_names)
+
+
+# An expired lease is taken over by another worker and a lease that is still held is not
+def test_work_queue_expired_lease(capture_dir):
+    json_file_name = Path(rf_tools.sdr_scan_db(str(capture_dir))[0]['file_name']).with_suffix('.json').name
+    first = rf_tools.WorkQueue(capture_dir, 'test', {}, lease_seconds=60)
+    second = rf_tools.WorkQueue(capture_dir, 'test', {}, lease_seconds=60)
+    assert first.claim(json_file_name)
+    assert not second.claim(json_file_name)
+
+    expired = time.time() - 3600
+    os.utime(first.lease_file_name(json_file_name), (expired, expired))
+    assert second.claim(json_file_name)
+    # the first worker lost its lease and can no longer renew, release or complete it
+    assert not first.renew(json_file_name)
+    first.release(json_file_name)
+    assert second.holds_lease(json_file_name)
+    assert not first.complete(json_file_name, [0])
+    assert second.complete(json_file_name, [0])
+    assert not second.lease_file_name(json_file_name).exists()
+
+
+# sdr_render_db only renders the captures that are new or changed, or whose PNG is missing or was made with other parameters
+def test_incremental_render(capture_dir):
+    record_count = len(rf_tools.sdr_scan_db(str(capture_dir)))
+    assert len(rf_tools.sdr_render_db(capture_dir, render_mode='raster')) == record_count
+    assert rf_tools.sdr_render_db(capture_dir, render_mode='raster') == []
+
+    # a changed json file and a removed PNG file are rendered again
+    records = sorted(rf_tools.sdr_scan_db(str(capture_dir)), key=lambda params: params['file_name'])
+    json_file_name = capture_dir / Path(records[0]['file_name']).with_suffix('.json')
+    os.utime(json_file_name, ns=(os.stat(json_file_name).st_atime_ns, os.stat(json_file_name).st_mtime_ns + 10**9))
+    rendered = rf_tools.sdr_render_db(capture_dir, render_mode='raster')
+    assert len(rendered) == 1
+    os.remove(rendered[0])
+    assert rf_tools.sdr_render_db(capture_dir, render_mode='raster') == rendered
+
+    # force renders every capture
+    assert len(rf_tools.sdr_render_db(capture_dir, render_mode='raster', force=True)) == record_count
+
+
+# The mesh and raster renders write their own PNG files and are tracked as separate products, so neither overwrites the other
+def test_render_modes_have_their_own_files(capture_dir):
+    mesh = rf_tools.sdr_render_db(capture_dir, render_mode='mesh')
+    raster = rf_tools.sdr_render_db(capture_dir, render_mode='raster')
+    assert len(mesh) == len(raster) > 0
+    assert not set(mesh) & set(raster)
+    assert all(os.path.exists(file_name) for file_name in mesh + raster)
+    assert rf_tools.sdr_render_db(capture_dir, render_mode='mesh') == []
+    assert rf_tools.sdr_render_db(capture_dir, render_mode='raster') == []
+
+
+# json files that are not capture records are left out of the catalog instead of stopping sdr_load_db
+def test_catalog_skips_json_that_is_not_a_record(capture_dir):
+    record_count = len(rf_tools.sdr_scan_db(str(capture_dir)))
+    (capture_dir / 'list.json').write_text('[1, 2, 3]')
+    (capture_dir / 'notes.json').write_text('{"note": "not a capture"}')
+    (capture_dir / 'broken.json').write_text('{')
+    assert len(rf_tools.sdr_load_db(str(capture_dir))) == record_count
+    assert len(rf_tools.sdr_load_db(str(capture_dir))) == record_count
+
+
+# The noise floor of detect_events is estimated over windows of spectrogram columns and not over the chunks the capture is read
+# in, so the events are the same for every chunk size, also when the bursts cross the boundaries of the windows
+@pytest.mark.parametrize('floor_columns', [rf_tools.DETECT_FLOOR_COLUMNS, 1500])
+def test_detect_events_does_not_depend_on_chunk_size(long_record, monkeypatch, floor_columns):
+    monkeypatch.setattr(rf_tools, 'DETECT_FLOOR_COLUMNS', floor_columns)
+    (x, _) = rf_tools.load_capture_file(long_record, mmap_mode='r')
+    expected = rf_tools.detect_events(x, long_record['sample_rate'], chunk_size=len(x))
+    assert expected
+    for chunk_size in (30_000, 100_003):
+        assert rf_tools.detect_events(x, long_record['sample_rate'], chunk_size=chunk_size) == expected
+
+
+# capture_statistics uses the noise floor windows of detect_events, so it does not depend on the chunk size, and sdr_stats_db
+# computes the statistics again when the floor window changes instead of keeping the rows of the old table
+def test_capture_statistics_does_not_depend_on_chunk_size(long_record, monkeypatch, tmp_path):
+    (x, _) = rf_tools.load_capture_file(long_record, mmap_mode='r')
+    (expected_capture, expected_bins) = rf_tools.capture_statistics(x, long_record['sample_rate'], chunk_size=len(x))
+    (capture_stats, bin_stats) = rf_tools.capture_statistics(x, long_record['sample_rate'], chunk_size=30_000)
+    for key in rf_tools.STATS_CAPTURE_KEYS:
+        np.testing.assert_allclose(capture_stats[key], expected_capture[key], rtol=1e-12)
+    for key in rf_tools.STATS_BIN_KEYS:
+        np.testing.assert_allclose(bin_stats[key], expected_bins[key], rtol=1e-12)
+
+    assert rf_tools.sdr_stats_db(tmp_path) == 1
+    assert rf_tools.sdr_stats_db(tmp_path) == 0
+    monkeypatch.setattr(rf_tools, 'DETECT_FLOOR_COLUMNS', 1500)
+    assert rf_tools.sdr_stats_db(tmp_path) == 1
+    assert '"floor_columns": 1500' in rf_tools.sdr_stats_parameters(tmp_path)
+
+
+# The rolling spectrogram of contiguous blocks is the spectrogram of the capture, and after dropped blocks the STFT starts again
+# at the start_sample of the next block so no column spans the gap
+def test_rolling_spectrogram_uses_start_sample(long_record):
+    (x, _) = rf_tools.load_capture_file(long_record)
+    sample_rate = long_record['sample_rate']
+    block_size = 4096
+    x = x[:10*block_size]
+
+    consumer = rf_tools.RollingSpectrogramConsumer(sample_rate, column_count=4096)
+    for start in range(0, len(x), block_size):
+        consumer.process(x[start:start + block_size], start)
+    (_, times, spectrogram_db) = consumer.get_spectrogram()
+    (_, expected_times, expected) = rf_tools.compute_spectrogram_db(x, sample_rate)
+    assert consumer.gap_count == 0
+    np.testing.assert_allclose(times, expected_times)
+    assert np.array_equal(spectrogram_db, expected)
+
+    # blocks 3 and 4 are dropped
+    consumer = rf_tools.RollingSpectrogramConsumer(sample_rate, column_count=4096)
+    for start in list(range(0, 3*block_size, block_size)) + list(range(5*block_size, len(x), block_size)):
+        consumer.process(x[start:start + block_size], start)
+    (_, times, spectrogram_db) = consumer.get_spectrogram()
+    (_, before_times, before) = rf_tools.compute_spectrogram_db(x[:3*block_size], sample_rate)
+    (_, after_times, after) = rf_tools.compute_spectrogram_db(x[5*block_size:], sample_rate)
+    assert consumer.gap_count == 1
+    np.testing.assert_allclose(times, np.concatenate((before_times, after_times + 5*block_size/sample_rate)))
+    assert np.array_equal(spectrogram_db, np.concatenate((before, after), axis=1))
+    consumer.close()